@@ -4,12 +4,14 @@ import json
 import logging
 import asyncio
 import os
+import time
+import uuid
 import httpx
 from dotenv import load_dotenv
 from fastapi import FastAPI, Request, HTTPException
 
 load_dotenv()
-from fastapi.responses import FileResponse, StreamingResponse
+from fastapi.responses import StreamingResponse, PlainTextResponse
 from pydantic import BaseModel
 from slowapi import Limiter, _rate_limit_exceeded_handler
 from slowapi.util import get_remote_address
@@ -18,7 +20,23 @@ from slowapi.errors import RateLimitExceeded
 from fastapi.staticfiles import StaticFiles
 
 # Import the compiled LangGraph app from your main agent script
-from main_agent import app
+from main_agent import app, reset_db_schema
+from llm_governor import governor
+from llm_cache import cache_stats as llm_cache_stats
+from profiler import profiling, profile_thread, should_profile, is_admin, profile_path, list_profiles
+import metrics
+from singleflight import SingleFlight
+from sessions import session_store, context_key
+from result_store import result_store
+from export import export_registry, export_stream, EXPORT_FORMATS
+from tools import get_engine
+from contractor_fts import reset_fts_cache
+from data_version import DataVersionWatcher
+from static_assets import StaticAssets, JSONCompressionMiddleware, STATIC_RELOAD_SECONDS
+# The encoder lives with the offload pool, which serializes large events out of process.
+from offload import CustomJSONEncoder, serialize_event, monitor_event_loop_lag
+from jobs import JobManager, JobStore, JOBS_DB_PATH
+from batch import run_batch, BATCH_MAX_QUESTIONS, BATCH_MAX_CONCURRENCY
 
 # --- Environment Variables ---
 
@@ -26,24 +44,12 @@ from main_agent import app
 # --- Rate Limiting ---
 limiter = Limiter(key_func=get_remote_address)
 
-# --- 1. Custom JSON Encoder ---
-# This class teaches Python's JSON library how to handle special types
-# that it doesn't know about, like NumPy numbers and Pandas DataFrames.
-class CustomJSONEncoder(json.JSONEncoder):
-    def default(self, obj):
-        if isinstance(obj, (np.integer, np.int64)):
-            return int(obj)
-        if isinstance(obj, (np.floating, np.float64)):
-            return float(obj)
-        if isinstance(obj, pd.DataFrame):
-            # Convert DataFrame to a JSON-friendly dict with 'split' orientation
-            return obj.to_dict(orient='split')
-        # Let the base class default method raise the TypeError
-        return super(CustomJSONEncoder, self).default(obj)
-
 # --- API Setup ---
 api = FastAPI()
 api.mount("/static", StaticFiles(directory="static"), name="static")
+api.add_middleware(JSONCompressionMiddleware)
+# Content-hashed, precompressed copies of static/ that the index page links to.
+static_assets = StaticAssets()
 
 @api.middleware("http")
 async def add_security_headers(request: Request, call_next):
@@ -55,13 +61,99 @@ api.state.limiter = limiter
 api.add_exception_handler(RateLimitExceeded, _rate_limit_exceeded_handler)
 logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s")
 
+@api.on_event("startup")
+async def start_event_loop_monitor():
+    """Continuously samples event-loop lag so stalls show up in /metrics."""
+    api.state.loop_monitor = asyncio.create_task(
+        monitor_event_loop_lag(lambda lag: metrics.record_latency("event_loop.lag", lag))
+    )
+
+@api.on_event("startup")
+async def start_data_version_watcher():
+    """Drops caches derived from the data when `ingest.py` bumps the data version."""
+    watcher = DataVersionWatcher(get_engine().url.database)
+    watcher.on_change(reset_fts_cache)
+    watcher.on_change(reset_db_schema)
+    watcher.on_change(session_store.clear)
+    # Stored results are left alone: running requests and exports still refer to them,
+    # and they expire on their own after RESULT_STORE_TTL.
+    api.state.data_version_watcher = asyncio.create_task(watcher.run())
+
+@api.on_event("startup")
+async def build_static_assets():
+    """Hashes and precompresses static/ once, off the event loop, before the first page load."""
+    await asyncio.to_thread(static_assets.refresh)
+    if STATIC_RELOAD_SECONDS > 0:
+        api.state.static_assets_watcher = asyncio.create_task(static_assets.watch())
+
 # --- Pydantic Models ---
 class AgentRequest(BaseModel):
     question: str
     honeypot: str | None = None
+    # Identifies the browser tab's conversation so follow-ups can reuse the last result.
+    session_id: str | None = None
+
+class BatchRequest(BaseModel):
+    questions: list[str]
+    max_concurrency: int | None = None
+    honeypot: str | None = None
 
 # --- Helper Functions ---
+async def agent_events(inputs: dict, profile_trace_id: str | None = None):
+    """
+    Runs the agent graph and yields each node's output as a Server-Sent Event.
+    With `profile_trace_id`, the run is sampled and saved as a profile under that ID.
+    """
+    try:
+        # The event loop thread is sampled too (graph scheduling, event serialization); under
+        # concurrent load its stacks can include other requests' work, node threads cannot.
+        with profiling(profile_trace_id), profile_thread("event_loop"):
+            # Use 'astream' to get real-time updates from the LangGraph
+            async for chunk in app.astream(inputs):
+                # Each chunk is a dictionary where the key is the node that just ran
+                for node_name, node_output in chunk.items():
+                    if isinstance(node_output, dict) and node_output.get("result_id"):
+                        # The graph passes results by ID; the client still receives the rows.
+                        node_output = {**node_output, "sql_dataframe": result_store.view(node_output["result_id"])}
+                    event_data = {"event": node_name, "data": node_output}
+                    # Yield the event in Server-Sent Event format, using our custom encoder
+                    yield await serialize_event(event_data)
+                    await asyncio.sleep(0.1)
+
+        # Send a final 'end' event
+        yield f"data: {json.dumps({'event': 'end'})}\n\n"
+
+    except Exception as e:
+        metrics.increment("stream_agent.errors")
+        logging.error(f"Error during stream: {e}")
+        yield f"data: {json.dumps({'event': 'error', 'data': str(e)})}\n\n"
+
+# Concurrent requests for the same question share one graph execution.
+agent_flights = SingleFlight("stream_agent")
+
+def session_events(data: AgentRequest, profile_trace_id: str | None = None):
+    """
+    Runs (or joins) the agent for a question in the context of the session's last result,
+    then points the session at the new result for its next follow-up.
+    """
+    previous_key = session_store.current_key(data.session_id)
+    key = context_key(previous_key, data.question)
+    inputs = {"question": data.question, "previous_context": previous_key, "context_key": key}
+    if profile_trace_id:
+        # A profiled run is never shared, so its profile covers exactly one execution.
+        events = agent_events(inputs, profile_trace_id)
+    else:
+        events = agent_flights.subscribe(key, lambda: agent_events(inputs))
 
+    async def stream():
+        async for event in events:
+            yield event
+        if data.session_id:
+            session_store.attach(data.session_id, key)
+    return stream()
+
+# Background jobs whose events survive client disconnects (and, once finished, restarts).
+job_manager = JobManager(JobStore(JOBS_DB_PATH))
 
 # --- API Endpoints ---
 
@@ -71,6 +163,7 @@ async def stream_agent_endpoint(request: Request, data: AgentRequest):
     """
     Receives a question via a POST request and streams the agent's progress.
     Includes reCAPTCHA, honeypot, and rate limiting checks.
+    Identical questions already being answered are joined instead of re-run.
     """
     # Honeypot check
     if data.honeypot:
@@ -78,30 +171,139 @@ async def stream_agent_endpoint(request: Request, data: AgentRequest):
         logging.warning(f"Honeypot field filled by {request.client.host}. Value: {data.honeypot}")
         raise HTTPException(status_code=400, detail="Invalid request")
 
-    inputs = {"question": data.question}
+    trace_id = uuid.uuid4().hex
+    profile = should_profile(request.headers.get("x-profile"))
+    if profile:
+        logging.info(f"Profiling request {trace_id}: {data.question!r}")
+    events = session_events(data, trace_id if profile else None)
 
     async def event_stream():
         """The generator function that yields events as the agent runs."""
-        try:
-            # Use 'astream' to get real-time updates from the LangGraph
-            async for chunk in app.astream(inputs):
-                # Each chunk is a dictionary where the key is the node that just ran
-                for node_name, node_output in chunk.items():
-                    event_data = {"event": node_name, "data": node_output}
-                    # Yield the event in Server-Sent Event format, using our custom encoder
-                    yield f"data: {json.dumps(event_data, cls=CustomJSONEncoder)}\n\n"
-                    await asyncio.sleep(0.1)
-            
-            # Send a final 'end' event
-            yield f"data: {json.dumps({'event': 'end'})}\n\n"
+        started = time.perf_counter()
+        async for event in events:
+            yield event
+        metrics.record_latency("stream_agent.time_to_end", time.perf_counter() - started)
+
+    return StreamingResponse(event_stream(), media_type="text/event-stream", headers={"X-Trace-Id": trace_id})
+
+@api.post("/jobs")
+async def create_job_endpoint(request: Request, data: AgentRequest):
+    """
+    Starts the agent as a background job and returns its ID immediately.
+    Progress is read from /jobs/{job_id}/events, which can be resumed after a disconnect.
+    """
+    if data.honeypot:
+        logging.warning(f"Honeypot field filled by {request.client.host}. Value: {data.honeypot}")
+        raise HTTPException(status_code=400, detail="Invalid request")
+
+    job_id = await job_manager.start(data.question, lambda: session_events(data))
+    return {"job_id": job_id, "status": "running", "events_url": f"/jobs/{job_id}/events"}
+
+@api.get("/jobs/{job_id}")
+async def get_job_endpoint(job_id: str):
+    """Returns the status of a job."""
+    job = await asyncio.to_thread(job_manager.store.get, job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Job not found or expired")
+    return job
+
+@api.get("/jobs/{job_id}/events")
+async def job_events_endpoint(request: Request, job_id: str):
+    """
+    Streams a job's events as SSE. Each event carries an `id`, and a reconnecting
+    client sends it back in the `Last-Event-ID` header to receive only what it missed.
+    """
+    if await asyncio.to_thread(job_manager.store.get, job_id) is None:
+        raise HTTPException(status_code=404, detail="Job not found or expired")
+    try:
+        last_event_id = int(request.headers.get("last-event-id") or request.query_params.get("last_event_id") or 0)
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Invalid Last-Event-ID")
+    return StreamingResponse(job_manager.stream(job_id, last_event_id), media_type="text/event-stream")
+
+@api.post("/batch-agent")
+async def batch_agent_endpoint(request: Request, data: BatchRequest):
+    """
+    Answers a list of questions in one request, running up to max_concurrency at a time.
+    Streams one NDJSON line per question as soon as it completes or fails.
+    """
+    if data.honeypot:
+        logging.warning(f"Honeypot field filled by {request.client.host}. Value: {data.honeypot}")
+        raise HTTPException(status_code=400, detail="Invalid request")
+    if not data.questions or len(data.questions) > BATCH_MAX_QUESTIONS:
+        raise HTTPException(status_code=400, detail=f"Provide between 1 and {BATCH_MAX_QUESTIONS} questions")
+
+    max_concurrency = min(data.max_concurrency or BATCH_MAX_CONCURRENCY, BATCH_MAX_CONCURRENCY)
+    if max_concurrency < 1:
+        raise HTTPException(status_code=400, detail="max_concurrency must be at least 1")
+    return StreamingResponse(run_batch(data.questions, max_concurrency), media_type="application/x-ndjson")
+
+@api.get("/export/{export_id}")
+async def export_endpoint(request: Request, export_id: str, format: str = "csv", gzip: bool = True):
+    """
+    Streams every row of an answer's query as CSV or NDJSON, re-running its validated SQL
+    on a read-only cursor in fixed-size chunks, optionally gzip-compressed on the fly.
+    """
+    sql = export_registry.get(export_id)
+    if sql is None:
+        raise HTTPException(status_code=404, detail="Export not found or expired")
+    if format not in EXPORT_FORMATS:
+        raise HTTPException(status_code=400, detail=f"Unsupported format; use one of {', '.join(EXPORT_FORMATS)}")
+
+    try:
+        # Executing the query can take a while; keep it off the event loop. The body is a sync
+        # generator, so StreamingResponse also pulls each fetchmany chunk on a worker thread.
+        body = await asyncio.to_thread(export_stream, get_engine().url.database, sql, format, gzip)
+    except Exception as e:
+        logging.error(f"Export {export_id} failed: {e}")
+        raise HTTPException(status_code=500, detail="Export failed")
+
+    filename = f"floodgpt-{export_id[:8]}.{format}"
+    media_type = EXPORT_FORMATS[format]
+    headers = {}
+    if gzip and "gzip" in request.headers.get("accept-encoding", ""):
+        # The browser decompresses transparently and saves the plain file.
+        headers["Content-Encoding"] = "gzip"
+    elif gzip:
+        filename, media_type = filename + ".gz", "application/gzip"
+    headers["Content-Disposition"] = f'attachment; filename="{filename}"'
+    return StreamingResponse(body, media_type=media_type, headers=headers)
+
+@api.get("/metrics")
+async def metrics_endpoint():
+    """Reports runtime metrics, including LLM queue depth and wait times."""
+    return {
+        "llm_governor": governor.metrics(),
+        "llm_cache": llm_cache_stats(),
+        "sessions": session_store.stats(),
+        "results": result_store.stats(),
+        **metrics.snapshot(),
+    }
+
+@api.get("/admin/profiles")
+async def list_profiles_endpoint(request: Request):
+    """Lists saved request profiles by trace ID, newest first."""
+    if not is_admin(request.headers.get("x-admin-token")):
+        raise HTTPException(status_code=404)
+    return {"profiles": list_profiles()}
 
-        except Exception as e:
-            logging.error(f"Error during stream: {e}")
-            yield f"data: {json.dumps({'event': 'error', 'data': str(e)})}\n\n"
+@api.get("/admin/profiles/{trace_id}")
+async def get_profile_endpoint(request: Request, trace_id: str):
+    """Returns a request's profile as collapsed stacks (open it in speedscope or flamegraph.pl)."""
+    if not is_admin(request.headers.get("x-admin-token")):
+        raise HTTPException(status_code=404)
+    path = profile_path(trace_id)
+    if path is None or not os.path.exists(path):
+        raise HTTPException(status_code=404, detail="Profile not found")
+    with open(path, encoding="utf-8") as f:
+        return PlainTextResponse(f.read())
 
-    return StreamingResponse(event_stream(), media_type="text/event-stream")
+@api.get("/assets/{hashed_path:path}")
+async def read_asset(request: Request, hashed_path: str):
+    """Serves a content-hashed static file with immutable caching and gzip/brotli negotiation."""
+    return static_assets.asset_response(request, hashed_path)
 
 @api.get("/")
-async def read_index():
-    """Serves the main index.html file at the root URL."""
-    return FileResponse('floodgpt.html')
\ No newline at end of file
+async def read_index(request: Request):
+    """Serves the main index.html file at the root URL, revalidated with its ETag."""
+    return static_assets.index_response(request)
\ No newline at end of file
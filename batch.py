@@ -0,0 +1,131 @@
+import asyncio
+import json
+import logging
+import os
+
+from langchain_core.runnables import RunnableLambda
+
+import metrics
+from main_agent import get_db_schema, has_unsupported_keyword, content_classification_chain
+from offload import CustomJSONEncoder
+from tools import (
+    question_relevance_chain, sql_generation_chain, sql_generation_inputs, clean_generated_sql, sql_validation_chain,
+    parse_validation_response, execute_sql_query, sanitize_and_validate_data, insight_chain, insight_data_summary,
+)
+
+# --- 1. Configuration ---
+BATCH_MAX_QUESTIONS = int(os.getenv("BATCH_MAX_QUESTIONS", "200"))
+# Upper bound on concurrent LLM calls / queries per batch; requests may ask for less.
+BATCH_MAX_CONCURRENCY = int(os.getenv("BATCH_MAX_CONCURRENCY", "8"))
+
+def _ndjson(record: dict) -> str:
+    return json.dumps(record, cls=CustomJSONEncoder) + "\n"
+
+def _failed(item: dict, error: str) -> str:
+    metrics.increment("batch_agent.failed")
+    return _ndjson({"event": "result", **item, "error": error})
+
+# --- 2. Batch Pipeline ---
+async def _answer(item: dict, db_schema: str, chains: dict) -> str:
+    """Takes one question through relevance, generation, validation, execution and insight."""
+    # Stage 0: keyword guard (no LLM call)
+    if has_unsupported_keyword(item["question"]):
+        return _failed(item, "Unsupported question")
+
+    # Stage 1: relevance classification
+    answer = await chains["relevance"].ainvoke({"schema": db_schema, "question": item["question"]})
+    if answer.strip().lower() != "related":
+        return _failed(item, "Unsupported question")
+
+    # Stage 2: SQL generation
+    inputs, item["sql_variant"] = sql_generation_inputs(item["question"], db_schema)
+    item["generated_sql"] = clean_generated_sql(await chains["generation"].ainvoke(inputs))
+
+    # Stage 3: SQL validation and correction
+    try:
+        answer = await chains["validation"].ainvoke({"schema": db_schema, "sql_query": item["generated_sql"]})
+    except Exception as e:
+        # Validation is a safeguard; fall back to the generated query as the graph would.
+        logging.warning(f"Batch validation failed for: {item['question']}. Error: {e}")
+        item["validated_sql"] = item["generated_sql"]
+    else:
+        validation = parse_validation_response(item["generated_sql"], answer)
+        if not validation.get("valid"):
+            metrics.increment(f"sql.{item['sql_variant']}.corrected")
+        corrected = (validation.get("corrected_query") or "").strip()
+        # A failed validation without a usable correction keeps the generated query.
+        item["validated_sql"] = item["generated_sql"] if validation.get("valid") or not corrected else corrected
+
+    # Stage 4: execution over the pooled engine
+    try:
+        result = await asyncio.to_thread(execute_sql_query, item["validated_sql"])
+        if "error" not in result:
+            result["sql_dataframe"] = await asyncio.to_thread(sanitize_and_validate_data, result["sql_dataframe"])
+    except Exception as e:
+        logging.error(f"Batch query failed for: {item['question']}. Error: {e}")
+        result = {"error": str(e)}
+    if "error" in result:
+        metrics.increment(f"sql.{item['sql_variant']}.execution_failed")
+        return _failed(item, result["error"])
+    item["sql_dataframe"] = result["sql_dataframe"]
+    item["truncated"] = result["truncated"]
+
+    # Stage 5: insight + moderation
+    if item["sql_dataframe"].empty:
+        item["insight"] = "The query returned no data, so there is nothing to explain."
+        return _ndjson({"event": "result", **item})
+    try:
+        output = await chains["insight"].ainvoke(
+            {"question": item["question"], "data_summary": insight_data_summary(item["sql_dataframe"])}
+        )
+    except Exception as e:
+        item["insight"] = "No insight available."
+        item["insight_error"] = str(e)
+    else:
+        if "unsafe" in output["classification"].strip().lower():
+            logging.error(f"Inappropriate content detected in batch insight for: {item['question']}")
+            return _failed({k: v for k, v in item.items() if k != "sql_dataframe"}, "Inappropriate content")
+        item["insight"] = output["insight"]
+    metrics.increment("batch_agent.completed")
+    return _ndjson({"event": "result", **item})
+
+async def run_batch(questions: list, max_concurrency: int):
+    """
+    Answers many questions concurrently: each question goes through every stage on its own,
+    with at most `max_concurrency` questions (and so LLM calls or queries) in flight. The
+    schema is loaded once and the calls share the governor's quota. Each question is
+    streamed back as an NDJSON line as soon as it fails or its insight is ready, so early
+    questions do not wait for the rest of the batch.
+    """
+    db_schema = await asyncio.to_thread(get_db_schema)
+    moderation = content_classification_chain()
+
+    def _moderate(insight: str) -> dict:
+        return {"insight": insight, "classification": moderation.invoke({"text": insight})}
+
+    chains = {
+        "relevance": question_relevance_chain(),
+        "generation": sql_generation_chain(),
+        "validation": sql_validation_chain(),
+        "insight": insight_chain() | RunnableLambda(_moderate),
+    }
+    semaphore = asyncio.Semaphore(max_concurrency)
+
+    async def _run(item: dict) -> str:
+        async with semaphore:
+            try:
+                return await _answer(item, db_schema, chains)
+            except Exception as e:
+                # One failing question becomes its error record instead of ending the response.
+                return _failed(item, str(e))
+
+    tasks = [asyncio.create_task(_run({"index": i, "question": q})) for i, q in enumerate(questions)]
+    try:
+        for completed in asyncio.as_completed(tasks):
+            yield await completed
+    finally:
+        # The client disconnected (or the response ended): stop the questions still queued.
+        for task in tasks:
+            task.cancel()
+
+    yield _ndjson({"event": "end", "questions": len(questions)})
@@ -0,0 +1,70 @@
+import base64
+import gzip
+import json
+import time
+
+import numpy as np
+import pandas as pd
+
+from chart_encoding import encode_labels, encode_series
+
+# Chart shapes typical of the agent's answers, from a 10-bar summary to a dense yearly scatter.
+CASES = {
+    "bar, 10 regions": (10, 2),
+    "line, 1,000 points": (1_000, 3),
+    "bar, 20,000 contracts": (20_000, 2),
+    "line, 200,000 points": (200_000, 3),
+}
+REPEATS = 5
+
+def make_frame(rows: int, series: int) -> pd.DataFrame:
+    rng = np.random.default_rng(0)
+    frame = {"region": rng.choice([f"Region {i}" for i in range(17)], rows)}
+    for i in range(series):
+        frame[f"total_cost_{i}"] = rng.lognormal(17, 1.5, rows).round(2)
+    frame["project_count"] = rng.integers(0, 400, rows)
+    return pd.DataFrame(frame)
+
+def chart_payload(df: pd.DataFrame, binary: bool) -> dict:
+    return {
+        "type": "bar",
+        "data": {
+            "labels": encode_labels(df["region"], binary=binary),
+            "values": [{"data": encode_series(df[col], binary=binary), "label": col} for col in df.columns[1:]],
+        },
+    }
+
+def decode_payload(text: str):
+    """Approximates the browser's work: JSON.parse, then base64 to typed arrays."""
+    payload = json.loads(text)
+    for series in payload["data"]["values"]:
+        data = series["data"]
+        if isinstance(data, dict):
+            np.frombuffer(base64.b64decode(data["bdata"]), dtype="<" + data["dtype"])
+    labels = payload["data"]["labels"]
+    if isinstance(labels, dict):
+        codes = np.frombuffer(base64.b64decode(labels["codes"]["bdata"]), dtype="<" + labels["codes"]["dtype"])
+        np.asarray(labels["dict"], dtype=object)[codes]
+
+def best_of(fn) -> float:
+    timings = []
+    for _ in range(REPEATS):
+        start = time.perf_counter()
+        fn()
+        timings.append(time.perf_counter() - start)
+    return min(timings) * 1000
+
+def main():
+    print(f"{'case':<24}{'mode':<8}{'json KB':>10}{'gzip KB':>10}{'encode ms':>12}{'parse ms':>11}")
+    for name, (rows, series) in CASES.items():
+        df = make_frame(rows, series)
+        for mode, binary in (("lists", False), ("binary", True)):
+            text = json.dumps(chart_payload(df, binary))
+            encode_ms = best_of(lambda: json.dumps(chart_payload(df, binary)))
+            parse_ms = best_of(lambda: decode_payload(text))
+            size_kb = len(text.encode("utf-8")) / 1024
+            gzip_kb = len(gzip.compress(text.encode("utf-8"), compresslevel=6)) / 1024
+            print(f"{name:<24}{mode:<8}{size_kb:>10.1f}{gzip_kb:>10.1f}{encode_ms:>12.2f}{parse_ms:>11.2f}")
+
+if __name__ == "__main__":
+    main()
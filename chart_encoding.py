@@ -0,0 +1,55 @@
+import base64
+import os
+
+import numpy as np
+import pandas as pd
+
+# --- 1. Configuration ---
+# Emit numeric chart series as base64 typed arrays ({"bdata", "dtype"}, which Plotly >= 2.28
+# reads natively) and repeated labels as a dictionary plus codes, instead of JSON number lists.
+CHART_BINARY_ARRAYS = os.getenv("CHART_BINARY_ARRAYS", "0") == "1"
+
+# Integer dtypes Plotly's typed-array spec accepts, smallest first (it has no 64-bit integers).
+_INT_DTYPES = [np.int8, np.int16, np.int32]
+_UINT_DTYPES = [np.uint8, np.uint16, np.uint32]
+
+def _typed_array(values: np.ndarray) -> dict:
+    values = np.ascontiguousarray(values)
+    return {"bdata": base64.b64encode(values.tobytes()).decode("ascii"), "dtype": values.dtype.str.lstrip("<|")}
+
+def _smallest_int(values: np.ndarray, candidates: list):
+    low, high = (values.min(), values.max()) if len(values) else (0, 0)
+    for dtype in candidates:
+        info = np.iinfo(dtype)
+        if info.min <= low and high <= info.max:
+            return dtype
+    return None
+
+# --- 2. Encoders ---
+
+def encode_series(series: pd.Series, binary: bool = CHART_BINARY_ARRAYS):
+    """Encodes a numeric chart series as a list, or as a little-endian typed array."""
+    if not binary or not pd.api.types.is_numeric_dtype(series.dtype) or pd.api.types.is_bool_dtype(series.dtype):
+        return series.tolist()
+    values = series.to_numpy()
+    if np.issubdtype(values.dtype, np.integer):
+        dtype = _smallest_int(values, _INT_DTYPES)
+        values = values.astype(dtype if dtype is not None else np.float64)
+    else:
+        # Contract costs need full precision, so floats stay 64-bit; NaN marks gaps.
+        values = values.astype("<f8")
+    return _typed_array(values.astype(values.dtype.newbyteorder("<")))
+
+def encode_labels(series: pd.Series, binary: bool = CHART_BINARY_ARRAYS):
+    """
+    Encodes chart labels as strings. In binary mode, labels that repeat are sent once
+    in `dict` with a typed array of `codes` pointing into it.
+    """
+    labels = series.astype(str)
+    if not binary:
+        return labels.tolist()
+    codes, uniques = pd.factorize(labels)
+    if len(uniques) == len(labels):
+        return labels.tolist()
+    dtype = _smallest_int(codes, _UINT_DTYPES) or np.uint32
+    return {"dict": uniques.tolist(), "codes": _typed_array(codes.astype(dtype))}
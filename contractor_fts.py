@@ -0,0 +1,170 @@
+import logging
+import re
+import sqlite3
+
+# --- 1. FTS5 Trigram Tables ---
+# Each FTS table is an external-content index over a base table, so the text is
+# stored once and the index joins back to the base rows by rowid.
+FTS_TABLES = {
+    "flood_control_projects_contractor_fts": ("flood_control_projects", ["contractor"]),
+    "cpes_projects_constructor_fts": ("cpes_projects", ["constructor_name"]),
+    "contractor_name_mapping_fts": ("contractor_name_mapping", ["cpes_name", "canonical_name"]),
+}
+
+# The trigram tokenizer cannot match terms shorter than three characters.
+MIN_TERM_LENGTH = 3
+
+def _create_fts_table(conn: sqlite3.Connection, fts_table: str, base_table: str, columns: list):
+    """Creates an FTS5 trigram table and the triggers that keep it in sync with its base table."""
+    cols = ", ".join(columns)
+    new_cols = ", ".join(f"new.{col}" for col in columns)
+    old_cols = ", ".join(f"old.{col}" for col in columns)
+    cursor = conn.cursor()
+    cursor.execute(
+        f"CREATE VIRTUAL TABLE IF NOT EXISTS {fts_table} USING fts5("
+        f"{cols}, content='{base_table}', content_rowid='rowid', tokenize='trigram');"
+    )
+    cursor.execute(
+        f"CREATE TRIGGER IF NOT EXISTS {fts_table}_ai AFTER INSERT ON {base_table} BEGIN "
+        f"INSERT INTO {fts_table}(rowid, {cols}) VALUES (new.rowid, {new_cols}); END;"
+    )
+    cursor.execute(
+        f"CREATE TRIGGER IF NOT EXISTS {fts_table}_ad AFTER DELETE ON {base_table} BEGIN "
+        f"INSERT INTO {fts_table}({fts_table}, rowid, {cols}) VALUES ('delete', old.rowid, {old_cols}); END;"
+    )
+    cursor.execute(
+        f"CREATE TRIGGER IF NOT EXISTS {fts_table}_au AFTER UPDATE ON {base_table} BEGIN "
+        f"INSERT INTO {fts_table}({fts_table}, rowid, {cols}) VALUES ('delete', old.rowid, {old_cols}); "
+        f"INSERT INTO {fts_table}(rowid, {cols}) VALUES (new.rowid, {new_cols}); END;"
+    )
+
+def rebuild_fts_table(conn: sqlite3.Connection, fts_table: str):
+    """Repopulates an FTS table from its base table (needed after bulk loads or VACUUM)."""
+    conn.execute(f"INSERT INTO {fts_table}({fts_table}) VALUES ('rebuild');")
+
+def optimize_fts_table(conn: sqlite3.Connection, fts_table: str):
+    """Merges an FTS table's index segments, e.g. after many rows were synced by its triggers."""
+    conn.execute(f"INSERT INTO {fts_table}({fts_table}) VALUES ('optimize');")
+
+def ensure_fts_indexes(conn: sqlite3.Connection, rebuild: bool = True):
+    """Creates every contractor FTS table whose base table exists, optionally rebuilding its contents."""
+    cursor = conn.cursor()
+    for fts_table, (base_table, columns) in FTS_TABLES.items():
+        cursor.execute("SELECT name FROM sqlite_master WHERE type='table' AND name=?;", (base_table,))
+        if not cursor.fetchone():
+            print(f"  Table '{base_table}' does not exist. Skipping FTS table '{fts_table}'.")
+            continue
+        print(f"  Creating FTS5 trigram table '{fts_table}' over {base_table} ({', '.join(columns)})...")
+        _create_fts_table(conn, fts_table, base_table, columns)
+        if rebuild:
+            rebuild_fts_table(conn, fts_table)
+        print(f"  FTS table '{fts_table}' is ready.")
+
+# --- 2. Availability Check ---
+_AVAILABLE_FTS_TABLES = None
+
+def get_available_fts_tables(conn) -> set:
+    """Returns the contractor FTS tables present in the database. The result is cached per process."""
+    global _AVAILABLE_FTS_TABLES
+    if _AVAILABLE_FTS_TABLES is None:
+        try:
+            cursor = conn.cursor()
+            cursor.execute("SELECT name FROM sqlite_master WHERE type='table'")
+            names = {row[0] for row in cursor.fetchall()}
+            _AVAILABLE_FTS_TABLES = names & set(FTS_TABLES)
+        except Exception as e:
+            logging.warning(f"Could not inspect FTS tables, contractor rewrite disabled. Error: {e}")
+            _AVAILABLE_FTS_TABLES = set()
+    return _AVAILABLE_FTS_TABLES
+
+def reset_fts_cache():
+    """Forgets the cached FTS availability so it is re-read on the next query."""
+    global _AVAILABLE_FTS_TABLES
+    _AVAILABLE_FTS_TABLES = None
+
+# --- 3. LIKE Predicate Rewrite ---
+# Matches `[LOWER(][alias.]contractor[)] LIKE [LOWER(]'%term%'[)]` for the two contractor columns.
+# Terms containing wildcards or quotes are left alone so the LIKE semantics are never changed.
+_LIKE_PREDICATE = re.compile(
+    r"(?P<lfunc>\b(?:LOWER|UPPER)\s*\(\s*)?"
+    r"(?:\b(?P<qual>\w+)\.)?\b(?P<col>contractor|constructor_name)\b"
+    r"(?(lfunc)\s*\))"
+    r"\s+LIKE\s+"
+    r"(?P<rfunc>(?:LOWER|UPPER)\s*\(\s*)?"
+    r"'%(?P<term>[^%_']+)%'"
+    r"(?(rfunc)\s*\))",
+    re.IGNORECASE,
+)
+
+_COLUMN_TABLES = {
+    "contractor": "flood_control_projects",
+    "constructor_name": "cpes_projects",
+}
+
+_SQL_KEYWORDS = {
+    "WHERE", "JOIN", "INNER", "LEFT", "RIGHT", "CROSS", "OUTER", "ON", "GROUP", "ORDER",
+    "LIMIT", "UNION", "HAVING", "USING", "NATURAL", "FULL", "EXCEPT", "INTERSECT",
+}
+
+def _table_references(sql: str, table: str) -> list:
+    """Returns the name each reference to `table` is addressed by (its alias, or the table name)."""
+    refs = []
+    pattern = re.compile(rf"\b(?:FROM|JOIN)\s+{table}\b(?:\s+(?:AS\s+)?(\w+))?", re.IGNORECASE)
+    for match in pattern.finditer(sql):
+        alias = match.group(1)
+        if alias and alias.upper() not in _SQL_KEYWORDS:
+            refs.append(alias)
+        else:
+            refs.append(table)
+    return refs
+
+def _fts_match(fts_table: str, term: str) -> str:
+    phrase = '"' + term.replace('"', '""') + '"'
+    return f"SELECT rowid FROM {fts_table} WHERE {fts_table} MATCH '{phrase}'"
+
+def rewrite_contractor_predicates(sql_query: str, available_fts: set) -> str:
+    """
+    Rewrites `contractor LIKE '%name%'` style predicates into FTS5 trigram lookups.
+    The base table is joined back by rowid, and names are also resolved through
+    `contractor_name_mapping` so a match on any known variant finds the project.
+    Predicates that cannot be rewritten safely are returned unchanged.
+    """
+    if not available_fts:
+        return sql_query
+
+    def _replace(match):
+        col = match.group("col").lower()
+        qual = match.group("qual")
+        term = match.group("term").strip()
+        table = _COLUMN_TABLES[col]
+        fts_table = next(name for name, (base, _) in FTS_TABLES.items() if base == table)
+
+        if len(term) < MIN_TERM_LENGTH or fts_table not in available_fts:
+            return match.group(0)
+
+        refs = _table_references(sql_query, table)
+        if qual:
+            # The qualifier must point at the base table itself, not at a subquery or CTE.
+            if not any(ref.lower() == qual.lower() for ref in refs):
+                return match.group(0)
+            target = qual
+        elif len(refs) == 1:
+            target = refs[0]
+        else:
+            return match.group(0)
+
+        column_ref = f"{target}.{match.group('col')}"
+        predicate = f"{target}.rowid IN ({_fts_match(fts_table, term)})"
+
+        if "contractor_name_mapping_fts" in available_fts:
+            mapped_col = "canonical_name" if table == "flood_control_projects" else "cpes_name"
+            predicate += (
+                f" OR {column_ref} IN (SELECT {mapped_col} FROM contractor_name_mapping"
+                f" WHERE rowid IN ({_fts_match('contractor_name_mapping_fts', term)}))"
+            )
+        return f"({predicate})"
+
+    rewritten = _LIKE_PREDICATE.sub(_replace, sql_query)
+    if rewritten != sql_query:
+        logging.info(f"Rewrote contractor LIKE predicates to FTS5 lookups:\n{rewritten}")
+    return rewritten
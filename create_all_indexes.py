@@ -1,5 +1,7 @@
 import sqlite3
 
+from contractor_fts import ensure_fts_indexes
+
 DATABASE_PATH = 'C:\\DEV\\FLOODGPT\\db\\analytics.db'
 
 def create_index_if_not_exists(conn, table_name, columns, index_name):
@@ -60,6 +62,12 @@ def main():
         contractor_mapping_cols = ['canonical_name', 'cpes_name']
         create_index_if_not_exists(conn, 'contractor_name_mapping', contractor_mapping_cols, 'idx_contractor_name_mapping_composite')
 
+        # 4. Index for 'contractor' so FTS matches resolved through the name mapping stay index-driven
+        create_index_if_not_exists(conn, 'flood_control_projects', ['contractor'], 'idx_flood_control_projects_contractor')
+
+        # 5. FTS5 trigram tables over contractor names (kept in sync by triggers)
+        ensure_fts_indexes(conn)
+
         conn.commit()
         print("All specified index creation processes completed.")
 
@@ -0,0 +1,67 @@
+import asyncio
+import logging
+import os
+import sqlite3
+
+import metrics
+
+# --- 1. Configuration ---
+# How often (seconds) serving processes check whether an ingest changed the data.
+DATA_VERSION_POLL_SECONDS = float(os.getenv("DATA_VERSION_POLL_SECONDS", "5"))
+
+# The stamp is SQLite's `user_version` header field, so bumping it commits atomically
+# with the data and reading it costs one page read.
+
+def read_version(db_path: str) -> int:
+    conn = sqlite3.connect(f"file:{db_path}?mode=ro", uri=True)
+    try:
+        return conn.execute("PRAGMA user_version").fetchone()[0]
+    finally:
+        conn.close()
+
+def bump_version(conn: sqlite3.Connection) -> int:
+    """Increments the data-version stamp on an open read-write connection and returns the new value."""
+    version = conn.execute("PRAGMA user_version").fetchone()[0] + 1
+    conn.execute(f"PRAGMA user_version = {int(version)}")
+    conn.commit()
+    return version
+
+# --- 2. Watcher ---
+class DataVersionWatcher:
+    """
+    Polls the data-version stamp and calls every registered callback when it changes,
+    so caches derived from the data are dropped without restarting the process.
+    """
+    def __init__(self, db_path: str, interval: float = DATA_VERSION_POLL_SECONDS):
+        self.db_path = db_path
+        self.interval = interval
+        self.version = None
+        self._callbacks = []
+
+    def on_change(self, callback):
+        self._callbacks.append(callback)
+
+    def check(self) -> bool:
+        try:
+            version = read_version(self.db_path)
+        except sqlite3.Error as e:
+            logging.warning(f"Could not read the data version: {e}")
+            return False
+        if self.version is None or version == self.version:
+            self.version = version
+            return False
+        logging.info(f"Data version changed from {self.version} to {version}; invalidating caches.")
+        self.version = version
+        metrics.increment("data_version.changes")
+        for callback in self._callbacks:
+            try:
+                callback()
+            except Exception as e:
+                logging.error(f"Cache invalidation callback {getattr(callback, '__name__', callback)} failed: {e}")
+        return True
+
+    async def run(self):
+        """Checks the stamp every `interval` seconds, off the event loop."""
+        while True:
+            await asyncio.to_thread(self.check)
+            await asyncio.sleep(self.interval)
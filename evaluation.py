@@ -1,3 +1,10 @@
+import argparse
+import hashlib
+import json
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
 import pandas as pd
 from datasets import Dataset
 import logging
@@ -10,148 +17,250 @@ logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(levelname)s - %(
 from main_agent import db
 from tools import generate_sql_query, execute_sql_query, generate_insight_from_data, validate_and_correct_sql
 
-# --- 1. Golden Dataset ---
-# Load the golden dataset from a CSV file.
-try:
-    golden_dataset_df = pd.read_csv("golden_dataset.csv")
-    golden_dataset_data = golden_dataset_df.to_dict(orient="records")
-except FileNotFoundError:
-    logging.error("golden_dataset.csv not found. Please create it and ensure it has 'question', 'golden_sql', and 'ground_truth_answer' columns.")
-    exit()
+# --- Configuration ---
+ARTIFACT_DIR = os.getenv("EVAL_ARTIFACT_DIR", "eval_artifacts")
+MAX_WORKERS = int(os.getenv("EVAL_MAX_WORKERS", "8"))
 
-# --- 2. SQL Generation and Execution Evaluation ---
+# --- 1. Per-Question Artifacts ---
+# Each question gets one JSON file holding everything later stages (and reruns) need:
+# the generated SQL, the normalized result hashes, the result context and the insight.
 
-logging.info("--- Starting SQL Evaluation ---")
+def _artifact_path(artifact_dir: str, question: str) -> str:
+    key = hashlib.sha256(question.strip().encode("utf-8")).hexdigest()[:16]
+    return os.path.join(artifact_dir, f"{key}.json")
 
-results = []
-db_schema = db.get_table_info()
+def load_artifact(artifact_dir: str, question: str) -> dict:
+    path = _artifact_path(artifact_dir, question)
+    if not os.path.exists(path):
+        return {}
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, json.JSONDecodeError) as e:
+        logging.warning(f"Ignoring unreadable artifact {path}: {e}")
+        return {}
 
-for item in golden_dataset_data:
-    question = item['question']
-    golden_sql = item['golden_sql']
-    
-    # --- Agent Simulation ---
-    # 1. Generate SQL
-    generated_sql_raw = generate_sql_query(question, db_schema)
-    
-    # 2. Validate SQL
+def save_artifact(artifact_dir: str, question: str, artifact: dict):
+    path = _artifact_path(artifact_dir, question)
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(artifact, f, indent=2, default=str)
+    # Atomic replace so an interrupted run never leaves a half-written artifact behind.
+    os.replace(tmp_path, path)
+
+# --- 2. Order-Insensitive Result Hashing ---
+
+def _normalize_column(series: pd.Series) -> pd.Series:
+    """Renders a column as comparable strings: numbers as rounded floats, NULLs as a marker."""
+    non_null = series.notna()
+    numeric = pd.to_numeric(series, errors="coerce")
+    if non_null.any() and numeric[non_null].notna().all():
+        rendered = numeric.astype("float64").round(6).map(lambda x: f"{x:.6f}")
+    else:
+        rendered = series.astype(str)
+    return rendered.where(non_null, "<NULL>")
+
+def result_hash(df: pd.DataFrame) -> str:
+    """
+    Hashes a query result so that row order, column order, column names and
+    dtype differences (e.g. int 5 vs float 5.0) do not affect the comparison.
+    """
+    if df is None or df.empty:
+        return hashlib.sha256(b"<EMPTY>").hexdigest()
+
+    columns = [_normalize_column(df.iloc[:, i]).reset_index(drop=True) for i in range(df.shape[1])]
+    # Order columns by their own sorted contents so positional differences do not matter.
+    columns.sort(key=lambda col: hashlib.sha256("\x1f".join(sorted(col)).encode("utf-8")).hexdigest())
+
+    rows = columns[0].str.cat(columns[1:], sep="\x1f") if len(columns) > 1 else columns[0]
+    payload = "\x1e".join(sorted(rows.tolist()))
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+# --- 3. Per-Question Pipeline ---
+
+def _generate_validated_sql(question: str, db_schema: str) -> dict:
+    # Never retrieve the golden answer itself as a few-shot example.
+    generated_sql_raw = generate_sql_query(question, db_schema, exclude_exact=True)
     validation_result = validate_and_correct_sql(generated_sql_raw, db_schema)
     if validation_result.get("valid"):
         generated_sql = generated_sql_raw
     else:
         generated_sql = validation_result.get("corrected_query", generated_sql_raw)
+    return {
+        "raw_sql": generated_sql_raw,
+        "generated_sql": generated_sql,
+        "sql_corrected": not validation_result.get("valid"),
+    }
 
-    # --- Comparison ---
-    exact_match = (generated_sql == golden_sql)
-    
-    # --- Execution Accuracy ---
-    try:
-        # Execute generated SQL
-        generated_result = execute_sql_query(generated_sql)
-        if "error" in generated_result:
-            raise Exception(generated_result["error"])
-        generated_result_df = generated_result["sql_dataframe"]
+def evaluate_question(item: dict, db_schema: str, artifact_dir: str, refresh: set) -> dict:
+    """Runs (or reuses) every stage for one golden question and persists the artifact."""
+    question = item['question']
+    golden_sql = item['golden_sql']
+    artifact = load_artifact(artifact_dir, question)
 
-        # Execute golden SQL
+    # --- Stage 1: SQL generation (LLM) ---
+    if "sql" in refresh or "generated_sql" not in artifact:
+        artifact.update(_generate_validated_sql(question, db_schema))
+        artifact.pop("result_hash", None)
+        artifact.pop("insight", None)
+    generated_sql = artifact["generated_sql"]
+
+    # --- Stage 2: Execution (database only, cheap) ---
+    generated_df = None
+    if "result_hash" not in artifact or artifact.get("golden_sql") != golden_sql:
+        generated_result = execute_sql_query(generated_sql)
         golden_result = execute_sql_query(golden_sql)
-        if "error" in golden_result:
-            raise Exception(f"Error in golden SQL: {golden_result['error']}")
-        golden_result_df = golden_result["sql_dataframe"]
-        
-        # Compare results
-        execution_accuracy = generated_result_df.equals(golden_result_df)
+        artifact["execution_error"] = generated_result.get("error")
+        artifact["golden_error"] = golden_result.get("error")
+        if "error" not in generated_result:
+            generated_df = generated_result["sql_dataframe"]
+        artifact["result_hash"] = result_hash(generated_df) if generated_df is not None else None
+        artifact["golden_hash"] = result_hash(golden_result["sql_dataframe"]) if "error" not in golden_result else None
+        artifact["context"] = generated_df.to_string() if generated_df is not None else None
+        artifact.pop("insight", None)
 
-    except Exception as e:
-        logging.error(f"Error executing SQL for question: '{question}'. Error: {e}")
-        execution_accuracy = False
-
-    results.append({
-        'question': question,
-        'golden_sql': golden_sql,
-        'generated_sql': generated_sql,
-        'exact_match': exact_match,
-        'execution_accuracy': execution_accuracy
-    })
-
-# --- Print SQL Evaluation Report ---
-sql_eval_df = pd.DataFrame(results)
-print("\n--- SQL Generation Evaluation Report ---")
-print(sql_eval_df.to_string())
-
-exact_match_rate = sql_eval_df['exact_match'].mean()
-execution_accuracy_rate = sql_eval_df['execution_accuracy'].mean()
-
-print(f"\nExact Match Rate: {exact_match_rate:.2f}")
-print(f"Execution Accuracy Rate: {execution_accuracy_rate:.2f}")
-
-
-# --- 3. Insight Evaluation with RAGAS ---
-
-logging.info("--- Starting Insight Evaluation with RAGAS ---")
-
-try:
-    from ragas import evaluate
-    from ragas.metrics import (
-        faithfulness,
-        answer_relevancy,
-        answer_correctness,
-    )
-    from llm_config import get_llm
-
-    # Configure the LLM for RAGAS - replace with your desired model
-    ragas_llm = get_llm(model_name="gemini-1.5-flash", temperature=0)
-
-
-    # --- Generate Agent Outputs ---
-    evaluation_data = []
-    for item in golden_dataset_data:
-        question = item['question']
-        ground_truth = item['ground_truth_answer']
-        
-        # Simulate running the agent to get the context (dataframe) and answer (insight)
-        sql_query = generate_sql_query(question, db_schema)
-        validation_result = validate_and_correct_sql(sql_query, db_schema)
-        validated_sql = validation_result.get("corrected_query", sql_query) if not validation_result.get("valid") else sql_query
-
-        result = execute_sql_query(validated_sql)
-        if "error" in result:
-            logging.warning(f"Skipping RAGAS for question '{question}' due to SQL execution error.")
-            continue
-            
-        context_df = result["sql_dataframe"]
-        answer = generate_insight_from_data(question, context_df)
-        
-        evaluation_data.append({
-            'question': question,
-            'answer': answer,
-            'contexts': [context_df.to_string()], # RAGAS expects contexts as a list of strings
-            'ground_truth': ground_truth
+    # --- Stage 3: Insight generation (LLM) ---
+    if artifact.get("execution_error") is None and ("insight" in refresh or "insight" not in artifact):
+        if generated_df is None:
+            generated_df = execute_sql_query(generated_sql).get("sql_dataframe")
+        artifact["insight"] = generate_insight_from_data(question, generated_df)
+
+    artifact["question"] = question
+    artifact["golden_sql"] = golden_sql
+    artifact["ground_truth"] = item.get("ground_truth_answer")
+    save_artifact(artifact_dir, question, artifact)
+    return artifact
+
+def run_evaluation(golden_dataset_data: list, artifact_dir: str, max_workers: int, refresh: set) -> list:
+    """Evaluates all golden questions on a bounded worker pool (the LLM calls dominate the runtime)."""
+    os.makedirs(artifact_dir, exist_ok=True)
+    db_schema = db.get_table_info()
+    artifacts = [None] * len(golden_dataset_data)
+
+    with ThreadPoolExecutor(max_workers=max_workers) as pool:
+        futures = {
+            pool.submit(evaluate_question, item, db_schema, artifact_dir, refresh): i
+            for i, item in enumerate(golden_dataset_data)
+        }
+        for done, future in enumerate(as_completed(futures), start=1):
+            i = futures[future]
+            try:
+                artifacts[i] = future.result()
+            except Exception as e:
+                logging.error(f"Evaluation failed for question: '{golden_dataset_data[i]['question']}'. Error: {e}")
+                artifacts[i] = {"question": golden_dataset_data[i]["question"], "golden_sql": golden_dataset_data[i]["golden_sql"], "failed": str(e)}
+            logging.info(f"Evaluated {done}/{len(futures)} questions.")
+    return artifacts
+
+# --- 4. Reports ---
+
+def print_sql_report(artifacts: list):
+    results = []
+    for artifact in artifacts:
+        generated_sql = artifact.get("generated_sql")
+        results.append({
+            'question': artifact['question'],
+            'golden_sql': artifact['golden_sql'],
+            'generated_sql': generated_sql,
+            'exact_match': generated_sql == artifact['golden_sql'],
+            'execution_accuracy': artifact.get("result_hash") is not None and artifact.get("result_hash") == artifact.get("golden_hash"),
         })
 
-    if evaluation_data:
-        # --- Create Hugging Face Dataset for RAGAS ---
-        ragas_dataset = Dataset.from_list(evaluation_data)
-
-        # --- Run RAGAS Evaluation ---
-        result = evaluate(
-            ragas_dataset,
-            metrics=[
-                faithfulness,
-                answer_relevancy,
-                answer_correctness,
-            ],
-            llm=ragas_llm,
+    sql_eval_df = pd.DataFrame(results)
+    print("\n--- SQL Generation Evaluation Report ---")
+    print(sql_eval_df.to_string())
+
+    exact_match_rate = sql_eval_df['exact_match'].mean()
+    execution_accuracy_rate = sql_eval_df['execution_accuracy'].mean()
+
+    print(f"\nExact Match Rate: {exact_match_rate:.2f}")
+    print(f"Execution Accuracy Rate: {execution_accuracy_rate:.2f}")
+
+def run_ragas(artifacts: list):
+    """Scores the persisted insights with RAGAS; no SQL or insight is regenerated here."""
+    logging.info("--- Starting Insight Evaluation with RAGAS ---")
+
+    try:
+        from ragas import evaluate
+        from ragas.metrics import (
+            faithfulness,
+            answer_relevancy,
+            answer_correctness,
         )
+        from llm_config import get_llm
 
-        # --- Print RAGAS Evaluation Report ---
-        ragas_df = result.to_pandas()
-        print("\n--- RAGAS Insight Evaluation Report ---")
-        print(ragas_df.to_string())
-    else:
-        print("\nNo data to evaluate with RAGAS.")
+        # Configure the LLM for RAGAS - replace with your desired model
+        ragas_llm = get_llm(model_name="gemini-1.5-flash", temperature=0)
+
+        evaluation_data = []
+        for artifact in artifacts:
+            if not artifact.get("insight") or artifact.get("context") is None:
+                logging.warning(f"Skipping RAGAS for question '{artifact['question']}' due to SQL execution error.")
+                continue
+            evaluation_data.append({
+                'question': artifact['question'],
+                'answer': artifact['insight'],
+                'contexts': [artifact['context']], # RAGAS expects contexts as a list of strings
+                'ground_truth': artifact['ground_truth']
+            })
+
+        if evaluation_data:
+            # --- Create Hugging Face Dataset for RAGAS ---
+            ragas_dataset = Dataset.from_list(evaluation_data)
+
+            # --- Run RAGAS Evaluation ---
+            result = evaluate(
+                ragas_dataset,
+                metrics=[
+                    faithfulness,
+                    answer_relevancy,
+                    answer_correctness,
+                ],
+                llm=ragas_llm,
+            )
+
+            # --- Print RAGAS Evaluation Report ---
+            ragas_df = result.to_pandas()
+            print("\n--- RAGAS Insight Evaluation Report ---")
+            print(ragas_df.to_string())
+        else:
+            print("\nNo data to evaluate with RAGAS.")
+
+    except ImportError:
+        logging.warning("RAGAS not installed. Skipping insight evaluation.")
+        print("\nPlease install RAGAS to run the insight evaluation: pip install ragas")
+    except Exception as e:
+        logging.error(f"An error occurred during RAGAS evaluation: {e}")
+
+# --- 5. Main Execution Block ---
+def main():
+    parser = argparse.ArgumentParser(description="Evaluate the FloodGPT agent against the golden dataset.")
+    parser.add_argument("--dataset", default="golden_dataset.csv", help="Path to the golden dataset CSV.")
+    parser.add_argument("--artifacts", default=ARTIFACT_DIR, help="Directory for per-question artifacts.")
+    parser.add_argument("--workers", type=int, default=MAX_WORKERS, help="Maximum concurrent questions (LLM calls).")
+    parser.add_argument("--refresh", choices=["sql", "insight", "all"], action="append", default=[],
+                        help="Regenerate a stage instead of reusing its cached artifact.")
+    parser.add_argument("--skip-ragas", action="store_true", help="Skip the RAGAS insight evaluation.")
+    args = parser.parse_args()
+
+    # --- Golden Dataset ---
+    try:
+        golden_dataset_df = pd.read_csv(args.dataset)
+        golden_dataset_data = golden_dataset_df.to_dict(orient="records")
+    except FileNotFoundError:
+        logging.error("golden_dataset.csv not found. Please create it and ensure it has 'question', 'golden_sql', and 'ground_truth_answer' columns.")
+        exit()
+
+    refresh = {"sql", "insight"} if "all" in args.refresh else set(args.refresh)
+
+    logging.info("--- Starting SQL Evaluation ---")
+    started = time.perf_counter()
+    artifacts = run_evaluation(golden_dataset_data, args.artifacts, args.workers, refresh)
+    logging.info(f"Evaluated {len(artifacts)} questions in {time.perf_counter() - started:.1f}s with {args.workers} workers.")
+
+    print_sql_report(artifacts)
+    if not args.skip_ragas:
+        run_ragas(artifacts)
 
-except ImportError:
-    logging.warning("RAGAS not installed. Skipping insight evaluation.")
-    print("\nPlease install RAGAS to run the insight evaluation: pip install ragas")
-except Exception as e:
-    logging.error(f"An error occurred during RAGAS evaluation: {e}")
\ No newline at end of file
+if __name__ == "__main__":
+    main()
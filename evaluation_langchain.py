@@ -52,7 +52,7 @@ def agent_pipeline(inputs: dict):
     db_schema = db.get_table_info()
 
     # 1. Generate and Validate SQL
-    generated_sql_raw = generate_sql_query(question, db_schema)
+    generated_sql_raw = generate_sql_query(question, db_schema, exclude_exact=True)
     validation_result = validate_and_correct_sql(generated_sql_raw, db_schema)
     validated_sql = validation_result.get("corrected_query", generated_sql_raw) if not validation_result.get("valid") else generated_sql_raw
 
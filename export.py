@@ -0,0 +1,128 @@
+import csv
+import io
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+import uuid
+import zlib
+from collections import OrderedDict
+
+from contractor_fts import get_available_fts_tables, rewrite_contractor_predicates
+
+# --- 1. Configuration ---
+# Rows fetched from the cursor (and encoded) per chunk; memory stays bounded by this, not the result size.
+EXPORT_CHUNK_ROWS = int(os.getenv("EXPORT_CHUNK_ROWS", "2000"))
+# How long (seconds) an answer's export link stays valid.
+EXPORT_TTL = float(os.getenv("EXPORT_TTL", "3600"))
+EXPORT_MAX_ENTRIES = int(os.getenv("EXPORT_MAX_ENTRIES", "1000"))
+
+EXPORT_FORMATS = {
+    "csv": "text/csv; charset=utf-8",
+    "ndjson": "application/x-ndjson",
+}
+
+# --- 2. Export Registry ---
+class ExportRegistry:
+    """
+    Maps export IDs to SQL that already passed validation and executed successfully.
+    Clients only ever refer to an ID, so the export endpoint never runs client-supplied SQL.
+    """
+    def __init__(self, ttl: float = EXPORT_TTL, max_entries: int = EXPORT_MAX_ENTRIES):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+
+    def register(self, sql: str) -> str:
+        export_id = uuid.uuid4().hex
+        with self._lock:
+            self._entries[export_id] = (sql, time.monotonic())
+            now = time.monotonic()
+            while self._entries and (
+                len(self._entries) > self.max_entries or next(iter(self._entries.values()))[1] + self.ttl < now
+            ):
+                self._entries.popitem(last=False)
+        return export_id
+
+    def get(self, export_id: str) -> str | None:
+        with self._lock:
+            entry = self._entries.get(export_id)
+        if entry is None or entry[1] + self.ttl < time.monotonic():
+            return None
+        return entry[0]
+
+export_registry = ExportRegistry()
+
+# --- 3. Streaming Rows ---
+
+def open_cursor(db_path: str, sql: str) -> sqlite3.Cursor:
+    """
+    Executes `sql` on a dedicated read-only connection and returns the live cursor.
+    Rows are then pulled in chunks, so no DataFrame (or full row list) is ever built.
+    """
+    # check_same_thread=False: Starlette pulls each chunk of a sync stream on a worker thread.
+    conn = sqlite3.connect(f"file:{db_path}?mode=ro", uri=True, check_same_thread=False)
+    rewritten = rewrite_contractor_predicates(sql, get_available_fts_tables(conn)) if "LIKE" in sql.upper() else sql
+    try:
+        return conn.execute(rewritten)
+    except sqlite3.Error as e:
+        if rewritten == sql:
+            conn.close()
+            raise
+        logging.warning(f"FTS-rewritten export query failed, running the original query. Error: {e}")
+        try:
+            return conn.execute(sql)
+        except sqlite3.Error:
+            conn.close()
+            raise
+
+def _iter_chunks(cursor: sqlite3.Cursor):
+    try:
+        while True:
+            rows = cursor.fetchmany(EXPORT_CHUNK_ROWS)
+            if not rows:
+                return
+            yield rows
+    finally:
+        cursor.connection.close()
+
+def _csv_cell(value):
+    # Neutralize spreadsheet formulas (CSV injection) in text cells.
+    if isinstance(value, str) and value[:1] in ("=", "+", "-", "@"):
+        return "'" + value
+    return value
+
+def csv_chunks(cursor: sqlite3.Cursor):
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow([column[0] for column in cursor.description])
+    for rows in _iter_chunks(cursor):
+        writer.writerows([_csv_cell(v) for v in row] for row in rows)
+        yield buffer.getvalue().encode("utf-8")
+        buffer.seek(0)
+        buffer.truncate()
+    # Header only, for results without rows.
+    if buffer.tell():
+        yield buffer.getvalue().encode("utf-8")
+
+def ndjson_chunks(cursor: sqlite3.Cursor):
+    columns = [column[0] for column in cursor.description]
+    for rows in _iter_chunks(cursor):
+        yield "".join(json.dumps(dict(zip(columns, row))) + "\n" for row in rows).encode("utf-8")
+
+def gzip_chunks(chunks):
+    """Compresses a byte stream on the fly into a single gzip member."""
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 31)
+    for chunk in chunks:
+        compressed = compressor.compress(chunk)
+        if compressed:
+            yield compressed
+    yield compressor.flush()
+
+def export_stream(db_path: str, sql: str, export_format: str, gzip: bool):
+    cursor = open_cursor(db_path, sql)
+    chunks = csv_chunks(cursor) if export_format == "csv" else ndjson_chunks(cursor)
+    return gzip_chunks(chunks) if gzip else chunks
@@ -0,0 +1,222 @@
+import csv
+import hashlib
+import heapq
+import json
+import logging
+import math
+import os
+import re
+import threading
+import time
+from collections import Counter
+
+from singleflight import normalize_question
+
+# --- 1. Configuration ---
+# Number of similar question/SQL pairs injected into the SQL generation prompt (0 disables).
+FEWSHOT_K = int(os.getenv("FEWSHOT_K", "3"))
+# Fraction of questions (0-1) kept on the zero-shot prompt, to compare both variants in /metrics.
+FEWSHOT_HOLDOUT = float(os.getenv("FEWSHOT_HOLDOUT", "0.1"))
+FEWSHOT_GOLDEN_PATH = os.getenv("FEWSHOT_GOLDEN_PATH", "golden_dataset.csv")
+# Log of question/SQL pairs that passed validation unchanged and returned rows in production.
+FEWSHOT_LOG_PATH = os.getenv("FEWSHOT_LOG_PATH", "db/verified_sql.jsonl")
+# Logged pairs kept; once the log holds twice as many lines it is compacted to the newest ones.
+FEWSHOT_LOG_MAX_ENTRIES = int(os.getenv("FEWSHOT_LOG_MAX_ENTRIES", "2000"))
+
+# Words that carry no signal for matching questions about projects.
+STOPWORDS = {
+    "a", "an", "and", "are", "as", "at", "be", "by", "for", "from", "how", "in", "is", "it", "me",
+    "of", "on", "or", "show", "the", "to", "what", "which", "who", "with", "list", "give", "all",
+}
+
+def tokenize(text: str) -> list:
+    return [t for t in re.findall(r"[a-z0-9]+", text.lower()) if len(t) > 1 and t not in STOPWORDS]
+
+# --- 2. BM25 Index ---
+class BM25Index:
+    """
+    An incremental BM25 index over example questions.
+    Adding a pair only updates the postings of its own terms; IDF and length
+    normalization are computed at query time, so nothing is ever rebuilt wholesale.
+    Re-adding a question replaces its previous SQL, except that a golden pair is never
+    replaced by a logged one.
+    """
+    def __init__(self, k1: float = 1.5, b: float = 0.75):
+        self.k1 = k1
+        self.b = b
+        self._lock = threading.Lock()
+        self._docs = {}
+        self._keys = {}
+        self._postings = {}
+        self._lengths = {}
+        self._total_length = 0
+        self._next_id = 0
+
+    def __len__(self):
+        return len(self._docs)
+
+    def __contains__(self, question: str) -> bool:
+        return normalize_question(question) in self._keys
+
+    def _remove(self, doc_id: int):
+        for term in self._docs[doc_id]["terms"]:
+            postings = self._postings[term]
+            del postings[doc_id]
+            if not postings:
+                del self._postings[term]
+        self._total_length -= self._lengths.pop(doc_id)
+        del self._docs[doc_id]
+
+    def add(self, question: str, sql: str, source: str = "verified") -> bool:
+        """Indexes a pair and returns whether it was added."""
+        key = normalize_question(question)
+        terms = Counter(tokenize(question))
+        if not terms:
+            return False
+        with self._lock:
+            if key in self._keys:
+                if source != "golden" and self._docs[self._keys[key]]["source"] == "golden":
+                    return False
+                self._remove(self._keys[key])
+            doc_id = self._next_id
+            self._next_id += 1
+            self._keys[key] = doc_id
+            self._docs[doc_id] = {"question": question, "sql": sql, "source": source, "key": key, "terms": terms}
+            for term, tf in terms.items():
+                self._postings.setdefault(term, {})[doc_id] = tf
+            length = sum(terms.values())
+            self._lengths[doc_id] = length
+            self._total_length += length
+        return True
+
+    def search(self, question: str, k: int, exclude_exact: bool = False) -> list:
+        """Returns up to `k` pairs ranked by BM25 score; `exclude_exact` skips the question itself."""
+        key = normalize_question(question)
+        with self._lock:
+            if not self._docs:
+                return []
+            n_docs = len(self._docs)
+            avg_length = self._total_length / n_docs
+            scores = {}
+            for term in set(tokenize(question)):
+                postings = self._postings.get(term)
+                if not postings:
+                    continue
+                idf = math.log(1 + (n_docs - len(postings) + 0.5) / (len(postings) + 0.5))
+                for doc_id, tf in postings.items():
+                    norm = tf + self.k1 * (1 - self.b + self.b * self._lengths[doc_id] / avg_length)
+                    scores[doc_id] = scores.get(doc_id, 0.0) + idf * tf * (self.k1 + 1) / norm
+            if exclude_exact and key in self._keys:
+                scores.pop(self._keys[key], None)
+            best = heapq.nlargest(k, scores.items(), key=lambda item: item[1])
+            return [
+                {"question": self._docs[d]["question"], "sql": self._docs[d]["sql"], "source": self._docs[d]["source"], "score": s}
+                for d, s in best
+            ]
+
+# --- 3. Example Store ---
+_INDEX = None
+_INDEX_LOCK = threading.Lock()
+_LOG_LOCK = threading.Lock()
+
+def _read_log() -> list:
+    if not os.path.exists(FEWSHOT_LOG_PATH):
+        return []
+    entries = []
+    with open(FEWSHOT_LOG_PATH, encoding="utf-8") as f:
+        for line in f:
+            try:
+                entries.append(json.loads(line))
+            except json.JSONDecodeError:
+                # A partially written last line from a crash; skip it.
+                continue
+    return entries
+
+def build_index() -> BM25Index:
+    """Indexes the golden dataset plus the logged verified pairs (golden pairs always win)."""
+    started = time.perf_counter()
+    index = BM25Index()
+    if os.path.exists(FEWSHOT_GOLDEN_PATH):
+        with open(FEWSHOT_GOLDEN_PATH, newline="", encoding="utf-8") as f:
+            for row in csv.DictReader(f):
+                if row.get("question") and row.get("golden_sql"):
+                    index.add(row["question"], row["golden_sql"], source="golden")
+    for entry in _read_log():
+        index.add(entry["question"], entry["sql"])
+    logging.info(f"Built few-shot index with {len(index)} examples in {1000 * (time.perf_counter() - started):.1f} ms.")
+    return index
+
+def get_index() -> BM25Index:
+    global _INDEX
+    with _INDEX_LOCK:
+        if _INDEX is None:
+            _INDEX = build_index()
+        return _INDEX
+
+def reset_index():
+    """Drops the in-memory index so the next lookup rebuilds it from the files."""
+    global _INDEX
+    with _INDEX_LOCK:
+        _INDEX = None
+
+_log_lines = None
+
+def _compact_log():
+    """Rewrites the log with the newest FEWSHOT_LOG_MAX_ENTRIES distinct questions."""
+    global _log_lines
+    latest = {}
+    for entry in _read_log():
+        key = normalize_question(entry["question"])
+        latest.pop(key, None)
+        latest[key] = entry
+    kept = list(latest.values())[-FEWSHOT_LOG_MAX_ENTRIES:]
+    temporary = f"{FEWSHOT_LOG_PATH}.tmp"
+    with open(temporary, "w", encoding="utf-8") as f:
+        f.writelines(json.dumps(entry) + "\n" for entry in kept)
+    os.replace(temporary, FEWSHOT_LOG_PATH)
+    _log_lines = len(kept)
+    logging.info(f"Compacted the few-shot log to {len(kept)} examples.")
+    # Pairs dropped from the log leave the index on its next rebuild.
+    reset_index()
+
+def record_verified(question: str, sql: str):
+    """
+    Logs a question/SQL pair that passed validation unchanged and returned rows, and adds it
+    to the live index. Questions already indexed (golden or logged) are not logged again.
+    """
+    global _log_lines
+    if question in get_index():
+        return
+    entry = json.dumps({"question": question, "sql": sql, "ts": time.time()})
+    with _LOG_LOCK:
+        if _log_lines is None:
+            _log_lines = len(_read_log())
+        os.makedirs(os.path.dirname(FEWSHOT_LOG_PATH) or ".", exist_ok=True)
+        with open(FEWSHOT_LOG_PATH, "a", encoding="utf-8") as f:
+            f.write(entry + "\n")
+        _log_lines += 1
+        get_index().add(question, sql)
+        if _log_lines >= 2 * FEWSHOT_LOG_MAX_ENTRIES:
+            _compact_log()
+
+# --- 4. Prompt Variants ---
+
+def choose_variant(question: str) -> str:
+    """Deterministically assigns a question to 'few_shot' or the 'zero_shot' holdout."""
+    if FEWSHOT_K <= 0:
+        return "zero_shot"
+    bucket = int(hashlib.sha1(normalize_question(question).encode("utf-8")).hexdigest()[:8], 16) / 0xFFFFFFFF
+    return "zero_shot" if bucket < FEWSHOT_HOLDOUT else "few_shot"
+
+def format_examples(examples: list) -> str:
+    if not examples:
+        return ""
+    pairs = "\n\n".join(f"Question: {e['question']}\nSQL: {e['sql']}" for e in examples)
+    return f"Here are verified examples of similar questions and their SQL:\n---\n{pairs}\n---\n"
+
+def examples_for(question: str, exclude_exact: bool = False) -> tuple[str, str]:
+    """Returns (variant, examples block) for the SQL generation prompt."""
+    variant = choose_variant(question)
+    if variant == "zero_shot":
+        return variant, ""
+    return variant, format_examples(get_index().search(question, FEWSHOT_K, exclude_exact=exclude_exact))
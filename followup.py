@@ -0,0 +1,202 @@
+import json
+import logging
+import os
+import re
+
+import pandas as pd
+from langchain_core.prompts import ChatPromptTemplate
+from langchain_core.output_parsers import StrOutputParser
+
+from llm_config import get_llm
+from llm_governor import governor
+
+# --- 1. Follow-up Classification ---
+# One small LLM call decides how a follow-up relates to the previous result:
+#   "local" - a filter / sort / limit over the cached result, applied with pandas
+#   "sql"   - needs columns the result lacks, so the previous SQL is narrowed or extended
+#   "new"   - an unrelated question that goes through the full pipeline
+
+LOCAL_OPERATORS = ("==", "!=", ">", ">=", "<", "<=", "contains")
+
+# Questions of at most this many words that contain a refinement word are sent to the classifier.
+FOLLOWUP_MAX_WORDS = int(os.getenv("FOLLOWUP_MAX_WORDS", "12"))
+# Questions this short ("2023?", "in Region IV") only make sense against the previous result.
+FOLLOWUP_FRAGMENT_WORDS = 3
+# Words that refer back to the previous result or narrow, reorder or cut it.
+REFINEMENT_WORDS = {
+    "these", "those", "them", "same", "above", "previous", "result", "results", "about",
+    "only", "just", "instead", "but", "except", "excluding", "without", "among",
+    "filter", "sort", "sorted", "order", "top", "bottom", "first", "last", "limit",
+    "highest", "lowest", "largest", "smallest", "ascending", "descending",
+}
+
+def _words(text: str) -> list:
+    return re.findall(r"[a-z0-9]+", text.lower())
+
+def might_refine(question: str, df: pd.DataFrame) -> bool:
+    """
+    A cheap check run before `classify_followup`: does the question name a column of the
+    previous result, or is it a short question with a refinement word ("only those in 2023",
+    "sort by cost", "2023?")? Anything else is treated as a new question without an LLM call.
+    """
+    words = _words(question)
+    text = f" {' '.join(words)} "
+    for column in df.columns:
+        column_words = _words(str(column))
+        if column_words and f" {' '.join(column_words)} " in text:
+            return True
+    if len(words) <= FOLLOWUP_FRAGMENT_WORDS:
+        return True
+    return len(words) <= FOLLOWUP_MAX_WORDS and not REFINEMENT_WORDS.isdisjoint(words)
+
+def followup_chain():
+    """Builds the governed chain that classifies and translates a follow-up question."""
+    prompt = ChatPromptTemplate.from_template(
+        """You help a data assistant answer follow-up questions without starting over.
+
+        The previous question was:
+        "{previous_question}"
+
+        It was answered with this SQLite query:
+        {previous_sql}
+
+        The result has {row_count} rows with these columns (name: type):
+        {columns}
+
+        First rows of the result:
+        {sample}
+
+        The user's follow-up is:
+        "{question}"
+
+        Decide how to answer the follow-up and respond ONLY with JSON in this structure:
+        {{
+            "mode": "local" | "sql" | "new",
+            "standalone_question": string,
+            "operations": [
+                {{"op": "filter", "column": string, "operator": "==" | "!=" | ">" | ">=" | "<" | "<=" | "contains", "value": string or number}},
+                {{"op": "sort", "column": string, "ascending": boolean}},
+                {{"op": "limit", "n": integer}}
+            ],
+            "sql": string or null
+        }}
+
+        Rules:
+        - "standalone_question" restates the follow-up as a complete question that makes sense on its own.
+        - Use "local" when the follow-up only filters, sorts or limits the rows above using the listed columns. List the operations in order.
+        - Use "sql" when the follow-up refines the previous question but needs columns or rows the result does not have. Put a single SELECT query in "sql" that minimally edits the previous query (for example by adding a WHERE condition or changing ORDER BY / LIMIT).
+        - Use "new" when the follow-up is a different question. Leave "operations" empty and "sql" null.
+        """
+    )
+
+    llm = get_llm(model_name="gemini-2.5-flash", temperature=0)
+    return governor.wrap("followup", prompt | llm | StrOutputParser(), hedge=True)
+
+def classify_followup(question: str, context: dict, df: pd.DataFrame) -> dict:
+    """Classifies a follow-up against the session's previous result `df`; falls back to mode 'new'."""
+    logging.info("Classifying follow-up question...")
+    response_str = followup_chain().invoke({
+        "previous_question": context["question"],
+        "previous_sql": context["validated_sql"],
+        "row_count": len(df),
+        "columns": "\n".join(f"{col}: {dtype}" for col, dtype in df.dtypes.astype(str).items()),
+        "sample": df.head().to_string(),
+        "question": question,
+    })
+    clean_response_str = response_str.strip().replace('`json', '').replace('`', '')
+    try:
+        plan = json.loads(clean_response_str)
+    except json.JSONDecodeError:
+        logging.warning("Follow-up classifier did not return valid JSON; treating it as a new question.")
+        return {"mode": "new"}
+    if plan.get("mode") not in ("local", "sql", "new"):
+        return {"mode": "new"}
+    if plan["mode"] == "sql" and "SELECT" not in (plan.get("sql") or "").upper():
+        return {"mode": "new"}
+    return plan
+
+# --- 2. Local Operations ---
+
+def _coerce_value(series: pd.Series, value):
+    if pd.api.types.is_numeric_dtype(series.dtype):
+        return float(value)
+    return str(value)
+
+def apply_local_operations(df: pd.DataFrame, operations: list) -> pd.DataFrame:
+    """
+    Applies filter / sort / limit operations to a cached result and returns a new frame.
+    Raises ValueError for unknown columns or operations so the caller can fall back.
+    String comparisons are case-insensitive, matching how users type names. Missing values
+    behave like SQL NULLs, so the rows match `operations_to_sql` over the previous query:
+    filters drop them and sorts put them first ascending and last descending.
+    """
+    if not operations:
+        raise ValueError("No operations to apply.")
+    for operation in operations:
+        op = operation.get("op")
+        if op == "limit":
+            df = df.head(int(operation["n"]))
+            continue
+        column = operation.get("column")
+        if column not in df.columns:
+            raise ValueError(f"Unknown column: {column}")
+        if op == "sort":
+            ascending = bool(operation.get("ascending", True))
+            # Categoricals from the bounded fetch sort by category order; SQL sorts by value.
+            df = df.sort_values(
+                column, ascending=ascending, kind="stable", na_position="first" if ascending else "last",
+                key=lambda values: values.astype(object) if isinstance(values.dtype, pd.CategoricalDtype) else values,
+            )
+        elif op == "filter":
+            operator = operation.get("operator")
+            if operator not in LOCAL_OPERATORS:
+                raise ValueError(f"Unknown operator: {operator}")
+            series = df[column]
+            present = series.notna()
+            value = _coerce_value(series, operation.get("value"))
+            if isinstance(value, str):
+                series, value = series.astype(str).str.lower(), value.lower()
+            if operator == "contains":
+                mask = series.astype(str).str.contains(str(value), case=False, regex=False)
+            else:
+                mask = {
+                    "==": series.__eq__, "!=": series.__ne__, ">": series.__gt__,
+                    ">=": series.__ge__, "<": series.__lt__, "<=": series.__le__,
+                }[operator](value)
+            df = df[mask.fillna(False).astype(bool) & present]
+        else:
+            raise ValueError(f"Unknown operation: {op}")
+    return df.reset_index(drop=True)
+
+def _sql_literal(value) -> str:
+    if isinstance(value, (int, float)) and not isinstance(value, bool):
+        return repr(value)
+    return "'" + str(value).replace("'", "''") + "'"
+
+def _sql_identifier(name: str) -> str:
+    return '"' + str(name).replace('"', '""') + '"'
+
+def operations_to_sql(previous_sql: str, df: pd.DataFrame, operations: list) -> str:
+    """
+    Expresses the local operations as a query over the previous SQL, so the session's
+    next follow-up (and the SQL shown to the user) reflects the filtered result.
+    """
+    query = f"SELECT * FROM ({previous_sql.strip().rstrip(';')}) AS previous_result"
+    for operation in operations:
+        op = operation["op"]
+        if op == "filter":
+            column, operator = _sql_identifier(operation["column"]), operation["operator"]
+            value = _coerce_value(df[operation["column"]], operation.get("value"))
+            if operator == "contains":
+                condition = f"{column} LIKE {_sql_literal('%' + str(value) + '%')}"
+            elif isinstance(value, str):
+                condition = f"LOWER({column}) {'=' if operator == '==' else operator} LOWER({_sql_literal(value)})"
+            else:
+                condition = f"{column} {'=' if operator == '==' else operator} {_sql_literal(value)}"
+            query = f"SELECT * FROM ({query}) AS previous_result WHERE {condition}"
+        elif op == "sort":
+            direction = "ASC" if operation.get("ascending", True) else "DESC"
+            query = f"SELECT * FROM ({query}) AS previous_result ORDER BY {_sql_identifier(operation['column'])} {direction}"
+        elif op == "limit":
+            query = f"SELECT * FROM ({query}) AS previous_result LIMIT {int(operation['n'])}"
+    return query
@@ -4,6 +4,9 @@ import json
 from langchain_core.prompts import ChatPromptTemplate
 from langchain_google_genai import ChatGoogleGenerativeAI
 
+from chart_encoding import CHART_BINARY_ARRAYS, encode_labels, encode_series
+from llm_governor import governor
+
 class DataFormatter:
     """
     A class to format a Pandas DataFrame into structured JSON for various chart types.
@@ -14,15 +17,17 @@ class DataFormatter:
         """
         self.llm = llm
 
-    def _get_chart_options(self, question: str, columns: list) -> dict:
-        """Uses the LLM to generate a professional title for the chart."""
+    def _get_chart_options(self, question: str, columns: list, llm_title: bool = True) -> dict:
+        """Uses the LLM to generate a professional title for the chart (or the question, with `llm_title=False`)."""
+        if not llm_title:
+            return {"title": question}
         try:
             prompt = ChatPromptTemplate.from_template(
                 "Based on the user's question '{q}' and the data columns '{cols}', "
                 "suggest a concise and professional chart 'title'. "
                 "Respond with a valid JSON object containing only the 'title' key."
             )
-            chain = prompt | self.llm
+            chain = governor.wrap("chart_title", prompt | self.llm, hedge=True)
             options_str = chain.invoke({"q": question, "cols": columns}).content
             # Clean up potential markdown formatting from the LLM
             clean_options_str = options_str.strip().replace('`json', '').replace('`', '')
@@ -31,7 +36,7 @@ class DataFormatter:
             logging.warning(f"Could not generate LLM chart options, falling back to default. Error: {e}")
             return {"title": question}
 
-    def _format_bar_data(self, df: pd.DataFrame, question: str, chart_type: str) -> dict:
+    def _format_bar_data(self, df: pd.DataFrame, question: str, chart_type: str, llm_title: bool = True) -> dict:
         """Formats DataFrame for bar or horizontal_bar charts."""
         label_cols = df.select_dtypes(include=['object', 'category']).columns
         data_cols = df.select_dtypes(include=['number']).columns
@@ -39,69 +44,75 @@ class DataFormatter:
         if not label_cols.any() or not data_cols.any():
             raise ValueError("Bar chart data must have at least one text/object column and one numeric column.")
 
-        labels = df[label_cols[0]].astype(str).tolist()
-        values = [{"data": df[col].tolist(), "label": str(col)} for col in data_cols]
+        labels = encode_labels(df[label_cols[0]])
+        values = [{"data": encode_series(df[col]), "label": str(col)} for col in data_cols]
         
         return {
             "type": chart_type,
             "data": {"labels": labels, "values": values},
-            "options": self._get_chart_options(question, df.columns.tolist())
+            "options": self._get_chart_options(question, df.columns.tolist(), llm_title)
         }
 
-    def _format_line_data(self, df: pd.DataFrame, question: str) -> dict:
+    def _format_line_data(self, df: pd.DataFrame, question: str, llm_title: bool = True) -> dict:
         """Formats DataFrame for line charts."""
         x_col = df.columns[0]
         y_cols = df.select_dtypes(include=['number']).columns
         if not y_cols.any():
             raise ValueError("Line chart data must have at least one numeric y-axis column.")
         
-        labels = df[x_col].astype(str).tolist()
-        values = [{"data": df[col].tolist(), "label": str(col)} for col in y_cols]
+        labels = encode_labels(df[x_col])
+        values = [{"data": encode_series(df[col]), "label": str(col)} for col in y_cols]
 
         return {
             "type": "line",
             "data": {"labels": labels, "values": values},
-            "options": self._get_chart_options(question, df.columns.tolist())
+            "options": self._get_chart_options(question, df.columns.tolist(), llm_title)
         }
         
-    def _format_pie_data(self, df: pd.DataFrame, question: str) -> dict:
+    def _format_pie_data(self, df: pd.DataFrame, question: str, llm_title: bool = True) -> dict:
         """Formats DataFrame for pie charts."""
         label_cols = df.select_dtypes(include=['object', 'category']).columns
         data_cols = df.select_dtypes(include=['number']).columns
         if not label_cols.any() or len(data_cols) != 1:
             raise ValueError("Pie chart data must have exactly one text/object column and one numeric column.")
         labels_col, data_col = label_cols[0], data_cols[0]
-        labels = df[labels_col].astype(str).tolist()
-        values = [{"data": df[data_col].tolist(), "label": data_col}]
+        labels = encode_labels(df[labels_col])
+        values = [{"data": encode_series(df[data_col]), "label": data_col}]
         return {
             "type": "pie",
             "data": {"labels": labels, "values": values},
-            "options": self._get_chart_options(question, df.columns.tolist())
+            "options": self._get_chart_options(question, df.columns.tolist(), llm_title)
         }
 
-    def _format_scatter_data(self, df: pd.DataFrame, question: str) -> dict:
+    def _format_scatter_data(self, df: pd.DataFrame, question: str, llm_title: bool = True) -> dict:
         """Formats DataFrame for scatter plots."""
         numeric_cols = df.select_dtypes(include=['number']).columns
         if len(numeric_cols) < 2:
             raise ValueError("Scatter plot data must have at least two numeric columns.")
         x_col, y_col = numeric_cols[0], numeric_cols[1]
         
-        labels = df[x_col].astype(str).tolist()
-        values = [{
-            "label": f"{x_col} vs {y_col}",
-            "data": df[[x_col, y_col]].to_dict('records')
-        }]
+        if CHART_BINARY_ARRAYS:
+            # Both axes go out as typed arrays; string labels would only duplicate `x`.
+            labels = []
+            values = [{"label": f"{x_col} vs {y_col}", "x": encode_series(df[x_col]), "data": encode_series(df[y_col])}]
+        else:
+            labels = df[x_col].astype(str).tolist()
+            values = [{
+                "label": f"{x_col} vs {y_col}",
+                "data": df[[x_col, y_col]].to_dict('records')
+            }]
 
         return {
             "type": "scatter",
             "data": {"labels": labels, "values": values},
-            "options": self._get_chart_options(question, df.columns.tolist())
+            "options": self._get_chart_options(question, df.columns.tolist(), llm_title)
         }
 
-    def format_data_for_visualization(self, state: dict) -> dict:
+    def format_data_for_visualization(self, state: dict, llm_title: bool = True) -> dict:
         """
         Main method to format a DataFrame for the chosen visualization type.
         This is the primary entry point to be called by the LangGraph node.
+        With `llm_title=False` no LLM call is made and the question becomes the title.
         """
         chart_type = state.get('visualization', 'none')
         df = state.get('sql_dataframe')
@@ -111,21 +122,18 @@ class DataFormatter:
             return {"error": "No data available to format."}
 
         try:
-            # Convert NumPy types to standard Python types for JSON serialization
-            for col in df.select_dtypes(include=['int64', 'int32']).columns:
-                df[col] = df[col].astype(int)
-            for col in df.select_dtypes(include=['float64', 'float32']).columns:
-                df[col] = df[col].astype(float)
-            
+            # `df` is a read-only view of the shared result: only read from it here.
+            # `tolist()` (or the typed-array encoding) already yields JSON-ready values.
+
             # Route to the correct formatting function
             if chart_type in ["bar", "horizontal_bar"]:
-                formatted_data = self._format_bar_data(df, question, chart_type)
+                formatted_data = self._format_bar_data(df, question, chart_type, llm_title)
             elif chart_type == "line":
-                formatted_data = self._format_line_data(df, question)
+                formatted_data = self._format_line_data(df, question, llm_title)
             elif chart_type == "pie":
-                formatted_data = self._format_pie_data(df, question)
+                formatted_data = self._format_pie_data(df, question, llm_title)
             elif chart_type == "scatter":
-                formatted_data = self._format_scatter_data(df, question)
+                formatted_data = self._format_scatter_data(df, question, llm_title)
             else:
                 raise ValueError(f"Unknown or unhandled chart type: {chart_type}")
             
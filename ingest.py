@@ -0,0 +1,221 @@
+import argparse
+import json
+import logging
+import os
+import sqlite3
+import time
+
+import pandas as pd
+
+from contractor_fts import FTS_TABLES, optimize_fts_table
+from data_version import bump_version
+from partitions import PARTITIONED_TABLE, PARTITION_COLUMN, available_partitions, build_partitions
+
+# --- 1. Configuration ---
+# Rows loaded per transaction.
+INGEST_BATCH_ROWS = int(os.getenv("INGEST_BATCH_ROWS", "50000"))
+
+# The columns identifying a row of each table: rows of a drop replace the rows with the same key.
+# cpes_projects has no id column, so an evaluation is identified by contractor, project and date.
+INGEST_KEYS = {
+    "flood_control_projects": ["global_id"],
+    "cpes_projects": ["constructor_name", "project", "date_eval"],
+    "contractor_name_mapping": ["cpes_name"],
+}
+
+STAGING_TABLE = "ingest_staging"
+
+# --- 2. Reading Drops ---
+
+def read_drop(path: str, batch_rows: int = INGEST_BATCH_ROWS):
+    """Yields a CSV, JSON-lines (.ndjson/.jsonl) or JSON-array file as DataFrames of at most `batch_rows` rows."""
+    extension = os.path.splitext(path)[1].lower()
+    if extension == ".csv":
+        yield from pd.read_csv(path, chunksize=batch_rows, dtype=object, keep_default_na=False, na_values=[""])
+    elif extension in (".ndjson", ".jsonl"):
+        yield from pd.read_json(path, lines=True, chunksize=batch_rows, dtype=False)
+    elif extension == ".json":
+        batch = []
+        for record in _json_array_records(path):
+            batch.append(record)
+            if len(batch) == batch_rows:
+                yield pd.DataFrame.from_records(batch)
+                batch = []
+        if batch:
+            yield pd.DataFrame.from_records(batch)
+    else:
+        raise ValueError(f"Unsupported file type '{extension}' for {path} (expected .csv, .json, .ndjson or .jsonl).")
+
+def _json_array_records(path: str, read_size: int = 1 << 20):
+    """Yields the elements of a top-level JSON array one at a time, reading the file in `read_size` pieces."""
+    decoder = json.JSONDecoder()
+    with open(path, encoding="utf-8") as f:
+        buffer = f.read(read_size).lstrip()
+        if not buffer.startswith("["):
+            raise ValueError(f"{path} is not a JSON array.")
+        buffer, position, eof = buffer[1:], 0, False
+        while True:
+            while position < len(buffer) and buffer[position] in " \t\r\n,":
+                position += 1
+            if position < len(buffer) and buffer[position] == "]":
+                return
+            try:
+                record, position = decoder.raw_decode(buffer, position)
+            except json.JSONDecodeError:
+                # The next element continues past the buffer: read more, unless the file has ended.
+                if eof:
+                    raise
+                more = f.read(read_size)
+                eof = not more
+                buffer, position = buffer[position:] + more, 0
+                continue
+            yield record
+
+def _sql_value(value):
+    if isinstance(value, (dict, list)):
+        return json.dumps(value, ensure_ascii=False)
+    return None if pd.isna(value) else value
+
+def _rows(chunk: pd.DataFrame) -> list:
+    # astype(object) turns NumPy scalars into Python ones, which sqlite3 can bind.
+    return [tuple(_sql_value(value) for value in row) for row in chunk.astype(object).itertuples(index=False, name=None)]
+
+# --- 3. Derived Structures ---
+
+def _fts_tables_for(table: str) -> list:
+    return [fts_table for fts_table, (base_table, _) in FTS_TABLES.items() if base_table == table]
+
+def _existing_tables(conn: sqlite3.Connection) -> set:
+    return {row[0] for row in conn.execute("SELECT name FROM sqlite_master WHERE type='table'")}
+
+# --- 4. Upsert ---
+
+def ingest(db_path: str, table: str, paths: list, keys: list | None = None, batch_rows: int = INGEST_BATCH_ROWS) -> dict:
+    """
+    Streams the drop files into `table`, replacing existing rows with the same key.
+    Each batch is one transaction under WAL that also updates the table's indexes and (through
+    their triggers) its FTS tables, so serving processes keep reading consistent data while it
+    runs. Afterwards only the structures derived from `table` are refreshed: its FTS segments,
+    its statistics and (for flood_control_projects) the partitions of the years it touched.
+    Finally the data version is bumped so serving processes drop their caches.
+    Returns a summary with rows, seconds and rows/s.
+    """
+    keys = keys or INGEST_KEYS.get(table)
+    if not keys:
+        raise ValueError(f"No key known for table '{table}'; pass --key.")
+
+    started = time.perf_counter()
+    conn = sqlite3.connect(db_path, isolation_level=None)
+    try:
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        if table not in _existing_tables(conn):
+            raise ValueError(f"Table '{table}' does not exist in {db_path}.")
+        table_columns = [row[1] for row in conn.execute(f"PRAGMA table_info({table})")]
+        missing_keys = [key for key in keys if key not in table_columns]
+        if missing_keys:
+            raise ValueError(f"Key columns {missing_keys} are not columns of '{table}'.")
+
+        key_list = ", ".join(keys)
+        conn.execute(f"CREATE INDEX IF NOT EXISTS idx_{table}_ingest_key ON {table} ({key_list})")
+        conn.execute(f"CREATE TEMP TABLE {STAGING_TABLE} AS SELECT * FROM main.{table} WHERE 0")
+        fts_tables = [name for name in _fts_tables_for(table) if name in _existing_tables(conn)]
+        partitioned = table == PARTITIONED_TABLE and bool(available_partitions())
+
+        affected_years = set()
+        total, skipped, batches = 0, 0, 0
+        for path in paths:
+            for chunk in read_drop(path, batch_rows):
+                batches += 1
+
+                unknown = [column for column in chunk.columns if column not in table_columns]
+                if unknown and batches == 1:
+                    logging.warning(f"Ignoring columns not in '{table}': {', '.join(map(str, unknown))}")
+                columns = [column for column in chunk.columns if column in table_columns]
+                if any(key not in columns for key in keys):
+                    raise ValueError(f"{path} is missing key columns {[key for key in keys if key not in columns]}.")
+                received = len(chunk)
+                chunk = chunk[columns].dropna(subset=keys)
+                skipped += received - len(chunk)
+                column_list = ", ".join(columns)
+
+                conn.execute("BEGIN IMMEDIATE")
+                try:
+                    conn.executemany(
+                        f"INSERT INTO {STAGING_TABLE} ({column_list}) VALUES ({', '.join('?' * len(columns))})",
+                        _rows(chunk),
+                    )
+                    # The last row of a key within the batch wins, as it would across batches.
+                    conn.execute(
+                        f"DELETE FROM {STAGING_TABLE} WHERE rowid NOT IN "
+                        f"(SELECT MAX(rowid) FROM {STAGING_TABLE} GROUP BY {key_list})"
+                    )
+                    if partitioned:
+                        affected_years.update(row[0] for row in conn.execute(
+                            f"SELECT DISTINCT {PARTITION_COLUMN} FROM main.{table} "
+                            f"WHERE ({key_list}) IN (SELECT {key_list} FROM {STAGING_TABLE}) "
+                            f"UNION SELECT DISTINCT {PARTITION_COLUMN} FROM {STAGING_TABLE}"
+                        ))
+                    conn.execute(f"DELETE FROM main.{table} WHERE ({key_list}) IN (SELECT {key_list} FROM {STAGING_TABLE})")
+                    conn.execute(f"INSERT INTO main.{table} ({column_list}) SELECT {column_list} FROM {STAGING_TABLE}")
+                    conn.execute(f"DELETE FROM {STAGING_TABLE}")
+                    conn.execute("COMMIT")
+                except Exception:
+                    conn.execute("ROLLBACK")
+                    raise
+                total += len(chunk)
+                logging.info(f"Batch {batches}: {len(chunk):,} rows ({total / (time.perf_counter() - started):,.0f} rows/s).")
+        load_seconds = time.perf_counter() - started
+
+        # Indexes and FTS tables were kept current batch by batch (so queries and contractor
+        # lookups stay correct while the load runs); compact this table's FTS segments and
+        # refresh its statistics in one transaction.
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            if total:
+                for fts_table in fts_tables:
+                    optimize_fts_table(conn, fts_table)
+            conn.execute(f"ANALYZE {table}")
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        if partitioned and affected_years:
+            build_partitions(db_path, years=sorted(affected_years, key=lambda year: (year is None, str(year))))
+        version = bump_version(conn)
+    finally:
+        conn.close()
+
+    seconds = time.perf_counter() - started
+    return {
+        "table": table,
+        "rows": total,
+        "skipped_rows": skipped,
+        "batches": batches,
+        "load_seconds": round(load_seconds, 2),
+        "seconds": round(seconds, 2),
+        "rows_per_second": round(total / load_seconds) if load_seconds > 0 else 0,
+        "partition_years": sorted(map(str, affected_years)),
+        "data_version": version,
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description="Upsert CSV/JSON drops into the analytics database.")
+    parser.add_argument("table", choices=sorted(INGEST_KEYS), help="Table the drop belongs to.")
+    parser.add_argument("files", nargs="+", help="CSV, JSON or JSON-lines files.")
+    parser.add_argument("--db", default="db/analytics.db", help="Path of the main SQLite database.")
+    parser.add_argument("--key", nargs="+", help="Key columns (default: the table's usual key).")
+    parser.add_argument("--batch-size", type=int, default=INGEST_BATCH_ROWS, help="Rows per transaction.")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s")
+    summary = ingest(args.db, args.table, args.files, keys=args.key, batch_rows=args.batch_size)
+    print(
+        f"Upserted {summary['rows']:,} rows into {summary['table']} in {summary['batches']} batches: "
+        f"{summary['rows_per_second']:,} rows/s loading, {summary['seconds']:.2f}s in total "
+        f"(data version {summary['data_version']})."
+    )
+    if summary["skipped_rows"]:
+        print(f"Skipped {summary['skipped_rows']:,} rows without a key.")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,199 @@
+import asyncio
+import logging
+import os
+import sqlite3
+import threading
+import time
+import uuid
+
+# --- 1. Configuration ---
+JOBS_DB_PATH = os.getenv("JOBS_DB_PATH", "db/jobs.db")
+# Maximum number of events kept per job; older events are dropped first.
+JOB_EVENT_BUFFER = int(os.getenv("JOB_EVENT_BUFFER", "64"))
+# How long (seconds) a finished job and its events stay retrievable.
+JOB_RESULT_TTL = float(os.getenv("JOB_RESULT_TTL", "3600"))
+# Interval (seconds) between keep-alive comments while a client waits for new events.
+JOB_KEEPALIVE_INTERVAL = 15.0
+# Interval (seconds) between store polls for jobs running in another worker process.
+JOB_POLL_INTERVAL = 0.5
+# A running job's worker refreshes its heartbeat this often (seconds); a job whose
+# heartbeat is older than JOB_STALE_AFTER belongs to a worker that has stopped.
+JOB_HEARTBEAT_INTERVAL = float(os.getenv("JOB_HEARTBEAT_INTERVAL", "5"))
+JOB_STALE_AFTER = float(os.getenv("JOB_STALE_AFTER", "30"))
+
+def sse_data(event: str) -> str:
+    """Extracts the JSON payload from a `data: ...` Server-Sent Event string."""
+    return event.removeprefix("data: ").rstrip("\n")
+
+# --- 2. SQLite Job Store ---
+class JobStore:
+    """
+    Persists jobs and their events in SQLite so finished work survives a worker restart.
+    The store is shared by every worker process. Each running job records its owner's pid
+    and a heartbeat, and only jobs whose heartbeat went stale are marked 'interrupted'.
+    """
+    def __init__(self, path: str):
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._lock = threading.Lock()
+        with self._lock:
+            self._conn.execute("PRAGMA journal_mode=WAL;")
+            self._conn.execute("PRAGMA synchronous=NORMAL;")
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS jobs ("
+                "id TEXT PRIMARY KEY, question TEXT, status TEXT, created_at REAL, finished_at REAL, expires_at REAL, "
+                "owner_pid INTEGER, heartbeat_at REAL);"
+            )
+            # Stores created before heartbeats existed.
+            columns = {row[1] for row in self._conn.execute("PRAGMA table_info(jobs);")}
+            for column, column_type in (("owner_pid", "INTEGER"), ("heartbeat_at", "REAL")):
+                if column not in columns:
+                    self._conn.execute(f"ALTER TABLE jobs ADD COLUMN {column} {column_type};")
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS job_events ("
+                "job_id TEXT, seq INTEGER, payload TEXT, PRIMARY KEY (job_id, seq));"
+            )
+        self.interrupt_stale()
+
+    def interrupt_stale(self) -> int:
+        """Marks running jobs whose worker stopped heartbeating as 'interrupted'; other workers' live jobs are left alone."""
+        now = time.time()
+        with self._lock:
+            cursor = self._conn.execute(
+                "UPDATE jobs SET status='interrupted', finished_at=?, expires_at=? "
+                "WHERE status='running' AND COALESCE(heartbeat_at, created_at) < ?;",
+                (now, now + JOB_RESULT_TTL, now - JOB_STALE_AFTER),
+            )
+        return cursor.rowcount
+
+    def create(self, question: str) -> str:
+        job_id = uuid.uuid4().hex
+        now = time.time()
+        with self._lock:
+            self._conn.execute(
+                "INSERT INTO jobs (id, question, status, created_at, owner_pid, heartbeat_at) VALUES (?, ?, 'running', ?, ?, ?);",
+                (job_id, question, now, os.getpid(), now),
+            )
+        return job_id
+
+    def heartbeat(self, job_id: str):
+        with self._lock:
+            self._conn.execute("UPDATE jobs SET heartbeat_at=? WHERE id=? AND status='running';", (time.time(), job_id))
+
+    def append_event(self, job_id: str, seq: int, payload: str):
+        with self._lock:
+            self._conn.execute("BEGIN;")
+            self._conn.execute("INSERT INTO job_events (job_id, seq, payload) VALUES (?, ?, ?);", (job_id, seq, payload))
+            self._conn.execute("DELETE FROM job_events WHERE job_id=? AND seq<=?;", (job_id, seq - JOB_EVENT_BUFFER))
+            self._conn.execute("COMMIT;")
+
+    def finish(self, job_id: str, status: str):
+        now = time.time()
+        with self._lock:
+            self._conn.execute(
+                "UPDATE jobs SET status=?, finished_at=?, expires_at=? WHERE id=?;",
+                (status, now, now + JOB_RESULT_TTL, job_id),
+            )
+
+    def get(self, job_id: str) -> dict | None:
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT id, question, status, created_at, finished_at, expires_at, heartbeat_at FROM jobs WHERE id=?;", (job_id,)
+            ).fetchone()
+        if row is None or (row[5] is not None and row[5] < time.time()):
+            return None
+        return dict(zip(["job_id", "question", "status", "created_at", "finished_at", "expires_at", "heartbeat_at"], row))
+
+    def events_after(self, job_id: str, last_seq: int) -> list:
+        with self._lock:
+            return self._conn.execute(
+                "SELECT seq, payload FROM job_events WHERE job_id=? AND seq>? ORDER BY seq;", (job_id, last_seq)
+            ).fetchall()
+
+    def purge_expired(self) -> int:
+        with self._lock:
+            self._conn.execute("BEGIN;")
+            expired = [r[0] for r in self._conn.execute("SELECT id FROM jobs WHERE expires_at < ?;", (time.time(),))]
+            self._conn.executemany("DELETE FROM job_events WHERE job_id=?;", [(j,) for j in expired])
+            self._conn.executemany("DELETE FROM jobs WHERE id=?;", [(j,) for j in expired])
+            self._conn.execute("COMMIT;")
+        return len(expired)
+
+# --- 3. Job Manager ---
+class JobManager:
+    """
+    Runs jobs as background tasks and streams their stored events with resume support.
+    Store calls run in worker threads so SQLite I/O never blocks the event loop.
+    """
+    def __init__(self, store: JobStore):
+        self.store = store
+        self._wakeups = {}
+        self._tasks = {}
+
+    async def start(self, question: str, events_factory) -> str:
+        """Creates a job that consumes `events_factory()` (an async iterator of SSE strings) in the background."""
+        await asyncio.to_thread(self.store.purge_expired)
+        job_id = await asyncio.to_thread(self.store.create, question)
+        self._wakeups[job_id] = asyncio.Event()
+        self._tasks[job_id] = asyncio.create_task(self._run(job_id, events_factory))
+        return job_id
+
+    def _notify(self, job_id: str):
+        wakeup = self._wakeups.get(job_id)
+        if wakeup is not None:
+            wakeup.set()
+            self._wakeups[job_id] = asyncio.Event()
+
+    async def _heartbeat(self, job_id: str):
+        while True:
+            await asyncio.sleep(JOB_HEARTBEAT_INTERVAL)
+            await asyncio.to_thread(self.store.heartbeat, job_id)
+
+    async def _run(self, job_id: str, events_factory):
+        status = "failed"
+        # Keeps the job alive in the shared store even while a node waits on a slow LLM call.
+        heartbeat = asyncio.create_task(self._heartbeat(job_id))
+        try:
+            seq = 0
+            async for event in events_factory():
+                seq += 1
+                await asyncio.to_thread(self.store.append_event, job_id, seq, sse_data(event))
+                self._notify(job_id)
+            status = "finished"
+        except Exception as e:
+            logging.error(f"Job {job_id} failed: {e}")
+        finally:
+            heartbeat.cancel()
+            await asyncio.to_thread(self.store.finish, job_id, status)
+            self._notify(job_id)
+            self._wakeups.pop(job_id, None)
+            self._tasks.pop(job_id, None)
+
+    async def stream(self, job_id: str, last_event_id: int = 0):
+        """Yields the job's events after `last_event_id` as SSE, following the job until it finishes."""
+        last_seq = last_event_id
+        while True:
+            # Take the wakeup before reading so an event published in between is not missed.
+            wakeup = self._wakeups.get(job_id)
+            rows = await asyncio.to_thread(self.store.events_after, job_id, last_seq)
+            if rows and rows[0][0] > last_seq + 1:
+                yield f"event: gap\ndata: {{\"missed_from\": {last_seq + 1}, \"missed_to\": {rows[0][0] - 1}}}\n\n"
+            for seq, payload in rows:
+                yield f"id: {seq}\ndata: {payload}\n\n"
+                last_seq = seq
+            if wakeup is None:
+                job = await asyncio.to_thread(self.store.get, job_id)
+                if job is not None and job["status"] == "running" and (job["heartbeat_at"] or job["created_at"]) < time.time() - JOB_STALE_AFTER:
+                    # Its worker stopped without finishing it.
+                    await asyncio.to_thread(self.store.interrupt_stale)
+                    return
+                if job is None or job["status"] != "running":
+                    # The job has finished, so every event has been delivered.
+                    return
+                # Running in another worker process: poll the shared store instead.
+                await asyncio.sleep(JOB_POLL_INTERVAL)
+                continue
+            try:
+                await asyncio.wait_for(wakeup.wait(), timeout=JOB_KEEPALIVE_INTERVAL)
+            except asyncio.TimeoutError:
+                yield ": keep-alive\n\n"
@@ -0,0 +1,154 @@
+import hashlib
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+
+from langchain_core.caches import BaseCache
+from langchain_core.load import dumps, loads
+
+import metrics
+
+# --- 1. Configuration ---
+# off:    no caching.
+# on:     cache deterministic (temperature 0) calls only.
+# record: cache every call, so a later replay run needs no network at all.
+# replay: answer every call from the cache and fail on a miss (offline, reproducible evals).
+LLM_CACHE_MODE = os.getenv("LLM_CACHE_MODE", "on").lower()
+LLM_CACHE_PATH = os.getenv("LLM_CACHE_PATH", "db/llm_cache.db")
+# Size budget for cached responses; least recently used entries are evicted first.
+LLM_CACHE_MAX_MB = float(os.getenv("LLM_CACHE_MAX_MB", "256"))
+
+LLM_CACHE_MODES = ("off", "on", "record", "replay")
+
+class LLMCacheMiss(LookupError):
+    """Raised in replay mode when a prompt has no recorded response."""
+
+def cache_key(prompt: str, llm_string: str) -> str:
+    # `llm_string` is LangChain's serialization of the model name, temperature and other parameters.
+    return hashlib.sha256(f"{llm_string}\n{prompt}".encode("utf-8")).hexdigest()
+
+# --- 2. SQLite Cache ---
+class SQLiteLLMCache(BaseCache):
+    """
+    A persistent LangChain cache of LLM responses keyed on the model parameters and a
+    hash of the rendered prompt. Lookups refresh an entry's last-used time; once the
+    stored responses exceed `max_bytes`, the least recently used ones are deleted.
+    """
+    def __init__(self, path: str = LLM_CACHE_PATH, max_bytes: int = int(LLM_CACHE_MAX_MB * 1024 * 1024), replay: bool = False):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.replay = replay
+        self._lock = threading.Lock()
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS llm_cache ("
+            "key TEXT PRIMARY KEY, llm_string TEXT, response TEXT, size INTEGER, last_used REAL)"
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS idx_llm_cache_last_used ON llm_cache (last_used)")
+        self._init_size_totals()
+        self._conn.commit()
+
+    def _init_size_totals(self):
+        # A one-row table of running totals, kept current by triggers so every process sharing the
+        # file sees the same numbers and a write never has to sum the whole cache.
+        self._conn.execute("CREATE TABLE IF NOT EXISTS llm_cache_size (entries INTEGER, total INTEGER)")
+        if self._conn.execute("SELECT 1 FROM llm_cache_size").fetchone() is None:
+            self._conn.execute("INSERT INTO llm_cache_size SELECT COUNT(*), COALESCE(SUM(size), 0) FROM llm_cache")
+        self._conn.execute(
+            "CREATE TRIGGER IF NOT EXISTS llm_cache_size_ai AFTER INSERT ON llm_cache BEGIN "
+            "UPDATE llm_cache_size SET entries = entries + 1, total = total + new.size; END"
+        )
+        self._conn.execute(
+            "CREATE TRIGGER IF NOT EXISTS llm_cache_size_ad AFTER DELETE ON llm_cache BEGIN "
+            "UPDATE llm_cache_size SET entries = entries - 1, total = total - old.size; END"
+        )
+        self._conn.execute(
+            "CREATE TRIGGER IF NOT EXISTS llm_cache_size_au AFTER UPDATE OF size ON llm_cache BEGIN "
+            "UPDATE llm_cache_size SET total = total - old.size + new.size; END"
+        )
+
+    def lookup(self, prompt: str, llm_string: str):
+        key = cache_key(prompt, llm_string)
+        with self._lock:
+            row = self._conn.execute("SELECT response FROM llm_cache WHERE key = ?", (key,)).fetchone()
+            if row is not None:
+                self._conn.execute("UPDATE llm_cache SET last_used = ? WHERE key = ?", (time.time(), key))
+                self._conn.commit()
+        if row is None:
+            metrics.increment("llm_cache.misses")
+            if self.replay:
+                raise LLMCacheMiss(f"No recorded LLM response for prompt {key[:12]} (LLM_CACHE_MODE=replay).")
+            return None
+        metrics.increment("llm_cache.hits")
+        return [loads(generation) for generation in json.loads(row[0])]
+
+    def update(self, prompt: str, llm_string: str, return_val):
+        response = json.dumps([dumps(generation) for generation in return_val])
+        with self._lock:
+            # An upsert rather than INSERT OR REPLACE: REPLACE's implicit delete does not fire the
+            # delete trigger, which would leave the old entry's size in the running total.
+            self._conn.execute(
+                "INSERT INTO llm_cache (key, llm_string, response, size, last_used) VALUES (?, ?, ?, ?, ?) "
+                "ON CONFLICT (key) DO UPDATE SET llm_string = excluded.llm_string, response = excluded.response, "
+                "size = excluded.size, last_used = excluded.last_used",
+                (cache_key(prompt, llm_string), llm_string, response, len(response), time.time()),
+            )
+            self._evict()
+            self._conn.commit()
+
+    def _evict(self):
+        total = self._conn.execute("SELECT total FROM llm_cache_size").fetchone()[0]
+        if total <= self.max_bytes:
+            return
+        freed = 0
+        stale = []
+        for key, size in self._conn.execute("SELECT key, size FROM llm_cache ORDER BY last_used"):
+            if total - freed <= self.max_bytes:
+                break
+            stale.append((key,))
+            freed += size
+        self._conn.executemany("DELETE FROM llm_cache WHERE key = ?", stale)
+        logging.info(f"Evicted {len(stale)} LLM cache entries ({freed / 1e6:.1f} MB).")
+
+    def clear(self, **kwargs):
+        with self._lock:
+            self._conn.execute("DELETE FROM llm_cache")
+            self._conn.commit()
+
+    def stats(self) -> dict:
+        with self._lock:
+            entries, size = self._conn.execute("SELECT entries, total FROM llm_cache_size").fetchone()
+        return {"mode": LLM_CACHE_MODE, "entries": entries, "size_mb": round(size / 1e6, 2)}
+
+_cache = None
+_cache_lock = threading.Lock()
+
+def get_cache() -> SQLiteLLMCache | None:
+    """Returns the process-wide cache, or None when LLM_CACHE_MODE is off."""
+    global _cache
+    if LLM_CACHE_MODE not in LLM_CACHE_MODES:
+        raise ValueError(f"LLM_CACHE_MODE must be one of {', '.join(LLM_CACHE_MODES)}, not '{LLM_CACHE_MODE}'.")
+    if LLM_CACHE_MODE == "off":
+        return None
+    with _cache_lock:
+        if _cache is None:
+            _cache = SQLiteLLMCache(replay=LLM_CACHE_MODE == "replay")
+        return _cache
+
+def cache_for(temperature) -> SQLiteLLMCache | None:
+    """
+    Returns the cache a model with this temperature should use. Sampled answers are only
+    cached when recording or replaying; in normal serving only temperature 0 is cached.
+    """
+    if LLM_CACHE_MODE == "on" and temperature != 0:
+        return None
+    return get_cache()
+
+def cache_stats() -> dict:
+    cache = get_cache()
+    return cache.stats() if cache is not None else {"mode": "off"}
@@ -7,6 +7,9 @@ from langchain_google_genai import ChatGoogleGenerativeAI
 # Load environment variables from .env file
 load_dotenv()
 
+# Imported after load_dotenv() so the cache settings can come from .env.
+from llm_cache import LLM_CACHE_MODE, cache_for
+
 # This line configures the 'google.generativeai' library so it can call list_models().
 # It reads the API key that was already loaded by dotenv in main_agent.py.
 genai.configure(api_key=os.getenv("GOOGLE_API_KEY"))
@@ -27,6 +30,16 @@ def _get_supported_models():
     return _SUPPORTED_MODELS
 
 def get_llm(model_name: str, **kwargs) -> ChatGoogleGenerativeAI:
+    # Quota errors are retried by the process-wide governor (llm_governor.py), which backs off
+    # for every caller at once; keep the client's own retries short so it sees the 429s.
+    kwargs.setdefault("max_retries", 1)
+    # Responses are served from the persistent cache (llm_cache.py) where the mode allows it.
+    cache = cache_for(kwargs.get("temperature"))
+    if cache is not None:
+        kwargs.setdefault("cache", cache)
+    if LLM_CACHE_MODE == "replay":
+        # Offline: every answer comes from the cache, so skip the model list lookup.
+        return ChatGoogleGenerativeAI(model=model_name, **kwargs)
     supported_models = _get_supported_models()
     if model_name in supported_models:
         logging.info(f"Model '{model_name}' is supported. Initializing...")
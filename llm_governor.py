@@ -0,0 +1,335 @@
+import contextlib
+import contextvars
+import heapq
+import itertools
+import logging
+import os
+import random
+import threading
+import time
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+from langchain_core.runnables import RunnableLambda
+
+from metrics import LatencyWindow
+
+# --- 1. Configuration ---
+# Quotas are per process; size them to the share of the project quota this instance may use.
+LLM_RPM_LIMIT = float(os.getenv("LLM_RPM_LIMIT", "1000"))
+LLM_TPM_LIMIT = float(os.getenv("LLM_TPM_LIMIT", "1000000"))
+LLM_MAX_QUEUE = int(os.getenv("LLM_MAX_QUEUE", "64"))
+LLM_QUEUE_TIMEOUT = float(os.getenv("LLM_QUEUE_TIMEOUT", "30"))
+LLM_MAX_RETRIES = int(os.getenv("LLM_MAX_RETRIES", "4"))
+LLM_MAX_BACKOFF = float(os.getenv("LLM_MAX_BACKOFF", "60"))
+
+# Hedging: a duplicate of an idempotent call is sent once the primary is slower than
+# this percentile of recent latencies for its call site (or the default until enough samples exist).
+LLM_HEDGE_PERCENTILE = float(os.getenv("LLM_HEDGE_PERCENTILE", "0.9"))
+LLM_HEDGE_DEFAULT_DELAY = float(os.getenv("LLM_HEDGE_DEFAULT_DELAY", "8"))
+LLM_HEDGE_MIN_DELAY = float(os.getenv("LLM_HEDGE_MIN_DELAY", "1"))
+LLM_HEDGE_MIN_SAMPLES = 20
+LLM_CALL_THREADS = int(os.getenv("LLM_CALL_THREADS", "32"))
+
+# Tokens reserved for the model's answer on top of the estimated prompt size.
+OUTPUT_TOKEN_ALLOWANCE = 512
+
+# Lower number = served first when calls are queued.
+CALL_SITE_PRIORITIES = {
+    "generate_sql": 0,
+    "followup": 0,
+    "validate_sql": 1,
+    "question_relevance": 1,
+    "prompt_injection": 1,
+    "insight": 2,
+    "recommend_visualization": 3,
+    "chart_title": 4,
+    "content_classification": 5,
+}
+DEFAULT_PRIORITY = 3
+
+class LLMQueueFullError(RuntimeError):
+    """Raised when too many LLM calls are already waiting for quota."""
+
+class LLMDeadlineExceeded(TimeoutError):
+    """Raised when an LLM call could not obtain quota or finish before its deadline."""
+
+# --- Deadlines ---
+# The active deadline (a time.monotonic() timestamp) for LLM calls made in the current context.
+_current_deadline = contextvars.ContextVar("llm_deadline", default=None)
+
+@contextlib.contextmanager
+def llm_deadline(seconds: float | None):
+    """Bounds every LLM call made inside the block; nested deadlines can only tighten it."""
+    if not seconds or seconds <= 0:
+        yield
+        return
+    deadline = time.monotonic() + seconds
+    outer = _current_deadline.get()
+    token = _current_deadline.set(deadline if outer is None else min(outer, deadline))
+    try:
+        yield
+    finally:
+        _current_deadline.reset(token)
+
+def estimate_tokens(inputs) -> int:
+    """Rough token estimate (~4 characters per token) of the prompt variables plus the answer."""
+    if isinstance(inputs, dict):
+        chars = sum(len(str(value)) for value in inputs.values())
+    else:
+        chars = len(str(inputs))
+    return chars // 4 + OUTPUT_TOKEN_ALLOWANCE
+
+def is_rate_limit_error(error: Exception) -> bool:
+    """Detects Gemini quota errors (HTTP 429 / ResourceExhausted) regardless of the client library."""
+    if type(error).__name__ in ("ResourceExhausted", "TooManyRequests", "RateLimitError"):
+        return True
+    message = str(error).lower()
+    return "429" in message or "resource exhausted" in message or "resource_exhausted" in message or "quota" in message
+
+# --- 2. Token Bucket ---
+class TokenBucket:
+    """A continuously refilling bucket holding at most one minute of quota."""
+    def __init__(self, per_minute: float):
+        self.capacity = per_minute
+        self.tokens = per_minute
+        self.updated = time.monotonic()
+
+    def refill(self, now: float, scale: float):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.capacity / 60.0 * scale)
+        self.updated = now
+
+    def time_until(self, amount: float, scale: float) -> float:
+        amount = min(amount, self.capacity)
+        if self.tokens >= amount:
+            return 0.0
+        return (amount - self.tokens) / (self.capacity / 60.0 * scale)
+
+# --- 3. Governor ---
+class LLMGovernor:
+    """
+    Process-wide admission control for LLM calls.
+    Calls wait in a bounded priority queue until both the requests-per-minute and
+    tokens-per-minute buckets have room. A 429 halves the refill rate and pauses
+    admission with exponential backoff, and successes slowly restore the rate.
+    """
+    def __init__(self, rpm: float, tpm: float, max_queue: int, queue_timeout: float, max_retries: int):
+        self.requests = TokenBucket(rpm)
+        self.tokens = TokenBucket(tpm)
+        self.max_queue = max_queue
+        self.queue_timeout = queue_timeout
+        self.max_retries = max_retries
+
+        self._cond = threading.Condition()
+        self._waiters = []
+        self._seq = itertools.count()
+        self._rate_scale = 1.0
+        self._paused_until = 0.0
+        self._consecutive_429s = 0
+
+        self._in_flight = 0
+        self._max_queue_depth = 0
+        self._recent_waits = deque(maxlen=1000)
+        self._counters = {
+            "calls": 0, "rejected": 0, "deadline_exceeded": 0, "rate_limited": 0, "retries": 0,
+            "hedges_sent": 0, "hedges_won": 0,
+        }
+        self._per_site = {}
+        self._latencies = {}
+        self._call_pool = ThreadPoolExecutor(max_workers=LLM_CALL_THREADS, thread_name_prefix="llm-call")
+
+    # --- Admission ---
+    def _time_until_ready(self, now: float, tokens: int) -> float:
+        self.requests.refill(now, self._rate_scale)
+        self.tokens.refill(now, self._rate_scale)
+        return max(
+            self._paused_until - now,
+            self.requests.time_until(1, self._rate_scale),
+            self.tokens.time_until(tokens, self._rate_scale),
+        )
+
+    def _acquire(self, call_site: str, tokens: int, deadline: float):
+        priority = CALL_SITE_PRIORITIES.get(call_site, DEFAULT_PRIORITY)
+        enqueued = time.monotonic()
+        with self._cond:
+            if len(self._waiters) >= self.max_queue:
+                self._counters["rejected"] += 1
+                raise LLMQueueFullError(f"LLM queue is full ({self.max_queue} waiting); rejecting '{call_site}'.")
+
+            entry = [priority, next(self._seq), tokens]
+            heapq.heappush(self._waiters, entry)
+            self._max_queue_depth = max(self._max_queue_depth, len(self._waiters))
+            try:
+                while True:
+                    now = time.monotonic()
+                    delay = None
+                    if self._waiters[0] is entry:
+                        delay = self._time_until_ready(now, tokens)
+                        if delay <= 0:
+                            heapq.heappop(self._waiters)
+                            self.requests.tokens -= 1
+                            self.tokens.tokens -= min(tokens, self.tokens.capacity)
+                            break
+                    remaining = deadline - now
+                    if remaining <= 0:
+                        self._counters["deadline_exceeded"] += 1
+                        raise LLMDeadlineExceeded(f"Timed out waiting for LLM quota for '{call_site}'.")
+                    self._cond.wait(timeout=min(delay, remaining) if delay is not None else remaining)
+            except BaseException:
+                if entry in self._waiters:
+                    self._waiters.remove(entry)
+                    heapq.heapify(self._waiters)
+                raise
+            finally:
+                # Whoever is now at the head of the queue must re-check the buckets.
+                self._cond.notify_all()
+
+            waited = time.monotonic() - enqueued
+            self._in_flight += 1
+            self._counters["calls"] += 1
+            self._recent_waits.append(waited)
+            site = self._per_site.setdefault(call_site, {"calls": 0, "wait_s_total": 0.0})
+            site["calls"] += 1
+            site["wait_s_total"] += waited
+
+    def _release(self):
+        with self._cond:
+            self._in_flight -= 1
+
+    # --- Feedback from the API ---
+    def _on_rate_limited(self):
+        with self._cond:
+            self._consecutive_429s += 1
+            self._counters["rate_limited"] += 1
+            self._rate_scale = max(0.1, self._rate_scale * 0.5)
+            backoff = min(LLM_MAX_BACKOFF, 2 ** self._consecutive_429s) * random.uniform(0.5, 1.0)
+            self._paused_until = max(self._paused_until, time.monotonic() + backoff)
+            self.requests.tokens = 0
+            logging.warning(f"LLM quota exceeded; pausing admissions for {backoff:.1f}s at {self._rate_scale:.0%} rate.")
+            self._cond.notify_all()
+
+    def _on_success(self):
+        with self._cond:
+            self._consecutive_429s = 0
+            self._rate_scale = min(1.0, self._rate_scale + 0.05)
+
+    # --- Latency tracking for hedging ---
+    def _latency_window(self, call_site: str) -> LatencyWindow:
+        with self._cond:
+            return self._latencies.setdefault(call_site, LatencyWindow(size=200))
+
+    def _hedge_delay(self, call_site: str) -> float:
+        window = self._latency_window(call_site)
+        if len(window) < LLM_HEDGE_MIN_SAMPLES:
+            return LLM_HEDGE_DEFAULT_DELAY
+        return max(LLM_HEDGE_MIN_DELAY, window.percentile(LLM_HEDGE_PERCENTILE))
+
+    def _deadline_exceeded(self, call_site: str):
+        with self._cond:
+            self._counters["deadline_exceeded"] += 1
+        return LLMDeadlineExceeded(f"LLM call '{call_site}' did not finish before its deadline.")
+
+    # --- Public API ---
+    def _invoke_with_retries(self, call_site: str, runnable, inputs, config):
+        tokens = estimate_tokens(inputs)
+        for attempt in range(self.max_retries + 1):
+            queue_deadline = time.monotonic() + self.queue_timeout
+            deadline = _current_deadline.get()
+            self._acquire(call_site, tokens, queue_deadline if deadline is None else min(queue_deadline, deadline))
+            started = time.monotonic()
+            try:
+                result = runnable.invoke(inputs, config)
+            except Exception as e:
+                if is_rate_limit_error(e) and attempt < self.max_retries:
+                    self._on_rate_limited()
+                    with self._cond:
+                        self._counters["retries"] += 1
+                    continue
+                raise
+            finally:
+                self._release()
+            self._latency_window(call_site).record(time.monotonic() - started)
+            self._on_success()
+            return result
+
+    def invoke(self, call_site: str, runnable, inputs, config=None, hedge: bool = False):
+        """
+        Invokes `runnable` once quota is available, retrying quota errors with backoff.
+        Inside an `llm_deadline` block the call fails with LLMDeadlineExceeded when the
+        deadline passes. With `hedge=True` (only for idempotent, temperature-0 calls) a
+        duplicate is sent if the primary is slow, and the first successful answer wins.
+        """
+        deadline = _current_deadline.get()
+        if deadline is None and not hedge:
+            return self._invoke_with_retries(call_site, runnable, inputs, config)
+
+        def _submit():
+            ctx = contextvars.copy_context()
+            return self._call_pool.submit(ctx.run, self._invoke_with_retries, call_site, runnable, inputs, config)
+
+        primary = _submit()
+        pending = {primary}
+        hedge_at = time.monotonic() + self._hedge_delay(call_site) if hedge else None
+        first_error = None
+
+        while pending:
+            now = time.monotonic()
+            timeouts = [t - now for t in (deadline, hedge_at) if t is not None]
+            done, pending = wait(pending, timeout=max(0.0, min(timeouts)) if timeouts else None, return_when=FIRST_COMPLETED)
+
+            for future in done:
+                if future.exception() is None:
+                    if future is not primary:
+                        with self._cond:
+                            self._counters["hedges_won"] += 1
+                    return future.result()
+                first_error = first_error or future.exception()
+
+            now = time.monotonic()
+            if deadline is not None and now >= deadline:
+                # Abandoned calls finish in the background; their answers are discarded.
+                raise self._deadline_exceeded(call_site)
+            if hedge_at is not None and now >= hedge_at and pending:
+                hedge_at = None
+                with self._cond:
+                    self._counters["hedges_sent"] += 1
+                logging.info(f"LLM call '{call_site}' is slow; sending a hedged duplicate.")
+                pending.add(_submit())
+
+        raise first_error
+
+    def wrap(self, call_site: str, runnable, hedge: bool = False) -> RunnableLambda:
+        """Returns a runnable that routes every invocation of `runnable` through the governor."""
+        def _governed(inputs, config=None):
+            return self.invoke(call_site, runnable, inputs, config, hedge=hedge)
+        return RunnableLambda(_governed, name=f"governed_{call_site}")
+
+    def metrics(self) -> dict:
+        with self._cond:
+            waits = sorted(self._recent_waits)
+            return {
+                "queue_depth": len(self._waiters),
+                "max_queue_depth": self._max_queue_depth,
+                "in_flight": self._in_flight,
+                "wait_ms_avg": round(1000 * sum(waits) / len(waits), 1) if waits else 0.0,
+                "wait_ms_p95": round(1000 * waits[int(0.95 * (len(waits) - 1))], 1) if waits else 0.0,
+                "rate_scale": round(self._rate_scale, 2),
+                "paused_for_s": round(max(0.0, self._paused_until - time.monotonic()), 1),
+                **self._counters,
+                "per_call_site": {
+                    site: {
+                        "calls": s["calls"],
+                        "wait_ms_avg": round(1000 * s["wait_s_total"] / s["calls"], 1),
+                        "latency": self._latencies[site].summary() if site in self._latencies else {"count": 0},
+                    }
+                    for site, s in self._per_site.items()
+                },
+            }
+
+governor = LLMGovernor(
+    rpm=LLM_RPM_LIMIT,
+    tpm=LLM_TPM_LIMIT,
+    max_queue=LLM_MAX_QUEUE,
+    queue_timeout=LLM_QUEUE_TIMEOUT,
+    max_retries=LLM_MAX_RETRIES,
+)
@@ -1,12 +1,23 @@
 import logging
 import json
+import os
+import functools
 from dotenv import load_dotenv
 from typing import TypedDict
 import pandas as pd
 
-from tools import is_prompt_injection, is_question_related, generate_sql_query, validate_and_correct_sql, execute_sql_query, recommend_visualization, generate_insight_from_data, sanitize_and_validate_data
+from tools import is_prompt_injection, is_question_related, sql_generation_chain, sql_generation_inputs, clean_generated_sql, validate_and_correct_sql, execute_sql_query, recommend_visualization, generate_insight_from_data, sanitize_and_validate_data
+from tools import USE_COMBINED_SQL_CALL, COMBINED_SQL_MIN_CONFIDENCE, combined_sql_chain, check_sql_locally
 from formatter import DataFormatter
 from llm_config import get_llm
+from llm_governor import governor, llm_deadline, LLMDeadlineExceeded
+from profiler import profiled
+from followup import classify_followup, apply_local_operations, operations_to_sql, might_refine
+from sessions import session_store
+from result_store import result_store
+from export import export_registry
+from fewshot import record_verified
+import metrics
 from langchain_community.utilities import SQLDatabase # Re-added the missing import
 # CORRECTED: Added StrOutputParser to the imports for the LCEL pipeline
 from langchain_core.prompts import ChatPromptTemplate, PromptTemplate 
@@ -28,24 +39,101 @@ class AgentState(TypedDict):
     db_schema: str
     generated_sql: str
     validated_sql: str
-    sql_dataframe: pd.DataFrame
+    # ID of the query result in the result store; nodes read it through result_frame()
+    result_id: str
+    # ID under which the validated SQL can be re-run for a full CSV/NDJSON export
+    export_id: str
     visualization: str
     formatted_data_for_visualization: dict
     insight: str
     error: str
+    # Session follow-ups: the previous result's context key, this run's key and how it was answered
+    previous_context: str
+    context_key: str
+    followup: str
+    # Which SQL prompt variant ('few_shot' or 'zero_shot') generated the query
+    sql_variant: str
+    # True when the validation call accepted the generated SQL without correcting it
+    sql_verified: bool
+    # True when the query result was cut off at the SQL result memory budget
+    truncated: bool
 
 # --- 2. Create Instances of Our Tools ---
 helper_llm = get_llm(model_name="gemini-2.5-flash", temperature=0)
 formatter = DataFormatter(llm=helper_llm)
 db = SQLDatabase.from_uri("sqlite:///db/analytics.db")
+_DB_SCHEMA = None
+
+def get_db_schema() -> str:
+    """Returns the table info sent to the LLM, read from the database once per process."""
+    global _DB_SCHEMA
+    if _DB_SCHEMA is None:
+        _DB_SCHEMA = db.get_table_info()
+    return _DB_SCHEMA
+
+def reset_db_schema():
+    """Forgets the cached table info (it includes sample rows) so it is re-read after an ingest."""
+    global _DB_SCHEMA
+    _DB_SCHEMA = None
+
+UNSUPPORTED_KEYWORDS = [
+    'delete', 'drop', 'recreate', 'truncate', 'shutdown', 'restart', 'kill', 'grant', 'revoke',
+    'who are you', 'what is your name', 'what is ai', 'can you create a python script',
+    'how to hack', 'how to create a bomb', 'how to commit suicide'
+]
+
+def has_unsupported_keyword(question: str) -> bool:
+    question = question.lower()
+    return any(keyword in question for keyword in UNSUPPORTED_KEYWORDS)
+
+def result_frame(state: AgentState) -> pd.DataFrame | None:
+    """Returns a read-only view of the state's query result, or None if there is none."""
+    return result_store.view(state.get("result_id"))
 
 # --- 3. Define the Nodes for our Graph ---
 # Each node is a function that performs a specific action.
 
-def content_classification_node(state: AgentState):
-    """Classifies the content of the insight to ensure it is appropriate."""
-    logging.info("---NODE: CLASSIFYING CONTENT---")
-    
+# Per-node deadlines in seconds for the LLM calls a node makes (0 disables).
+# Override with NODE_DEADLINE_<NODE_NAME>, e.g. NODE_DEADLINE_INSIGHT=15.
+_DEFAULT_NODE_DEADLINES = {
+    "followup": 15,
+    "validate_question": 20,
+    "plan_sql": 40,
+    "generate_sql": 30,
+    "validate_sql": 20,
+    "visualizer": 8,
+    "formatter": 8,
+    "insight": 25,
+    "content_classification": 10,
+}
+NODE_DEADLINES = {
+    name: float(os.getenv(f"NODE_DEADLINE_{name.upper()}", default))
+    for name, default in _DEFAULT_NODE_DEADLINES.items()
+}
+
+def with_deadline(node_name: str, fallback=None):
+    """
+    Runs a node under its configured LLM deadline. Non-essential nodes pass a
+    `fallback` (a dict, or a function of the state) that is returned when the deadline
+    is missed; essential nodes let LLMDeadlineExceeded propagate so the stream reports the failure.
+    """
+    def decorator(node_fn):
+        @functools.wraps(node_fn)
+        def wrapper(state):
+            with llm_deadline(NODE_DEADLINES.get(node_name)):
+                try:
+                    return node_fn(state)
+                except LLMDeadlineExceeded:
+                    if fallback is None:
+                        raise
+                    logging.warning(f"Node '{node_name}' missed its deadline; using fallback value.")
+            # Built outside the expired deadline; a callable fallback must not call the LLM.
+            return fallback(state) if callable(fallback) else dict(fallback)
+        return wrapper
+    return decorator
+
+def content_classification_chain():
+    """Builds the governed moderation chain that labels a text 'safe' or 'unsafe'."""
     # CORRECTED: Changed LLMChain to the modern LCEL pipeline structure
     prompt = PromptTemplate(
         input_variables=["text"],
@@ -53,10 +141,15 @@ def content_classification_node(state: AgentState):
     )
     
     # Use LCEL chain structure
-    chain = prompt | helper_llm | StrOutputParser()
-    
+    return governor.wrap("content_classification", prompt | helper_llm | StrOutputParser(), hedge=True)
+
+@with_deadline("content_classification")
+def content_classification_node(state: AgentState):
+    """Classifies the content of the insight to ensure it is appropriate."""
+    logging.info("---NODE: CLASSIFYING CONTENT---")
+
     # Invoke the chain
-    classification = chain.invoke({"text": state["insight"]})
+    classification = content_classification_chain().invoke({"text": state["insight"]})
     
     if "unsafe" in classification.strip().lower():
         logging.error(f"Inappropriate content detected in insight: {state['insight']}")
@@ -64,52 +157,135 @@ def content_classification_node(state: AgentState):
     
     return {}
 
+@with_deadline("insight", fallback={"insight": "The insight took too long to generate. Please review the table and chart, or try again."})
 def insight_node(state: AgentState):
     """Generates an insight from the data."""
     logging.info("---NODE: GENERATING INSIGHT---")
-    if state.get("error") or state.get("sql_dataframe") is None or state.get("sql_dataframe").empty:
+    df = result_frame(state)
+    if state.get("error") or df is None or df.empty:
         logging.warning("Skipping insight generation due to error or no data.")
         return {"insight": "No insight available."}
     
-    insight = generate_insight_from_data(state['question'], state['sql_dataframe'])
+    insight = generate_insight_from_data(state['question'], df)
     return {"insight": insight}
 
+@with_deadline("followup", fallback={"followup": "new"})
+def followup_node(state: AgentState):
+    """Answers a follow-up from the session's previous result when it only refines it."""
+    logging.info("---NODE: CHECKING FOR FOLLOW-UP---")
+    context = session_store.get(state.get("previous_context"))
+    previous_df = result_store.view(context["result_id"]) if context is not None else None
+    if previous_df is None or has_unsupported_keyword(state["question"]):
+        return {"followup": "new"}
+    if not might_refine(state["question"], previous_df):
+        # Clearly a new question: skip the classifier call on the critical path.
+        metrics.increment("followup.prefiltered")
+        return {"followup": "new"}
+
+    plan = classify_followup(state["question"], context, previous_df)
+    question = plan.get("standalone_question") or state["question"]
+    metrics.increment(f"followup.{plan['mode']}")
+    if plan["mode"] == "local":
+        try:
+            df = apply_local_operations(previous_df, plan.get("operations") or [])
+            sql = operations_to_sql(context["validated_sql"], previous_df, plan["operations"])
+        except (ValueError, TypeError, KeyError) as e:
+            logging.warning(f"Could not apply follow-up locally ({e}); running the full pipeline.")
+            return {"followup": "new", "question": question}
+        logging.info(f"Answered follow-up from the cached result with: {plan['operations']}")
+        return {
+            "followup": "local", "question": question, "validated_sql": sql,
+            "result_id": result_store.put(df), "export_id": export_registry.register(sql),
+        }
+    if plan["mode"] == "sql":
+        sql = plan["sql"][plan["sql"].upper().find("SELECT"):].strip()
+        issue = check_sql_locally(sql)
+        if issue is not None:
+            # The refined SQL goes through validate_sql like a newly generated query.
+            logging.warning(f"Follow-up SQL failed the local checks ({issue}); validating it.")
+            return {"followup": "sql", "question": question, "generated_sql": sql, "db_schema": get_db_schema()}
+        logging.info(f"Answering follow-up by refining the previous SQL:\n{sql}")
+        return {"followup": "sql", "question": question, "validated_sql": sql}
+    return {"followup": "new", "question": question}
+
+def route_followup(state: AgentState) -> str:
+    mode = state.get("followup") or "new"
+    if mode == "sql" and not state.get("validated_sql"):
+        return "validate"
+    return route_result(state) if mode == "local" else mode
+
+@with_deadline("validate_question")
 def validate_question_node(state: AgentState):
     """Validates the user's question to ensure it is related to the database content and does not contain harmful keywords."""
     logging.info("---NODE: VALIDATING QUESTION---")
-    unsupported_keywords = [
-        'delete', 'drop', 'recreate', 'truncate', 'shutdown', 'restart', 'kill', 'grant', 'revoke',
-        'who are you', 'what is your name', 'what is ai', 'can you create a python script',
-        'how to hack', 'how to create a bomb', 'how to commit suicide'
-    ]
-    question = state.get("question", "").lower()
-    if any(keyword in question for keyword in unsupported_keywords):
-        logging.error(f"Unsupported keyword found in question: {question}")
+    question = state.get("question", "")
+    if has_unsupported_keyword(question):
+        logging.error(f"Unsupported keyword found in question: {question.lower()}")
         return {"error": "Unsupported question"}
 
-    db_schema = db.get_table_info()
+    db_schema = get_db_schema()
     if not is_question_related(state["question"], db_schema):
         logging.error(f"Unsupported question: {state['question']}")
         return {"error": "Unsupported question"}
     return {"db_schema": db_schema}
 
+@with_deadline("generate_sql")
 def sql_generation_node(state: AgentState):
     """Generates the initial SQL query from the user's question."""
     logging.info("---NODE: GENERATING SQL---")
     if state.get("error"):
         return {}
-    db_schema = db.get_table_info()
-    query = generate_sql_query(state['question'], db_schema)
-    return {"generated_sql": query, "db_schema": db_schema}
+    db_schema = get_db_schema()
+    inputs, variant = sql_generation_inputs(state['question'], db_schema)
+    query = clean_generated_sql(sql_generation_chain().invoke(inputs))
+    return {"generated_sql": query, "db_schema": db_schema, "sql_variant": variant}
+
+@with_deadline("plan_sql")
+def sql_planning_node(state: AgentState):
+    """
+    Combined mode: one structured-output call decides relevance, writes the SQL and rates it.
+    The query skips the validation call when it passes the local checks with enough confidence.
+    """
+    logging.info("---NODE: PLANNING SQL---")
+    question = state.get("question", "")
+    if has_unsupported_keyword(question):
+        logging.error(f"Unsupported keyword found in question: {question.lower()}")
+        return {"error": "Unsupported question"}
 
+    db_schema = get_db_schema()
+    inputs, variant = sql_generation_inputs(question, db_schema)
+    try:
+        plan = combined_sql_chain().invoke(inputs)
+    except Exception as e:
+        plan = None
+        logging.warning(f"Combined SQL call failed: {e}")
+    if plan is None:
+        # No usable answer: route_after_planning falls back to validate_question and generate_sql.
+        metrics.increment("sql.combined.failed")
+        return {}
+    if not plan.related:
+        logging.error(f"Unsupported question: {question}")
+        return {"error": "Unsupported question"}
+
+    query = plan.sql.strip()
+    update = {"generated_sql": query, "db_schema": db_schema, "sql_variant": variant}
+    issue = check_sql_locally(query)
+    if issue is None and plan.confidence >= COMBINED_SQL_MIN_CONFIDENCE:
+        return {**update, "validated_sql": query}
+    logging.warning(f"Planned SQL needs validation (confidence {plan.confidence:.2f}, issue: {issue}, notes: {plan.notes}).")
+    return update
+
+@with_deadline("validate_sql")
 def sql_validation_node(state: AgentState):
     """Validates and corrects the generated SQL query."""
     logging.info("---NODE: VALIDATING SQL---")
     validation_result = validate_and_correct_sql(state['generated_sql'], state['db_schema'])
     if validation_result.get("valid"):
-        return {"validated_sql": state['generated_sql']}
+        return {"validated_sql": state['generated_sql'], "sql_verified": True}
     else:
         logging.warning(f"SQL was invalid. Issues: {validation_result.get('issues')}. Using corrected query.")
+        if state.get("sql_variant"):
+            metrics.increment(f"sql.{state['sql_variant']}.corrected")
         return {"validated_sql": validation_result.get("corrected_query")}
 
 def sql_execution_node(state: AgentState):
@@ -117,15 +293,24 @@ def sql_execution_node(state: AgentState):
     logging.info("---NODE: EXECUTING SQL---")
     execution_result = execute_sql_query(state['validated_sql'])
     if "error" in execution_result:
-        return {"error": execution_result["error"], "sql_dataframe": pd.DataFrame()}
+        if state.get("sql_variant"):
+            metrics.increment(f"sql.{state['sql_variant']}.execution_failed")
+        return {"error": execution_result["error"], "result_id": ""}
     
     sanitized_df = sanitize_and_validate_data(execution_result["sql_dataframe"])
-    return {"sql_dataframe": sanitized_df}
-
+    # Only the compact copy is kept; later nodes read views of it by ID.
+    return {
+        "result_id": result_store.put(sanitized_df),
+        "export_id": export_registry.register(state['validated_sql']),
+        # The full result remains available through the export link.
+        "truncated": execution_result["truncated"],
+    }
+
+@with_deadline("visualizer", fallback={"visualization": "none"})
 def visualizer_node(state: AgentState):
     """Recommends a visualization type based on the query result."""
     logging.info("---NODE: RECOMMENDING VISUALIZATION---")
-    df = state.get('sql_dataframe')
+    df = result_frame(state)
     if state.get("error") or df is None or df.empty:
         logging.warning("Skipping visualization due to error or no data.")
         return {"visualization": "none"}
@@ -140,35 +325,143 @@ def visualizer_node(state: AgentState):
     logging.info(f"Parsed visualization type: {chart_type}")
     return {"visualization": chart_type}
 
+def _format_without_llm(state: AgentState) -> dict:
+    """Deadline fallback: the chart without the LLM title (the question is used instead)."""
+    formatted_data_dict = formatter.format_data_for_visualization({**state, "sql_dataframe": result_frame(state)}, llm_title=False)
+    return {"formatted_data_for_visualization": formatted_data_dict}
+
+@with_deadline("formatter", fallback=_format_without_llm)
 def formatter_node(state: AgentState):
     """Formats the data into a chart-ready JSON object."""
     logging.info("---NODE: FORMATTING DATA---")
-    formatted_data_dict = formatter.format_data_for_visualization(state)
+    formatted_data_dict = formatter.format_data_for_visualization({**state, "sql_dataframe": result_frame(state)})
     return {"formatted_data_for_visualization": formatted_data_dict}
 
+# --- Conditional Routing ---
+# LLM calls the skipped nodes would still have made on each shortcut route,
+# counted in /metrics as graph.llm_calls_saved.<route>.
+ROUTE_SAVED_LLM_CALLS = {
+    "question_rejected": 2,  # validate_sql, content_classification
+    "plan_accepted": 2,      # question_relevance, validate_sql
+    "plan_validated": 1,     # question_relevance
+    "plan_rejected": 1,      # content_classification
+    "execution_failed": 1,   # content_classification
+    "empty_result": 1,       # content_classification of the canned "no data" insight
+    "scalar_result": 2,      # visualizer, chart title in formatter
+}
+
+def _take_route(route: str, target: str) -> str:
+    metrics.increment(f"graph.route.{route}")
+    metrics.increment(f"graph.llm_calls_saved.{route}", ROUTE_SAVED_LLM_CALLS.get(route, 0))
+    return target
+
+def route_after_validation(state: AgentState) -> str:
+    if state.get("error"):
+        return _take_route("question_rejected", "end")
+    return "continue"
+
+def route_after_planning(state: AgentState) -> str:
+    if state.get("error"):
+        return _take_route("plan_rejected", "end")
+    if not state.get("generated_sql"):
+        return _take_route("plan_failed", "fallback")
+    if state.get("validated_sql"):
+        return _take_route("plan_accepted", "execute")
+    return _take_route("plan_validated", "validate")
+
+def route_result(state: AgentState) -> str:
+    """Sends a query result to charting, or straight to the insight when a chart adds nothing."""
+    if state.get("error"):
+        return _take_route("execution_failed", "end")
+    df = result_frame(state)
+    if df is None or df.empty:
+        return _take_route("empty_result", "skip_llm")
+    if df.shape == (1, 1):
+        return _take_route("scalar_result", "insight")
+    return "chart"
+
+def route_after_insight(state: AgentState) -> str:
+    df = result_frame(state)
+    # An empty result gets a fixed message from insight_node, so there is nothing to moderate.
+    return "skip_classification" if df is None or df.empty else "classify"
+
+def remember_node(state: AgentState):
+    """
+    Caches this run's question, SQL and result for the session's next follow-up, and
+    logs freshly generated SQL that passed validation unchanged and returned rows as a
+    few-shot example.
+    """
+    df = result_frame(state)
+    if state.get("error") or df is None or not state.get("validated_sql"):
+        return {}
+    if state.get("sql_variant") and state.get("sql_verified") and not df.empty:
+        try:
+            record_verified(state["question"], state["validated_sql"])
+        except OSError as e:
+            logging.warning(f"Could not log verified SQL example: {e}")
+    if state.get("context_key"):
+        session_store.publish(state["context_key"], {
+            "question": state["question"], "validated_sql": state["validated_sql"], "result_id": state["result_id"],
+        })
+    return {}
+
 # --- 4. Build the Graph ---
 workflow = StateGraph(AgentState)
 
-# Add the nodes
-workflow.add_node("validate_question", validate_question_node)
-workflow.add_node("generate_sql", sql_generation_node)
-workflow.add_node("validate_sql", sql_validation_node)
-workflow.add_node("execute_sql", sql_execution_node)
-workflow.add_node("visualizer", visualizer_node)
-workflow.add_node("formatter", formatter_node)
-workflow.add_node("insight", insight_node)
-workflow.add_node("content_classification", content_classification_node)
+# Add the nodes (each one's thread is sampled while it runs in a profiled request)
+workflow.add_node("followup", profiled("followup")(followup_node))
+workflow.add_node("validate_question", profiled("validate_question")(validate_question_node))
+workflow.add_node("generate_sql", profiled("generate_sql")(sql_generation_node))
+workflow.add_node("plan_sql", profiled("plan_sql")(sql_planning_node))
+workflow.add_node("validate_sql", profiled("validate_sql")(sql_validation_node))
+workflow.add_node("execute_sql", profiled("execute_sql")(sql_execution_node))
+workflow.add_node("visualizer", profiled("visualizer")(visualizer_node))
+workflow.add_node("formatter", profiled("formatter")(formatter_node))
+workflow.add_node("insight", profiled("insight")(insight_node))
+workflow.add_node("content_classification", profiled("content_classification")(content_classification_node))
+workflow.add_node("remember", profiled("remember")(remember_node))
 
 # Define the workflow sequence
-workflow.set_entry_point("validate_question")
-workflow.add_edge("validate_question", "generate_sql")
+workflow.set_entry_point("followup")
+# Follow-ups that only refine the previous result skip question validation and SQL generation.
+workflow.add_conditional_edges("followup", route_followup, {
+    "chart": "visualizer",
+    "insight": "insight",
+    "skip_llm": "insight",
+    "sql": "execute_sql",
+    "validate": "validate_sql",
+    # With USE_COMBINED_SQL_CALL one call replaces question validation and SQL generation.
+    "new": "plan_sql" if USE_COMBINED_SQL_CALL else "validate_question",
+    "end": END,
+})
+# Rejected questions and failed queries end the run instead of reaching more LLM calls.
+workflow.add_conditional_edges("validate_question", route_after_validation, {
+    "continue": "generate_sql",
+    "end": END,
+})
 workflow.add_edge("generate_sql", "validate_sql")
+workflow.add_conditional_edges("plan_sql", route_after_planning, {
+    "execute": "execute_sql",
+    "validate": "validate_sql",
+    "fallback": "validate_question",
+    "end": END,
+})
 workflow.add_edge("validate_sql", "execute_sql")
-workflow.add_edge("execute_sql", "visualizer")
+# Single values and empty results skip the chart recommendation and chart title.
+workflow.add_conditional_edges("execute_sql", route_result, {
+    "chart": "visualizer",
+    "insight": "insight",
+    "skip_llm": "insight",
+    "end": END,
+})
 workflow.add_edge("visualizer", "formatter")
 workflow.add_edge("formatter", "insight")
-workflow.add_edge("insight", "content_classification")
-workflow.add_edge("content_classification", END)
+workflow.add_conditional_edges("insight", route_after_insight, {
+    "classify": "content_classification",
+    "skip_classification": "remember",
+})
+workflow.add_edge("content_classification", "remember")
+workflow.add_edge("remember", END)
 
 # Compile the graph into a runnable application
 app = workflow.compile()
@@ -190,8 +483,9 @@ def main():
         print(f"An error occurred during execution: {final_state['error']}")
 
     print("## Data Result:\n")
-    if final_state.get("sql_dataframe") is not None and not final_state["sql_dataframe"].empty:
-        print(final_state["sql_dataframe"].to_string())
+    result_df = result_frame(final_state)
+    if result_df is not None and not result_df.empty:
+        print(result_df.to_string())
     else:
         print("No data was returned from the query.")
     print("\n" + "-"*50 + "\n")
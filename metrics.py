@@ -0,0 +1,64 @@
+import threading
+from collections import deque
+
+class LatencyWindow:
+    """Keeps the most recent samples of a duration and reports percentiles over them."""
+    def __init__(self, size: int = 1000):
+        self._samples = deque(maxlen=size)
+        self._lock = threading.Lock()
+
+    def record(self, seconds: float):
+        with self._lock:
+            self._samples.append(seconds)
+
+    def __len__(self):
+        return len(self._samples)
+
+    def percentile(self, q: float) -> float | None:
+        with self._lock:
+            samples = sorted(self._samples)
+        if not samples:
+            return None
+        return samples[min(len(samples) - 1, int(q * len(samples)))]
+
+    def summary(self) -> dict:
+        with self._lock:
+            samples = sorted(self._samples)
+        if not samples:
+            return {"count": 0}
+
+        def _pick(q):
+            return round(1000 * samples[min(len(samples) - 1, int(q * len(samples)))], 1)
+
+        return {
+            "count": len(samples),
+            "p50_ms": _pick(0.50),
+            "p95_ms": _pick(0.95),
+            "p99_ms": _pick(0.99),
+            "max_ms": round(1000 * samples[-1], 1),
+        }
+
+_WINDOWS = {}
+_COUNTERS = {}
+_LOCK = threading.Lock()
+
+def record_latency(name: str, seconds: float):
+    """Adds a duration sample to the named latency window."""
+    with _LOCK:
+        window = _WINDOWS.setdefault(name, LatencyWindow())
+    window.record(seconds)
+
+def increment(name: str, amount: int = 1):
+    """Increments a named counter."""
+    with _LOCK:
+        _COUNTERS[name] = _COUNTERS.get(name, 0) + amount
+
+def snapshot() -> dict:
+    """Returns every latency summary and counter, for the /metrics endpoint."""
+    with _LOCK:
+        windows = dict(_WINDOWS)
+        counters = dict(_COUNTERS)
+    return {
+        "latency": {name: window.summary() for name, window in windows.items()},
+        "counters": counters,
+    }
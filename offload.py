@@ -0,0 +1,194 @@
+import asyncio
+import json
+import logging
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+import bleach
+import numpy as np
+import pandas as pd
+
+# NOTE: This module is imported by the pool's worker processes, so it must stay light:
+# do not import the agent, the LLM clients or the API from here.
+
+# --- 1. Configuration ---
+# Number of worker processes for CPU-bound DataFrame work (0 runs everything inline).
+CPU_POOL_WORKERS = int(os.getenv("CPU_POOL_WORKERS", str(min(4, os.cpu_count() or 1))))
+# Results smaller than this many cells (rows x columns) are processed inline.
+OFFLOAD_MIN_CELLS = int(os.getenv("OFFLOAD_MIN_CELLS", "50000"))
+
+# --- 2. Custom JSON Encoder ---
+def json_ready(df: pd.DataFrame) -> pd.DataFrame:
+    """Turns missing values in dictionary-encoded columns into None (JSON null) instead of NaN."""
+    categorical = [i for i, dtype in enumerate(df.dtypes) if isinstance(dtype, pd.CategoricalDtype)]
+    if not categorical or not any(df.iloc[:, i].isna().any() for i in categorical):
+        return df
+    df = df.copy(deep=False)
+    for i in categorical:
+        column = df.iloc[:, i]
+        df.isetitem(i, column.astype(object).where(column.notna(), None))
+    return df
+
+# This class teaches Python's JSON library how to handle special types
+# that it doesn't know about, like NumPy numbers and Pandas DataFrames.
+class CustomJSONEncoder(json.JSONEncoder):
+    def default(self, obj):
+        if isinstance(obj, (np.integer, np.int64)):
+            return int(obj)
+        if isinstance(obj, (np.floating, np.float64)):
+            return float(obj)
+        if isinstance(obj, pd.DataFrame):
+            # Convert DataFrame to a JSON-friendly dict with 'split' orientation
+            return json_ready(obj).to_dict(orient='split')
+        # Let the base class default method raise the TypeError
+        return super(CustomJSONEncoder, self).default(obj)
+
+# --- 3. Columnar Transfer Format ---
+# DataFrames cross the process boundary as flat buffers instead of pickled objects:
+# numeric columns as raw array bytes, text columns as one UTF-8 blob plus offsets,
+# and categoricals as integer codes plus their categories.
+
+def to_columnar(df: pd.DataFrame) -> dict:
+    columns = []
+    for position, name in enumerate(df.columns):
+        series = df.iloc[:, position]
+        if isinstance(series.dtype, pd.CategoricalDtype):
+            columns.append({
+                "name": name, "kind": "category",
+                "codes": series.cat.codes.to_numpy().tobytes(), "codes_dtype": series.cat.codes.dtype.str,
+                "categories": series.cat.categories.tolist(),
+            })
+        elif series.dtype != object and pd.api.types.is_numeric_dtype(series.dtype):
+            values = series.to_numpy()
+            columns.append({"name": name, "kind": "numeric", "dtype": values.dtype.str, "data": values.tobytes()})
+        elif pd.api.types.infer_dtype(series, skipna=True) in ("string", "empty"):
+            mask = series.isna().to_numpy()
+            values = series.where(~mask, "").tolist()
+            # Offsets are in characters: the blob is decoded once and sliced on the other side.
+            offsets = np.zeros(len(values) + 1, dtype=np.int64)
+            np.cumsum(np.fromiter(map(len, values), dtype=np.int64, count=len(values)), out=offsets[1:])
+            columns.append({
+                "name": name, "kind": "string",
+                "blob": "".join(values).encode("utf-8"), "offsets": offsets.tobytes(), "nulls": np.packbits(mask).tobytes(),
+            })
+        else:
+            # Mixed or exotic objects are rare in SQL results; ship them as a plain list.
+            columns.append({"name": name, "kind": "object", "values": series.tolist()})
+    return {"columns": columns, "rows": len(df)}
+
+def from_columnar(payload: dict) -> pd.DataFrame:
+    rows = payload["rows"]
+    data = {}
+    for col in payload["columns"]:
+        kind = col["kind"]
+        if kind == "numeric":
+            values = np.frombuffer(bytearray(col["data"]), dtype=np.dtype(col["dtype"]))
+        elif kind == "category":
+            codes = np.frombuffer(col["codes"], dtype=np.dtype(col["codes_dtype"]))
+            values = pd.Categorical.from_codes(codes, categories=col["categories"])
+        elif kind == "string":
+            text, offsets = col["blob"].decode("utf-8"), np.frombuffer(col["offsets"], dtype=np.int64).tolist()
+            nulls = np.unpackbits(np.frombuffer(col["nulls"], dtype=np.uint8), count=rows).astype(bool).tolist()
+            values = np.array(
+                [None if nulls[i] else text[offsets[i]:offsets[i + 1]] for i in range(rows)],
+                dtype=object,
+            )
+        else:
+            values = np.array(col["values"], dtype=object)
+        data[col["name"]] = values
+    return pd.DataFrame(data, columns=[col["name"] for col in payload["columns"]])
+
+# --- 4. CPU-Bound Stages ---
+
+def sanitize_frame(df: pd.DataFrame) -> pd.DataFrame:
+    """Strips HTML from text columns and coerces numeric columns (see tools.sanitize_and_validate_data)."""
+    for col in df.columns:
+        # Sanitize string columns
+        if df[col].dtype == 'object':
+            df[col] = df[col].apply(lambda x: bleach.clean(x) if isinstance(x, str) else x)
+        # Dictionary-encoded text: clean each distinct value once
+        elif isinstance(df[col].dtype, pd.CategoricalDtype):
+            cleaned = df[col].cat.categories.map(lambda x: bleach.clean(x) if isinstance(x, str) else x)
+            if cleaned.is_unique:
+                df[col] = df[col].cat.rename_categories(cleaned)
+            else:
+                df[col] = df[col].astype(object).map(lambda x: bleach.clean(x) if isinstance(x, str) else x)
+        # Coerce numeric columns to numeric, coercing errors to NaN
+        elif pd.api.types.is_numeric_dtype(df[col]):
+            df[col] = pd.to_numeric(df[col], errors='coerce')
+    return df
+
+def _run_frame_stage(stage_name: str, payload: dict) -> dict:
+    """Worker entry point: rebuilds the DataFrame, runs the stage and ships the result back."""
+    return to_columnar(_FRAME_STAGES[stage_name](from_columnar(payload)))
+
+def _serialize_event(event_data: dict, frame_key: str, payload: dict) -> str:
+    """Worker entry point: serializes an SSE event whose DataFrame arrived in columnar form."""
+    event_data["data"] = {**event_data["data"], frame_key: from_columnar(payload)}
+    return f"data: {json.dumps(event_data, cls=CustomJSONEncoder)}\n\n"
+
+_FRAME_STAGES = {
+    "sanitize": sanitize_frame,
+}
+
+# --- 5. Process Pool ---
+_POOL = None
+
+def _get_pool():
+    global _POOL
+    if _POOL is None and CPU_POOL_WORKERS > 0:
+        # 'spawn' keeps workers independent of the server's threads and open connections.
+        _POOL = ProcessPoolExecutor(max_workers=CPU_POOL_WORKERS, mp_context=multiprocessing.get_context("spawn"))
+        logging.info(f"Started CPU offload pool with {CPU_POOL_WORKERS} worker processes.")
+    return _POOL
+
+def _discard_broken_pool():
+    """Drops a pool whose worker died so the next call starts a fresh one."""
+    global _POOL
+    if _POOL is not None and getattr(_POOL, "_broken", False):
+        _POOL.shutdown(wait=False, cancel_futures=True)
+        _POOL = None
+
+def _should_offload(df) -> bool:
+    return isinstance(df, pd.DataFrame) and df.size >= OFFLOAD_MIN_CELLS and _get_pool() is not None
+
+def run_frame_stage(stage_name: str, df: pd.DataFrame) -> pd.DataFrame:
+    """Runs a CPU-bound DataFrame stage, in the process pool when the frame is large."""
+    if not _should_offload(df):
+        return _FRAME_STAGES[stage_name](df)
+    try:
+        payload = _get_pool().submit(_run_frame_stage, stage_name, to_columnar(df)).result()
+        return from_columnar(payload)
+    except Exception as e:
+        logging.warning(f"Offloaded stage '{stage_name}' failed, running inline. Error: {e}")
+        _discard_broken_pool()
+        return _FRAME_STAGES[stage_name](df)
+
+async def serialize_event(event_data: dict) -> str:
+    """Serializes an SSE event, moving large DataFrame payloads off the event loop."""
+    node_output = event_data.get("data")
+    frame_key = None
+    if isinstance(node_output, dict):
+        frame_key = next((k for k, v in node_output.items() if _should_offload(v)), None)
+    if frame_key is None:
+        return f"data: {json.dumps(event_data, cls=CustomJSONEncoder)}\n\n"
+
+    loop = asyncio.get_running_loop()
+    payload = to_columnar(node_output[frame_key])
+    light_event = {**event_data, "data": {k: v for k, v in node_output.items() if k != frame_key}}
+    try:
+        return await loop.run_in_executor(_get_pool(), _serialize_event, light_event, frame_key, payload)
+    except Exception as e:
+        logging.warning(f"Offloaded event serialization failed, serializing inline. Error: {e}")
+        _discard_broken_pool()
+        return f"data: {json.dumps(event_data, cls=CustomJSONEncoder)}\n\n"
+
+# --- 6. Event Loop Lag Monitor ---
+async def monitor_event_loop_lag(record, interval: float = 0.1):
+    """Measures how late the event loop wakes up from a fixed sleep; `record` receives the lag in seconds."""
+    loop = asyncio.get_running_loop()
+    while True:
+        expected = loop.time() + interval
+        await asyncio.sleep(interval)
+        record(max(0.0, loop.time() - expected))
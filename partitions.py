@@ -0,0 +1,439 @@
+import argparse
+import logging
+import os
+import re
+import sqlite3
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from decimal import ROUND_HALF_UP, Decimal
+
+import numpy as np
+import pandas as pd
+
+from sql_fetch import read_sql_bounded
+
+# --- 1. Configuration ---
+# Serve `flood_control_projects` queries from per-year partition files (built with `python partitions.py`).
+USE_YEAR_PARTITIONS = os.getenv("USE_YEAR_PARTITIONS", "0") == "1"
+PARTITION_DIR = os.getenv("PARTITION_DIR", "db/partitions")
+# Threads (each with its own connection) running per-partition aggregates concurrently.
+PARTITION_WORKERS = int(os.getenv("PARTITION_WORKERS", "4"))
+
+PARTITIONED_TABLE = "flood_control_projects"
+PARTITION_COLUMN = "infra_year"
+# SQLite's default limit on attached databases per connection.
+MAX_ATTACHED = 10
+# Rows without an infra_year go to their own partition; no year predicate ever selects them.
+UNKNOWN_YEAR = "unknown"
+# Columns indexed inside each partition: the usual filters and GROUP BY keys.
+PARTITION_INDEX_COLUMNS = ["region", "province", "implementing_office", "contractor"]
+
+_PARTITION_FILE = re.compile(rf"^{PARTITIONED_TABLE}_(\d{{4}}|{UNKNOWN_YEAR})\.db$")
+
+class UnsupportedPartitionQuery(ValueError):
+    """Raised when a query cannot be answered from the partitions as planned."""
+
+def partition_path(year, partition_dir: str = PARTITION_DIR) -> str:
+    return os.path.join(partition_dir, f"{PARTITIONED_TABLE}_{UNKNOWN_YEAR if year is None else int(year)}.db")
+
+def available_partitions(partition_dir: str = PARTITION_DIR) -> dict:
+    """Returns {year: path} for every partition file (year None for rows without one)."""
+    if not os.path.isdir(partition_dir):
+        return {}
+    partitions = {}
+    for name in os.listdir(partition_dir):
+        match = _PARTITION_FILE.match(name)
+        if match:
+            year = None if match.group(1) == UNKNOWN_YEAR else int(match.group(1))
+            partitions[year] = os.path.join(partition_dir, name)
+    return partitions
+
+# --- 2. Building Partitions ---
+
+def build_partitions(db_path: str, years=None, partition_dir: str = PARTITION_DIR) -> dict:
+    """
+    Copies each infra_year's rows of `flood_control_projects` into its own SQLite file,
+    with the table's original definition, per-partition indexes and statistics. Files are
+    written next to the target and swapped in atomically, so serving processes never see
+    a half-built partition. `years` limits the rebuild (e.g. to the years an ingest touched);
+    a full rebuild also removes partitions whose year no longer exists.
+    Returns {year: row count}.
+    """
+    os.makedirs(partition_dir, exist_ok=True)
+    conn = sqlite3.connect(db_path)
+    try:
+        create_sql = conn.execute(
+            "SELECT sql FROM sqlite_master WHERE type='table' AND name=?", (PARTITIONED_TABLE,)
+        ).fetchone()[0]
+        columns = {row[1] for row in conn.execute(f"PRAGMA table_info({PARTITIONED_TABLE})")}
+        index_columns = [column for column in PARTITION_INDEX_COLUMNS if column in columns]
+        existing_years = [row[0] for row in conn.execute(
+            f"SELECT DISTINCT {PARTITION_COLUMN} FROM {PARTITIONED_TABLE} ORDER BY 1"
+        )]
+        targets = existing_years if years is None else list(years)
+        counts = {}
+        for year in targets:
+            started = time.perf_counter()
+            final_path = partition_path(year, partition_dir)
+            if year not in existing_years:
+                if os.path.exists(final_path):
+                    os.remove(final_path)
+                continue
+            tmp_path = final_path + ".tmp"
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            part = sqlite3.connect(tmp_path)
+            part.execute(create_sql)
+            part.commit()
+            part.close()
+            conn.execute("ATTACH DATABASE ? AS part", (tmp_path,))
+            try:
+                with conn:
+                    cursor = conn.execute(
+                        f"INSERT INTO part.{PARTITIONED_TABLE} SELECT * FROM main.{PARTITIONED_TABLE} "
+                        f"WHERE {PARTITION_COLUMN} IS ?", (year,)
+                    )
+                    counts[year] = cursor.rowcount
+                    # Indexes are built after the bulk insert, which is faster than maintaining them row by row.
+                    for column in index_columns:
+                        conn.execute(f"CREATE INDEX part.idx_{PARTITIONED_TABLE}_{column} ON {PARTITIONED_TABLE} ({column})")
+                conn.execute("ANALYZE part")
+            finally:
+                conn.execute("DETACH DATABASE part")
+            os.replace(tmp_path, final_path)
+            logging.info(f"Built partition {year}: {counts[year]:,} rows in {time.perf_counter() - started:.2f}s.")
+
+        if years is None:
+            for year, path in available_partitions(partition_dir).items():
+                if year not in existing_years:
+                    os.remove(path)
+        return counts
+    finally:
+        conn.close()
+
+# --- 3. Partition Pruning ---
+
+# A single-table query over the partitioned table: one SELECT, no joins, no comma joins.
+_SINGLE_TABLE = re.compile(
+    rf"\bFROM\s+{PARTITIONED_TABLE}\b(?:\s+(?:AS\s+)?(?!WHERE\b|GROUP\b|ORDER\b|LIMIT\b)\w+)?\s*(?:WHERE\b|GROUP\b|ORDER\b|LIMIT\b|;|$)",
+    re.IGNORECASE,
+)
+_YEAR_PREDICATE = re.compile(
+    rf"\b(?:\w+\.)?{PARTITION_COLUMN}\s*(?:"
+    r"(?P<op>==|=|>=|<=|>|<)\s*'?(?P<value>\d{4})'?"
+    r"|BETWEEN\s+'?(?P<low>\d{4})'?\s+AND\s+'?(?P<high>\d{4})'?"
+    r"|IN\s*\((?P<values>[\d',\s]+)\))",
+    re.IGNORECASE,
+)
+
+def _is_single_table_query(sql: str) -> bool:
+    return (
+        len(re.findall(r"\bSELECT\b", sql, re.IGNORECASE)) == 1
+        and len(re.findall(r"\bFROM\b", sql, re.IGNORECASE)) == 1
+        and not re.search(r"\bJOIN\b", sql, re.IGNORECASE)
+        and bool(_SINGLE_TABLE.search(sql))
+    )
+
+# The WHERE clause of a single-SELECT query, up to the clause that follows it.
+_WHERE_CLAUSE = re.compile(
+    r"\bWHERE\b(?P<clause>.*?)(?=\bGROUP\s+BY\b|\bHAVING\b|\bORDER\s+BY\b|\bLIMIT\b|\bWINDOW\b|;|$)",
+    re.IGNORECASE | re.DOTALL,
+)
+
+def prune_years(sql: str, years: list) -> list:
+    """
+    Returns the partition years `sql` can read. Only infra_year predicates of the WHERE
+    clause of a single-table query are used, and only when that clause is one AND
+    conjunction (no OR, NOT or CASE); year tests elsewhere, such as a CASE in the
+    SELECT list, do not filter rows. Anything else reads every partition.
+    """
+    if not _is_single_table_query(sql):
+        return list(years)
+    where = _WHERE_CLAUSE.search(sql)
+    if where is None or re.search(r"\b(?:OR|NOT|CASE)\b", where.group("clause"), re.IGNORECASE):
+        return list(years)
+    selected = set(years)
+    for match in _YEAR_PREDICATE.finditer(where.group("clause")):
+        known = {year for year in selected if year is not None}
+        if match.group("op"):
+            value = int(match.group("value"))
+            compare = {
+                "=": value.__eq__, "==": value.__eq__, ">=": value.__le__,
+                "<=": value.__ge__, ">": value.__lt__, "<": value.__gt__,
+            }[match.group("op")]
+            selected = {year for year in known if compare(year)}
+        elif match.group("low"):
+            low, high = int(match.group("low")), int(match.group("high"))
+            selected = {year for year in known if low <= year <= high}
+        else:
+            values = {int(v) for v in re.findall(r"\d{4}", match.group("values"))}
+            selected = known & values
+    return sorted(selected, key=lambda year: (year is None, year))
+
+# --- 4. Queries Over a Unified View ---
+
+def _connect(db_path: str, partitions: dict, years: list) -> sqlite3.Connection:
+    """
+    Opens a read-only connection to the main database with the selected partitions attached
+    and a temporary `flood_control_projects` view over them, which shadows the main table.
+    """
+    if len(years) > MAX_ATTACHED:
+        raise UnsupportedPartitionQuery(f"{len(years)} partitions exceed the {MAX_ATTACHED}-database attach limit.")
+    conn = sqlite3.connect(f"file:{db_path}?mode=ro", uri=True)
+    selects = []
+    for position, year in enumerate(years):
+        conn.execute(f"ATTACH DATABASE ? AS p{position}", (f"file:{partitions[year]}?mode=ro",))
+        selects.append(f"SELECT * FROM p{position}.{PARTITIONED_TABLE}")
+    union = " UNION ALL ".join(selects) or f"SELECT * FROM main.{PARTITIONED_TABLE} WHERE 0"
+    conn.execute(f"CREATE TEMP VIEW {PARTITIONED_TABLE} AS {union}")
+    return conn
+
+# --- 5. Parallel Aggregation ---
+_AGGREGATE_QUERY = re.compile(
+    rf"^\s*SELECT\s+(?P<select>.+?)\s+FROM\s+{PARTITIONED_TABLE}\b(?P<alias>(?:\s+(?:AS\s+)?(?!WHERE\b|GROUP\b)\w+)?)"
+    r"(?:\s+WHERE\s+(?P<where>.+?))?"
+    r"\s+GROUP\s+BY\s+(?P<group>.+?)"
+    r"(?:\s+ORDER\s+BY\s+(?P<order>.+?))?"
+    r"(?:\s+LIMIT\s+(?P<limit>\d+)(?:\s+OFFSET\s+(?P<offset>\d+))?)?\s*;?\s*$",
+    re.IGNORECASE | re.DOTALL,
+)
+_AGGREGATE_ITEM = re.compile(
+    r"^(?P<round>ROUND\s*\(\s*)?(?P<func>SUM|COUNT|AVG|MIN|MAX)\s*\(\s*(?P<expr>[^()]*?(?:\([^()]*\)[^()]*?)*)\s*\)"
+    r"(?(round)\s*(?:,\s*(?P<digits>\d+)\s*)?\))$",
+    re.IGNORECASE | re.DOTALL,
+)
+_ALIAS = re.compile(r"^(?P<expr>.+?)(?:\s+AS)?\s+(?P<alias>\"[^\"]+\"|\w+)$", re.IGNORECASE | re.DOTALL)
+_IDENTIFIER = re.compile(r"^(?:\w+\.)?(\"[^\"]+\"|\w+)$")
+
+def _split_top_level(text: str) -> list:
+    """Splits on commas outside parentheses and quotes."""
+    parts, depth, quote, current = [], 0, None, []
+    for char in text:
+        if quote:
+            quote = None if char == quote else quote
+        elif char in "'\"":
+            quote = char
+        elif char == "(":
+            depth += 1
+        elif char == ")":
+            depth -= 1
+        elif char == "," and depth == 0:
+            parts.append("".join(current).strip())
+            current = []
+            continue
+        current.append(char)
+    parts.append("".join(current).strip())
+    return parts
+
+def _normalize(expr: str) -> str:
+    return re.sub(r"\s+", "", expr).lower()
+
+def _split_alias(item: str) -> tuple:
+    if _AGGREGATE_ITEM.match(item) or _IDENTIFIER.match(item):
+        return item, None
+    match = _ALIAS.match(item)
+    if match is None:
+        return item, None
+    return match.group("expr").strip(), match.group("alias").strip('"')
+
+def plan_aggregate(sql: str) -> dict | None:
+    """
+    Recognizes `SELECT <keys>, SUM/COUNT/AVG/MIN/MAX(...) FROM flood_control_projects
+    [WHERE ...] GROUP BY <keys> [ORDER BY ...] [LIMIT n]` (aggregates optionally wrapped
+    in ROUND) and returns how to compute it as per-partition partials plus a merge.
+    Returns None for every other query shape.
+    """
+    match = _AGGREGATE_QUERY.match(sql.strip())
+    if match is None or not _is_single_table_query(sql) or re.search(r"\b(?:HAVING|DISTINCT)\b", sql, re.IGNORECASE):
+        return None
+    group_keys = _split_top_level(match.group("group"))
+    if not all(_IDENTIFIER.match(key) for key in group_keys):
+        return None
+    normalized_keys = [_normalize(key) for key in group_keys]
+
+    outputs, partial_columns = [], [f"{key} AS _g{i}" for i, key in enumerate(group_keys)]
+    for position, item in enumerate(_split_top_level(match.group("select"))):
+        expr, alias = _split_alias(item)
+        name = alias or expr
+        if _normalize(expr) in normalized_keys:
+            outputs.append({"kind": "key", "name": name, "expr": expr, "key": normalized_keys.index(_normalize(expr))})
+            continue
+        aggregate = _AGGREGATE_ITEM.match(expr)
+        if aggregate is None or "DISTINCT" in aggregate.group("expr").upper():
+            return None
+        func, inner = aggregate.group("func").upper(), aggregate.group("expr")
+        digits = aggregate.group("digits")
+        output = {
+            "kind": func, "name": name, "expr": expr, "index": position,
+            "round": (int(digits) if digits else 0) if aggregate.group("round") else None,
+        }
+        if func in ("SUM", "AVG"):
+            partial_columns += [f"SUM({inner}) AS _s{position}", f"COUNT({inner}) AS _n{position}"]
+        elif func == "COUNT":
+            partial_columns.append(f"COUNT({inner}) AS _c{position}")
+        else:
+            partial_columns.append(f"{func}({inner}) AS _m{position}")
+        outputs.append(output)
+
+    where = f" WHERE {match.group('where')}" if match.group("where") else ""
+    partial_sql = (
+        f"SELECT {', '.join(partial_columns)} FROM {PARTITIONED_TABLE}{match.group('alias')}{where} "
+        f"GROUP BY {', '.join(group_keys)}"
+    )
+    return {
+        "partial_sql": partial_sql,
+        "keys": len(group_keys),
+        "outputs": outputs,
+        "order": _split_top_level(match.group("order")) if match.group("order") else [],
+        "limit": int(match.group("limit")) if match.group("limit") else None,
+        "offset": int(match.group("offset") or 0),
+    }
+
+_EXECUTOR = None
+_EXECUTOR_LOCK = threading.Lock()
+
+def _executor() -> ThreadPoolExecutor:
+    global _EXECUTOR
+    with _EXECUTOR_LOCK:
+        if _EXECUTOR is None:
+            _EXECUTOR = ThreadPoolExecutor(max_workers=PARTITION_WORKERS, thread_name_prefix="partition")
+        return _EXECUTOR
+
+def _read_partition(path: str, sql: str) -> pd.DataFrame:
+    # One connection per partition and call; sqlite3 releases the GIL while the query runs.
+    conn = sqlite3.connect(f"file:{path}?mode=ro", uri=True)
+    try:
+        return pd.read_sql(sql, conn)
+    finally:
+        conn.close()
+
+def _numeric(values: pd.Series) -> np.ndarray:
+    if values.dtype == object or not pd.api.types.is_numeric_dtype(values.dtype):
+        raise UnsupportedPartitionQuery(f"Cannot merge non-numeric partial aggregate '{values.name}'.")
+    return values.to_numpy(dtype=np.float64)
+
+def _sql_round(values: np.ndarray, digits: int) -> np.ndarray:
+    # SQLite's ROUND rounds the decimal form of a value half away from zero (np.round rounds
+    # binary halves to even, so 2.5 -> 2 and 1.005 -> 1.0) and always returns REAL.
+    quantum = Decimal(1).scaleb(-digits)
+    return np.array(
+        [value if np.isnan(value) else float(Decimal(repr(value)).quantize(quantum, rounding=ROUND_HALF_UP))
+         for value in values.astype(np.float64).tolist()],
+        dtype=np.float64,
+    )
+
+def merge_partials(plan: dict, partials: list) -> pd.DataFrame:
+    """Merges per-partition partial aggregates with NumPy, then applies ORDER BY and LIMIT."""
+    combined = pd.concat(partials, ignore_index=True)
+    key_columns = [f"_g{i}" for i in range(plan["keys"])]
+    grouper = combined.groupby(key_columns, sort=False, dropna=False)
+    codes = grouper.ngroup().to_numpy()
+    groups = combined[key_columns].drop_duplicates().reset_index(drop=True)
+    n = len(groups)
+
+    result = {}
+    for output in plan["outputs"]:
+        if output["kind"] == "key":
+            values = groups[f"_g{output['key']}"].to_numpy()
+        elif output["kind"] == "COUNT":
+            values = np.bincount(codes, weights=_numeric(combined[f"_c{output['index']}"]), minlength=n).astype(np.int64)
+        elif output["kind"] in ("SUM", "AVG"):
+            sums = np.bincount(codes, weights=np.nan_to_num(_numeric(combined[f"_s{output['index']}"])), minlength=n)
+            counts = np.bincount(codes, weights=_numeric(combined[f"_n{output['index']}"]), minlength=n)
+            with np.errstate(invalid="ignore", divide="ignore"):
+                values = sums / counts if output["kind"] == "AVG" else sums
+            # SQL: SUM/AVG over no non-NULL values is NULL.
+            values = np.where(counts > 0, values, np.nan)
+            partial_sums = combined[f"_s{output['index']}"]
+            if output["kind"] == "SUM" and pd.api.types.is_integer_dtype(partial_sums.dtype) and (counts > 0).all():
+                values = values.astype(np.int64)
+        else:
+            partial_values = combined[f"_m{output['index']}"]
+            values = np.full(n, np.inf if output["kind"] == "MIN" else -np.inf)
+            (np.fmin if output["kind"] == "MIN" else np.fmax).at(values, codes, _numeric(partial_values))
+            values[np.isinf(values)] = np.nan
+            # MIN/MAX of an INTEGER column is an integer, as it is from the main table.
+            if pd.api.types.is_integer_dtype(partial_values.dtype) and not np.isnan(values).any():
+                values = values.astype(partial_values.dtype)
+        if output.get("round") is not None:
+            values = _sql_round(values, output["round"])
+        result[output["name"]] = values
+    df = pd.DataFrame(result)
+    return _order_and_limit(df, plan)
+
+def _order_and_limit(df: pd.DataFrame, plan: dict) -> pd.DataFrame:
+    if plan["order"]:
+        by, ascending = [], []
+        names = {_normalize(output["name"]): output["name"] for output in plan["outputs"]}
+        names.update({_normalize(output["expr"]): output["name"] for output in plan["outputs"]})
+        for term in plan["order"]:
+            direction = re.search(r"\s+(ASC|DESC)$", term, re.IGNORECASE)
+            expr = term[:direction.start()] if direction else term
+            expr = expr.strip().strip('"')
+            if expr.isdigit() and 1 <= int(expr) <= len(df.columns):
+                column = df.columns[int(expr) - 1]
+            elif _normalize(expr) in names:
+                column = names[_normalize(expr)]
+            else:
+                raise UnsupportedPartitionQuery(f"Cannot order merged aggregates by '{expr}'.")
+            by.append(column)
+            ascending.append(not (direction and direction.group(1).upper() == "DESC"))
+        # SQLite sorts NULLs first in ascending order and last in descending order.
+        df = df.sort_values(by, ascending=ascending, kind="stable", na_position="first" if ascending[0] else "last")
+    if plan["limit"] is not None:
+        df = df.iloc[plan["offset"]:plan["offset"] + plan["limit"]]
+    elif plan["offset"]:
+        df = df.iloc[plan["offset"]:]
+    return df.reset_index(drop=True)
+
+# --- 6. Entry Point ---
+
+def execute_partitioned(sql: str, db_path: str) -> tuple | None:
+    """
+    Answers `sql` from the year partitions when that reads less data than the main table:
+    decomposable GROUP BY aggregates run concurrently per partition and are merged, and
+    queries with infra_year predicates read only the matching partitions. Returns
+    (DataFrame, truncated), or None when the query should run against the main table.
+    """
+    if not re.search(rf"\b{PARTITIONED_TABLE}\b", sql, re.IGNORECASE):
+        return None
+    partitions = available_partitions()
+    if not partitions:
+        return None
+    years = prune_years(sql, list(partitions))
+
+    plan = plan_aggregate(sql)
+    if plan is not None:
+        started = time.perf_counter()
+        futures = [_executor().submit(_read_partition, partitions[year], plan["partial_sql"]) for year in years]
+        partials = [future.result() for future in futures]
+        partials = [partial for partial in partials if not partial.empty]
+        if not partials:
+            # No partition has matching rows: an empty result with the output columns.
+            return pd.DataFrame(columns=[output["name"] for output in plan["outputs"]]), False
+        df = merge_partials(plan, partials)
+        logging.info(f"Aggregated {len(years)} partitions in parallel in {time.perf_counter() - started:.3f}s.")
+        return df, False
+
+    if len(years) == len(partitions):
+        # Nothing to prune: the main table is read just as fast.
+        return None
+    logging.info(f"Reading {len(years)} of {len(partitions)} year partitions.")
+    conn = _connect(db_path, partitions, years)
+    try:
+        return read_sql_bounded(sql, conn)
+    finally:
+        conn.close()
+
+def main():
+    parser = argparse.ArgumentParser(description="Split flood_control_projects into per-infra_year partition files.")
+    parser.add_argument("--db", default="db/analytics.db", help="Path of the main SQLite database.")
+    parser.add_argument("--years", type=int, nargs="*", help="Rebuild only these years (default: all).")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s")
+    counts = build_partitions(args.db, years=args.years or None)
+    print(f"Built {len(counts)} partitions with {sum(counts.values()):,} rows in {PARTITION_DIR}.")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,190 @@
+import contextlib
+import contextvars
+import functools
+import hmac
+import logging
+import os
+import random
+import re
+import sys
+import threading
+import time
+from collections import Counter
+
+# --- 1. Configuration ---
+# Share of /stream-agent requests profiled automatically (0 disables sampling).
+PROFILE_SAMPLE_RATE = float(os.getenv("PROFILE_SAMPLE_RATE", "0"))
+# Requests sending this value in the X-Profile header are always profiled, and it
+# guards the /admin/profiles endpoints. Unset, only PROFILE_SAMPLE_RATE applies.
+PROFILE_ADMIN_TOKEN = os.getenv("PROFILE_ADMIN_TOKEN", "")
+PROFILE_INTERVAL = float(os.getenv("PROFILE_INTERVAL_MS", "5")) / 1000
+PROFILE_DIR = os.getenv("PROFILE_DIR", "profiles")
+PROFILE_MAX_FILES = int(os.getenv("PROFILE_MAX_FILES", "100"))
+
+TRACE_ID_PATTERN = re.compile(r"^[0-9a-f]{32}$")
+
+# The profile of the graph execution running in the current context, if any.
+_current_profile = contextvars.ContextVar("profile", default=None)
+
+def is_admin(token: str | None) -> bool:
+    return bool(PROFILE_ADMIN_TOKEN) and hmac.compare_digest(token or "", PROFILE_ADMIN_TOKEN)
+
+def should_profile(profile_header: str | None) -> bool:
+    """Decides whether a request is profiled: by admin header, or by PROFILE_SAMPLE_RATE."""
+    return is_admin(profile_header) or (PROFILE_SAMPLE_RATE > 0 and random.random() < PROFILE_SAMPLE_RATE)
+
+def profile_path(trace_id: str) -> str | None:
+    if not TRACE_ID_PATTERN.match(trace_id):
+        return None
+    return os.path.join(PROFILE_DIR, f"{trace_id}.collapsed")
+
+def _collapse(frame, label: str) -> str:
+    names = []
+    while frame is not None:
+        code = frame.f_code
+        names.append(f"{frame.f_globals.get('__name__', '?')}.{getattr(code, 'co_qualname', code.co_name)}")
+        frame = frame.f_back
+    names.append(label)
+    return ";".join(reversed(names)).replace(" ", "_")
+
+# --- 2. Sampler ---
+class Profile:
+    """The stacks sampled from the threads working on one traced request."""
+    def __init__(self, trace_id: str):
+        self.trace_id = trace_id
+        self.threads = {}
+        self.stacks = Counter()
+        self.samples = 0
+        self.started = time.perf_counter()
+
+class _Sampler:
+    """
+    One background thread that reads `sys._current_frames()` every PROFILE_INTERVAL
+    while at least one profile is active, recording only the threads registered to
+    each profile. No thread runs and nothing is sampled when no profile is active.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._profiles = set()
+        self._thread = None
+
+    def add(self, profile: Profile):
+        with self._lock:
+            self._profiles.add(profile)
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="profiler", daemon=True)
+                self._thread.start()
+
+    def remove(self, profile: Profile):
+        with self._lock:
+            self._profiles.discard(profile)
+
+    def register(self, profile: Profile, label: str):
+        with self._lock:
+            profile.threads[threading.get_ident()] = label
+
+    def unregister(self, profile: Profile):
+        with self._lock:
+            profile.threads.pop(threading.get_ident(), None)
+
+    def snapshot(self, profile: Profile) -> tuple:
+        """Returns a copy of the profile's stack counts and its sample count, taken between two samples."""
+        with self._lock:
+            return Counter(profile.stacks), profile.samples
+
+    def _run(self):
+        while True:
+            with self._lock:
+                if not self._profiles:
+                    self._thread = None
+                    return
+                targets = [(profile, dict(profile.threads)) for profile in self._profiles]
+            frames = sys._current_frames()
+            sampled = [
+                (profile, [_collapse(frames[thread_id], label) for thread_id, label in threads.items() if thread_id in frames])
+                for profile, threads in targets
+            ]
+            del frames
+            # Stacks are collapsed outside the lock; only the counter updates hold it, so a
+            # snapshot never sees a Counter half-way through a sample.
+            with self._lock:
+                for profile, stacks in sampled:
+                    profile.samples += 1
+                    profile.stacks.update(stacks)
+            time.sleep(PROFILE_INTERVAL)
+
+_sampler = _Sampler()
+
+# --- 3. Hooks ---
+
+@contextlib.contextmanager
+def profiling(trace_id: str | None):
+    """
+    Profiles the work done under this block (and in threads registered with `profiled`)
+    and writes it to PROFILE_DIR/<trace_id>.collapsed, a collapsed-stack file that
+    speedscope and flamegraph.pl open directly. Does nothing when `trace_id` is None.
+    """
+    if trace_id is None:
+        yield
+        return
+    profile = Profile(trace_id)
+    token = _current_profile.set(profile)
+    _sampler.add(profile)
+    try:
+        yield
+    finally:
+        _sampler.remove(profile)
+        _current_profile.reset(token)
+        _save(profile)
+
+@contextlib.contextmanager
+def profile_thread(label: str):
+    """Adds the current thread to the active profile (if any) for the duration of the block."""
+    profile = _current_profile.get()
+    if profile is None:
+        yield
+        return
+    _sampler.register(profile, label)
+    try:
+        yield
+    finally:
+        _sampler.unregister(profile)
+
+def profiled(label: str):
+    """Decorates a graph node so its thread is sampled while the node runs in a profiled request."""
+    def decorator(fn):
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            if _current_profile.get() is None:
+                return fn(*args, **kwargs)
+            with profile_thread(f"node:{label}"):
+                return fn(*args, **kwargs)
+        return wrapper
+    return decorator
+
+def _save(profile: Profile):
+    # The sampler may be mid-sample for this profile even after `remove`, so serialize a copy.
+    stacks, samples = _sampler.snapshot(profile)
+    try:
+        os.makedirs(PROFILE_DIR, exist_ok=True)
+        with open(profile_path(profile.trace_id), "w", encoding="utf-8") as f:
+            f.writelines(f"{stack} {count}\n" for stack, count in stacks.most_common())
+        saved = sorted(
+            (os.path.join(PROFILE_DIR, name) for name in os.listdir(PROFILE_DIR) if name.endswith(".collapsed")),
+            key=os.path.getmtime,
+        )
+        for path in saved[:-PROFILE_MAX_FILES]:
+            os.remove(path)
+        logging.info(
+            f"Saved profile {profile.trace_id}: {samples} samples over "
+            f"{time.perf_counter() - profile.started:.2f}s."
+        )
+    except OSError as e:
+        logging.warning(f"Could not save profile {profile.trace_id}: {e}")
+
+def list_profiles() -> list:
+    if not os.path.isdir(PROFILE_DIR):
+        return []
+    names = [name for name in os.listdir(PROFILE_DIR) if name.endswith(".collapsed")]
+    names.sort(key=lambda name: os.path.getmtime(os.path.join(PROFILE_DIR, name)), reverse=True)
+    return [name.removesuffix(".collapsed") for name in names]
@@ -0,0 +1,143 @@
+import logging
+import os
+import threading
+import time
+import uuid
+from collections import OrderedDict
+
+import numpy as np
+import pandas as pd
+
+# --- 1. Configuration ---
+# Memory budget for cached query results; least recently used results are evicted first.
+RESULT_STORE_MAX_MB = float(os.getenv("RESULT_STORE_MAX_MB", "1024"))
+# How long (seconds) an unused result is kept, e.g. for follow-up questions.
+RESULT_STORE_TTL = float(os.getenv("RESULT_STORE_TTL", "1800"))
+
+# Text columns that repeat a small set of values and are always dictionary-encoded.
+DICTIONARY_COLUMNS = {"region", "province", "contractor", "implementing_office", "municipality", "type_of_work"}
+# Other text columns are dictionary-encoded when distinct values are at most this share of rows.
+DICTIONARY_MAX_RATIO = 0.5
+
+def _smallest_code_dtype(n_categories: int):
+    for dtype in (np.int8, np.int16, np.int32):
+        if n_categories < np.iinfo(dtype).max:
+            return dtype
+    return np.int64
+
+def _read_only(values: np.ndarray) -> np.ndarray:
+    values.flags.writeable = False
+    return values
+
+# --- 2. Compact Result ---
+class CompactResult:
+    """
+    A query result held as flat, read-only column buffers: numeric columns as NumPy
+    arrays and repetitive text columns as integer codes plus one copy of each value.
+    `view()` wraps the buffers in a DataFrame without copying them; writing into the
+    view raises, so nodes derive new frames instead of modifying the shared result.
+    """
+    def __init__(self, df: pd.DataFrame):
+        self.names = list(df.columns)
+        self.rows = len(df)
+        self.columns = []
+        for position in range(df.shape[1]):
+            series = df.iloc[:, position]
+            name = str(self.names[position])
+            if isinstance(series.dtype, pd.CategoricalDtype):
+                codes = series.cat.codes.to_numpy().astype(_smallest_code_dtype(len(series.cat.categories)))
+                self.columns.append(("category", _read_only(codes), series.cat.categories))
+            elif series.dtype != object and pd.api.types.is_numeric_dtype(series.dtype):
+                # Copy so the buffer does not keep the source DataFrame's 2-D block alive.
+                self.columns.append(("numeric", _read_only(series.to_numpy().copy()), None))
+            elif self._should_encode(name, series):
+                codes, uniques = pd.factorize(series, use_na_sentinel=True)
+                codes = codes.astype(_smallest_code_dtype(len(uniques)))
+                self.columns.append(("category", _read_only(codes), pd.Index(uniques, dtype=object)))
+            else:
+                self.columns.append(("object", _read_only(series.to_numpy(dtype=object).copy()), None))
+        self.nbytes = sum(self._column_nbytes(col) for col in self.columns)
+
+    @staticmethod
+    def _should_encode(name: str, series: pd.Series) -> bool:
+        if pd.api.types.infer_dtype(series, skipna=True) != "string":
+            return False
+        if name.lower() in DICTIONARY_COLUMNS:
+            return True
+        return len(series) > 0 and series.nunique(dropna=True) <= DICTIONARY_MAX_RATIO * len(series)
+
+    @staticmethod
+    def _column_nbytes(column) -> int:
+        kind, values, categories = column
+        if kind == "numeric":
+            return values.nbytes
+        if kind == "category":
+            return values.nbytes + sum(len(str(c)) + 49 for c in categories)
+        # Object columns hold pointers to Python strings; count the strings too.
+        return values.nbytes + sum(len(v) + 49 for v in values if isinstance(v, str))
+
+    def view(self) -> pd.DataFrame:
+        data = {}
+        for position, (kind, values, categories) in enumerate(self.columns):
+            if kind == "category":
+                values = pd.Categorical.from_codes(values, dtype=pd.CategoricalDtype(categories))
+            data[position] = values
+        # copy=False keeps one block per column, so no buffer is copied or consolidated.
+        df = pd.DataFrame(data, index=pd.RangeIndex(self.rows), copy=False)
+        df.columns = self.names
+        return df
+
+# --- 3. Result Store ---
+class ResultStore:
+    """Holds compact results by ID under a memory budget, evicting the least recently used."""
+    def __init__(self, max_bytes: float, ttl: float):
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._results = OrderedDict()
+        self._bytes = 0
+
+    def _evict(self):
+        now = time.monotonic()
+        while self._results:
+            result_id, (result, touched) = next(iter(self._results.items()))
+            # The newest result is always kept, even if it alone exceeds the budget.
+            over_budget = self._bytes > self.max_bytes and len(self._results) > 1
+            if not over_budget and touched + self.ttl >= now:
+                break
+            self._results.popitem(last=False)
+            self._bytes -= result.nbytes
+            logging.info(f"Evicted cached result {result_id} ({result.nbytes} bytes).")
+
+    def put(self, df: pd.DataFrame) -> str:
+        """Stores a compact copy of `df` and returns its ID; the caller can drop `df`."""
+        result = CompactResult(df)
+        result_id = uuid.uuid4().hex
+        with self._lock:
+            self._results[result_id] = (result, time.monotonic())
+            self._bytes += result.nbytes
+            self._evict()
+        return result_id
+
+    def view(self, result_id: str | None) -> pd.DataFrame | None:
+        """Returns a read-only, zero-copy DataFrame over a stored result, or None if it is gone."""
+        if not result_id:
+            return None
+        with self._lock:
+            entry = self._results.get(result_id)
+            if entry is None:
+                return None
+            self._results[result_id] = (entry[0], time.monotonic())
+            self._results.move_to_end(result_id)
+        return entry[0].view()
+
+    def clear(self):
+        with self._lock:
+            self._results.clear()
+            self._bytes = 0
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {"results": len(self._results), "bytes": self._bytes, "max_bytes": int(self.max_bytes)}
+
+result_store = ResultStore(RESULT_STORE_MAX_MB * 1024 * 1024, RESULT_STORE_TTL)
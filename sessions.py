@@ -0,0 +1,94 @@
+import hashlib
+import os
+import threading
+import time
+from collections import OrderedDict
+
+from singleflight import normalize_question
+
+# --- 1. Configuration ---
+# How long (seconds) an idle session keeps its last result for follow-up questions.
+SESSION_TTL = float(os.getenv("SESSION_TTL", "1800"))
+# Maximum number of sessions (and cached results) kept in memory; least recently used go first.
+SESSION_MAX_ENTRIES = int(os.getenv("SESSION_MAX_ENTRIES", "500"))
+
+def context_key(previous_key: str, question: str) -> str:
+    """
+    Identifies the result of asking `question` on top of the context `previous_key`.
+    It doubles as the single-flight key: identical questions only share a run when
+    they follow the same previous result.
+    """
+    return hashlib.sha1(f"{previous_key}\n{normalize_question(question)}".encode("utf-8")).hexdigest()
+
+# --- 2. Session Store ---
+class SessionStore:
+    """
+    Keeps the last answered question, its validated SQL and its result per session.
+    Results are stored once under their context key and sessions point at them, so
+    coalesced requests from different sessions share one cached result. The rows
+    themselves live in the result store and are referenced by `result_id`.
+    """
+    def __init__(self, ttl: float = SESSION_TTL, max_entries: int = SESSION_MAX_ENTRIES):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self._contexts = OrderedDict()
+        self._sessions = OrderedDict()
+
+    def _evict(self, entries: OrderedDict):
+        now = time.monotonic()
+        while entries and (len(entries) > self.max_entries or next(iter(entries.values()))[1] + self.ttl < now):
+            entries.popitem(last=False)
+
+    @staticmethod
+    def _touch(entries: OrderedDict, key: str, value):
+        entries[key] = (value, time.monotonic())
+        entries.move_to_end(key)
+
+    def publish(self, key: str, context: dict):
+        """Stores the context produced by a run under its context key."""
+        with self._lock:
+            self._touch(self._contexts, key, context)
+            self._evict(self._contexts)
+
+    def attach(self, session_id: str, key: str) -> bool:
+        """Points a session at a published context; returns False if the run left none."""
+        with self._lock:
+            if key not in self._contexts:
+                return False
+            self._touch(self._sessions, session_id, key)
+            self._evict(self._sessions)
+            return True
+
+    def current_key(self, session_id: str | None) -> str:
+        """Returns the context key of the session's last result, or '' if there is none."""
+        if not session_id:
+            return ""
+        with self._lock:
+            self._evict(self._sessions)
+            self._evict(self._contexts)
+            entry = self._sessions.get(session_id)
+            if entry is None or entry[0] not in self._contexts:
+                return ""
+            # Touch both entries so an active conversation is not evicted.
+            self._touch(self._sessions, session_id, entry[0])
+            self._touch(self._contexts, entry[0], self._contexts[entry[0]][0])
+            return entry[0]
+
+    def get(self, key: str | None) -> dict | None:
+        if not key:
+            return None
+        with self._lock:
+            entry = self._contexts.get(key)
+            return entry[0] if entry is not None else None
+
+    def clear(self):
+        with self._lock:
+            self._contexts.clear()
+            self._sessions.clear()
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {"sessions": len(self._sessions), "cached_results": len(self._contexts)}
+
+session_store = SessionStore()
@@ -0,0 +1,76 @@
+import asyncio
+import logging
+import re
+
+import metrics
+
+def normalize_question(question: str) -> str:
+    """Normalizes a question so trivially different phrasings share one execution."""
+    return re.sub(r"\s+", " ", question).strip().lower().rstrip("?.! ")
+
+class _Flight:
+    """The events of one running execution, replayable from the start by any subscriber."""
+    def __init__(self):
+        self.events = []
+        self.done = False
+        self.subscribers = 0
+        self._wakeup = asyncio.Event()
+        self.task = None
+
+    def publish(self, event):
+        self.events.append(event)
+        # Wake every waiting subscriber; each one reads from its own position in `events`.
+        self._wakeup.set()
+        self._wakeup = asyncio.Event()
+
+    def close(self):
+        self.done = True
+        self._wakeup.set()
+
+    async def subscribe(self):
+        position = 0
+        while True:
+            while position < len(self.events):
+                yield self.events[position]
+                position += 1
+            if self.done:
+                return
+            await self._wakeup.wait()
+
+class SingleFlight:
+    """
+    Coalesces concurrent identical requests onto one producer.
+    The producer runs as its own task and never waits for subscribers, so a slow
+    client only delays itself. Late joiners first replay the events already emitted.
+    Once the execution finishes, the next request with the same key starts a new one.
+    """
+    def __init__(self, name: str):
+        self.name = name
+        self._flights = {}
+
+    def subscribe(self, key: str, producer_factory):
+        flight = self._flights.get(key)
+        if flight is None:
+            flight = _Flight()
+            self._flights[key] = flight
+            flight.task = asyncio.create_task(self._run(key, flight, producer_factory))
+            metrics.increment(f"{self.name}.executions")
+        else:
+            logging.info(f"Joining in-flight execution for: {key!r}")
+            metrics.increment(f"{self.name}.coalesced")
+        flight.subscribers += 1
+        return flight.subscribe()
+
+    async def _run(self, key: str, flight: _Flight, producer_factory):
+        try:
+            async for event in producer_factory():
+                flight.publish(event)
+        except Exception as e:
+            logging.error(f"Single-flight producer failed for {key!r}: {e}")
+        finally:
+            flight.close()
+            if self._flights.get(key) is flight:
+                del self._flights[key]
+
+    def in_flight(self) -> int:
+        return len(self._flights)
@@ -0,0 +1,102 @@
+import logging
+import os
+
+import pandas as pd
+from pandas.api.types import union_categoricals
+
+from result_store import DICTIONARY_COLUMNS, DICTIONARY_MAX_RATIO
+
+# --- 1. Configuration ---
+# In-memory size at which a query result is cut off and flagged as truncated.
+SQL_RESULT_BYTE_BUDGET = int(float(os.getenv("SQL_RESULT_BUDGET_MB", "128")) * 1024 * 1024)
+# Rows pulled from the cursor per chunk; each chunk is downcast before the next is fetched.
+SQL_FETCH_CHUNK_ROWS = int(os.getenv("SQL_FETCH_CHUNK_ROWS", "20000"))
+
+# --- 2. Downcasting ---
+
+def _is_dictionary_column(name: str, series: pd.Series) -> bool:
+    if pd.api.types.infer_dtype(series, skipna=True) != "string":
+        return False
+    if str(name).lower() in DICTIONARY_COLUMNS:
+        return True
+    return len(series) > 0 and series.nunique(dropna=True) <= DICTIONARY_MAX_RATIO * len(series)
+
+def _downcast_numeric(series: pd.Series) -> pd.Series:
+    # Floats stay float64: even when each value fits float32, sums and means over the column
+    # would be computed in float32 and drift by thousands of pesos on contract totals.
+    # Reductions over small integer dtypes are accumulated in int64, so integers are safe.
+    if pd.api.types.is_integer_dtype(series.dtype):
+        return pd.to_numeric(series, downcast="integer")
+    return series
+
+def downcast_chunk(chunk: pd.DataFrame, dictionary_positions: set) -> pd.DataFrame:
+    """Turns the text columns at the given positions into categoricals and integer columns into their smallest dtype."""
+    columns = {}
+    for position in range(chunk.shape[1]):
+        series = chunk.iloc[:, position]
+        if position in dictionary_positions:
+            series = series.astype("category")
+        elif series.dtype != object and pd.api.types.is_numeric_dtype(series.dtype) and not pd.api.types.is_bool_dtype(series.dtype):
+            series = _downcast_numeric(series)
+        columns[position] = series
+    downcast = pd.concat(columns, axis=1, copy=False)
+    downcast.columns = chunk.columns
+    return downcast
+
+def _concat_chunks(chunks: list, columns: pd.Index) -> pd.DataFrame:
+    """Concatenates chunks column by column, merging the chunks' categories instead of falling back to object."""
+    if len(chunks) == 1:
+        return chunks[0]
+    merged = {}
+    for position in range(len(columns)):
+        parts = [chunk.iloc[:, position] for chunk in chunks]
+        try:
+            if all(isinstance(part.dtype, pd.CategoricalDtype) for part in parts):
+                merged[position] = pd.Series(union_categoricals(parts))
+                continue
+        except TypeError:
+            # Categories of different types (e.g. numbers in a later chunk): keep plain objects.
+            parts = [part.astype(object) for part in parts]
+        merged[position] = pd.concat(parts, ignore_index=True)
+    df = pd.concat(merged, axis=1, copy=False)
+    df.columns = columns
+    return df
+
+# --- 3. Bounded Fetch ---
+
+def read_sql_bounded(sql: str, engine, byte_budget: int = SQL_RESULT_BYTE_BUDGET, chunk_rows: int = SQL_FETCH_CHUNK_ROWS) -> tuple:
+    """
+    Reads a query result in chunks of `chunk_rows`, downcasting each chunk as it arrives,
+    and stops once the result would exceed `byte_budget` bytes in memory.
+    Returns (DataFrame, truncated).
+    """
+    chunks, used, truncated = [], 0, False
+    dictionary_positions = None
+    reader = pd.read_sql(sql, engine, chunksize=chunk_rows)
+    try:
+        for chunk in reader:
+            if dictionary_positions is None:
+                # Decided on the first chunk so every chunk gets the same column types.
+                dictionary_positions = {
+                    position for position, name in enumerate(chunk.columns)
+                    if _is_dictionary_column(name, chunk.iloc[:, position])
+                }
+            chunk = downcast_chunk(chunk, dictionary_positions)
+            size = int(chunk.memory_usage(index=False, deep=True).sum())
+            if used + size > byte_budget:
+                # Keep the rows that still fit, then stop reading.
+                chunks.append(chunk.iloc[:int(len(chunk) * (byte_budget - used) / size)])
+                truncated = True
+                break
+            chunks.append(chunk)
+            used += size
+    finally:
+        # Closing the reader releases the cursor (and its connection) on an early stop.
+        reader.close()
+
+    if not chunks:
+        return pd.DataFrame(), truncated
+    df = _concat_chunks(chunks, chunks[0].columns)
+    if truncated:
+        logging.warning(f"Query result truncated at {len(df):,} rows by the {byte_budget / 1e6:.0f} MB result budget.")
+    return df, truncated
@@ -102,6 +102,8 @@ function resetResults() {
     $('#results-table').empty();
   }
   document.getElementById('viz-rec').textContent = "";
+  document.getElementById('export-links').classList.add('hidden');
+  document.getElementById('truncated-note').classList.add('hidden');
 
   const plotlyChartDiv = document.getElementById('plotly-chart');
   if (plotlyChartDiv.data) { // Check if a plot exists before purging
@@ -111,6 +113,14 @@ function resetResults() {
   document.getElementById('explain-content').textContent = "";
 }
 
+// Links to stream every row of the answer's query, not just what the table received.
+function showExportLinks(exportId) {
+  if (!exportId) return;
+  document.getElementById('export-csv').href = `/export/${exportId}?format=csv`;
+  document.getElementById('export-ndjson').href = `/export/${exportId}?format=ndjson`;
+  document.getElementById('export-links').classList.remove('hidden');
+}
+
 function submitQuery() {
   const question = document.getElementById('query-input').value;
   if (!question.trim()) {
@@ -133,6 +143,16 @@ function runPendingQuery() {
   }
 }
 
+// One conversation per browser tab, so follow-up questions can build on the last result.
+function getSessionId() {
+  let sessionId = sessionStorage.getItem('floodgptSessionId');
+  if (!sessionId) {
+    sessionId = (window.crypto && crypto.randomUUID) ? crypto.randomUUID() : String(Date.now()) + Math.random().toString(16).slice(2);
+    sessionStorage.setItem('floodgptSessionId', sessionId);
+  }
+  return sessionId;
+}
+
 function runAgent(question, token, honeypot) {
   const submitBtn = document.getElementById('submit-btn');
   const loadingOverlay = document.getElementById('loading-overlay');
@@ -150,7 +170,8 @@ function runAgent(question, token, honeypot) {
       },
       body: JSON.stringify({
         question: question,
-        honeypot: honeypot
+        honeypot: honeypot,
+        session_id: getSessionId()
       }),
     })
     .then(response => {
@@ -189,14 +210,15 @@ function runAgent(question, token, honeypot) {
                   data: nodeOutput 
                 } = parsedEvent;
 
-                if (nodeName === 'validate_question' && nodeOutput.error === 'Unsupported question') {
+                // In combined mode 'plan_sql' checks the question instead of 'validate_question'.
+                if ((nodeName === 'validate_question' || nodeName === 'plan_sql') && nodeOutput.error === 'Unsupported question') {
                   loadingStatusText.textContent = 'Your question is not supported. Please ask questions related to flood control projects.';
                   submitBtn.disabled = false;
                   submitBtn.classList.remove('opacity-50', 'cursor-not-allowed');
                   loadingOverlay.classList.add('hidden');
                   return;
                 }
-                 if (nodeName === 'validate_question' && nodeOutput.error) {
+                 if ((nodeName === 'validate_question' || nodeName === 'plan_sql') && nodeOutput.error) {
                     loadingStatusText.textContent = nodeOutput.error;
                     submitBtn.disabled = false;
                     submitBtn.classList.remove('opacity-50', 'cursor-not-allowed');
@@ -204,12 +226,26 @@ function runAgent(question, token, honeypot) {
                     return;
                 }
 
-                if (nodeName === 'validate_sql') {
+                if (nodeName === 'followup' && nodeOutput.followup === 'local') {
+                  loadingStatusText.textContent = 'Refining the previous results 🔎...';
+                  document.getElementById('sql-query').textContent = nodeOutput.validated_sql;
+                  renderDataTable(nodeOutput.sql_dataframe);
+                  showExportLinks(nodeOutput.export_id);
+                } else if (nodeName === 'followup' && nodeOutput.followup === 'sql') {
+                  loadingStatusText.textContent = 'Refining the previous query 🔎...';
+                  document.getElementById('sql-query').textContent = nodeOutput.validated_sql || nodeOutput.generated_sql;
+                } else if (nodeName === 'plan_sql') {
+                  loadingStatusText.textContent = 'Writing the data query 🧐...';
+                  document.getElementById('sql-query').textContent = nodeOutput.validated_sql || nodeOutput.generated_sql;
+                } else if (nodeName === 'validate_sql') {
                   loadingStatusText.textContent = 'Checking the data query 🧐...';
                   document.getElementById('sql-query').textContent = nodeOutput.validated_sql;
                 } else if (nodeName === 'execute_sql') {
                   loadingStatusText.textContent = 'Retrieving data 💾...';
                   renderDataTable(nodeOutput.sql_dataframe);
+                  showExportLinks(nodeOutput.export_id);
+                  // The result hit the server's memory budget; the export links still return every row.
+                  document.getElementById('truncated-note').classList.toggle('hidden', !nodeOutput.truncated);
                 } else if (nodeName === 'visualizer') {
                   loadingStatusText.textContent = 'Designing the chart 🎨...';
                 } else if (nodeName === 'formatter') {
@@ -320,6 +356,25 @@ function runAgent(question, token, honeypot) {
 //   }
 // }
 
+// Typed arrays sent as {bdata, dtype} (see chart_encoding.py). Plotly reads these directly;
+// they only need decoding here for dictionary-encoded label codes.
+const TYPED_ARRAYS = {
+  i1: Int8Array, u1: Uint8Array, i2: Int16Array, u2: Uint16Array,
+  i4: Int32Array, u4: Uint32Array, f4: Float32Array, f8: Float64Array
+};
+
+function decodeTypedArray(spec) {
+  const binary = atob(spec.bdata);
+  const bytes = new Uint8Array(binary.length);
+  for (let i = 0; i < binary.length; i++) bytes[i] = binary.charCodeAt(i);
+  return new TYPED_ARRAYS[spec.dtype](bytes.buffer);
+}
+
+function decodeChartLabels(labels) {
+  if (!labels || Array.isArray(labels) || !labels.codes) return labels;
+  return Array.from(decodeTypedArray(labels.codes), code => labels.dict[code]);
+}
+
 function renderPlotly(chartJsonWrapper) {
   let chartJson = chartJsonWrapper?.formatted_data_for_visualization || chartJsonWrapper;
   if (chartJson.formatted_data_for_visualization) chartJson = chartJson.formatted_data_for_visualization;
@@ -338,6 +393,10 @@ function renderPlotly(chartJsonWrapper) {
     orientation = 'h';
   }
 
+  if (chartJson.data) {
+    chartJson.data.labels = decodeChartLabels(chartJson.data.labels);
+  }
+
   if (!chartJson.data || !Array.isArray(chartJson.data.labels) || !Array.isArray(chartJson.data.values)) {
     document.getElementById('plotly-chart').innerHTML =
       "<p class='text-red-400 text-center mt-20'>Invalid chart data format.</p>";
@@ -369,11 +428,14 @@ function renderPlotly(chartJsonWrapper) {
     }];
   } else {
     chartJson.data.values.forEach((series, idx) => {
+      // Binary scatter series carry their own numeric x values instead of string labels.
+      const categories = series.x || chartJson.data.labels;
       const trace = {
-        x: orientation === 'v' ? chartJson.data.labels : series.data,
-        y: orientation === 'v' ? series.data : chartJson.data.labels,
+        x: orientation === 'v' ? categories : series.data,
+        y: orientation === 'v' ? series.data : categories,
         name: series.label || `Series ${idx + 1}`,
         type: type,
+        mode: series.x ? 'markers' : undefined,
         orientation: orientation,
         marker: {
           color: tableauColors[idx % tableauColors.length],
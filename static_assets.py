@@ -0,0 +1,216 @@
+import asyncio
+import gzip
+import hashlib
+import logging
+import mimetypes
+import os
+import re
+import threading
+
+from fastapi import Request
+from fastapi.responses import Response
+
+try:
+    import brotli
+except ImportError:  # Optional: without it only gzip variants are served.
+    brotli = None
+
+# --- 1. Configuration ---
+STATIC_DIR = "static"
+INDEX_HTML = "floodgpt.html"
+# Content-hashed assets never change under their URL, so browsers may cache them for a year.
+IMMUTABLE_CACHE_CONTROL = "public, max-age=31536000, immutable"
+# JSON responses at least this large are gzip-compressed when the client accepts it.
+JSON_GZIP_MIN_BYTES = int(os.getenv("JSON_GZIP_MIN_BYTES", "1024"))
+# How often (seconds) to check static/ for edited files and rebuild the manifest. 0 builds it
+# once at startup, which is what production wants; set it while developing the front end.
+STATIC_RELOAD_SECONDS = float(os.getenv("STATIC_RELOAD_SECONDS", "0"))
+
+# --- 2. Precompressed Variants ---
+
+def _variants(body: bytes) -> dict:
+    """Returns the identity body plus every compressed encoding that is actually smaller."""
+    variants = {"identity": body}
+    compressed = {"gzip": gzip.compress(body, compresslevel=9, mtime=0)}
+    if brotli is not None:
+        compressed["br"] = brotli.compress(body, quality=11)
+    for encoding, data in compressed.items():
+        if len(data) < len(body):
+            variants[encoding] = data
+    return variants
+
+def accepted_encodings(header: str) -> dict:
+    """Parses an Accept-Encoding header into {encoding: q-value}; q=0 marks a refused encoding."""
+    accepted = {}
+    for item in header.split(","):
+        encoding, *params = [part.strip() for part in item.split(";")]
+        if not encoding:
+            continue
+        q = 1.0
+        for param in params:
+            name, _, value = param.partition("=")
+            if name.strip().lower() == "q":
+                try:
+                    q = float(value.strip())
+                except ValueError:
+                    q = 0.0
+        accepted[encoding.lower()] = q
+    return accepted
+
+def _negotiate(request: Request, variants: dict) -> str:
+    accepted = accepted_encodings(request.headers.get("accept-encoding", ""))
+    wildcard = accepted.get("*", 0.0)
+    # The highest q-value wins; on a tie brotli is preferred, as it is the smaller variant.
+    candidates = [
+        (accepted.get(encoding, wildcard), -rank, encoding)
+        for rank, encoding in enumerate(("br", "gzip"))
+        if encoding in variants
+    ]
+    q, _, encoding = max(candidates, default=(0.0, 0, "identity"))
+    return encoding if q > 0 else "identity"
+
+def _variant_response(request: Request, variants: dict, media_type: str, headers: dict) -> Response:
+    encoding = _negotiate(request, variants)
+    headers = {**headers, "Vary": "Accept-Encoding"}
+    if encoding != "identity":
+        headers["Content-Encoding"] = encoding
+    return Response(variants[encoding], media_type=media_type, headers=headers)
+
+# --- 3. Asset Manifest ---
+class StaticAssets:
+    """
+    Serves the files under `static/` at content-hashed URLs (e.g. /assets/js/script.3f9c2a1b7d4e.js)
+    with precompressed gzip/brotli variants, and the index page with those URLs and an ETag.
+    The manifest is built at startup; with STATIC_RELOAD_SECONDS set, `watch` rebuilds it when a
+    file's modification time changes, so edits show up without a restart.
+    """
+    def __init__(self, static_dir: str = STATIC_DIR, index_html: str = INDEX_HTML):
+        self.static_dir = static_dir
+        self.index_html = index_html
+        self._lock = threading.Lock()
+        self._mtimes = None
+        self._assets = {}
+        self._urls = {}
+        self._index = None
+
+    def _scan_mtimes(self) -> dict:
+        mtimes = {self.index_html: os.path.getmtime(self.index_html)}
+        for root, _, files in os.walk(self.static_dir):
+            for name in files:
+                path = os.path.join(root, name)
+                mtimes[path] = os.path.getmtime(path)
+        return mtimes
+
+    def _build(self, mtimes: dict):
+        assets, urls = {}, {}
+        for path in mtimes:
+            if path == self.index_html:
+                continue
+            with open(path, "rb") as f:
+                body = f.read()
+            relative = os.path.relpath(path, self.static_dir).replace(os.sep, "/")
+            stem, ext = os.path.splitext(relative)
+            hashed = f"{stem}.{hashlib.sha256(body).hexdigest()[:12]}{ext}"
+            media_type = mimetypes.guess_type(path)[0] or "application/octet-stream"
+            assets[hashed] = (media_type, _variants(body))
+            urls[f"/static/{relative}"] = f"/assets/{hashed}"
+
+        with open(self.index_html, encoding="utf-8") as f:
+            html = f.read()
+        # Point the page at the hashed URLs; external CDN links are left alone.
+        html = re.sub(r'(?<=["\'])/static/[^"\']+(?=["\'])', lambda m: urls.get(m.group(0), m.group(0)), html)
+        body = html.encode("utf-8")
+        etag = f'"{hashlib.sha256(body).hexdigest()[:16]}"'
+        self._assets, self._urls, self._index = assets, urls, (etag, _variants(body))
+        logging.info(f"Built static asset manifest with {len(assets)} files.")
+
+    def refresh(self):
+        mtimes = self._scan_mtimes()
+        with self._lock:
+            if mtimes != self._mtimes:
+                self._build(mtimes)
+                self._mtimes = mtimes
+
+    async def watch(self, interval: float = STATIC_RELOAD_SECONDS):
+        """Checks the files for changes every `interval` seconds, off the event loop."""
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                await asyncio.to_thread(self.refresh)
+            except OSError as e:
+                logging.warning(f"Could not rebuild the static asset manifest: {e}")
+
+    def _ensure_built(self):
+        if self._index is None:
+            self.refresh()
+
+    def asset_response(self, request: Request, hashed_path: str) -> Response:
+        self._ensure_built()
+        asset = self._assets.get(hashed_path)
+        if asset is None:
+            return Response(status_code=404)
+        media_type, variants = asset
+        return _variant_response(request, variants, media_type, {"Cache-Control": IMMUTABLE_CACHE_CONTROL})
+
+    def index_response(self, request: Request) -> Response:
+        self._ensure_built()
+        etag, variants = self._index
+        # The page must be revalidated each time, but an unchanged page costs only a 304.
+        headers = {"ETag": etag, "Cache-Control": "no-cache"}
+        if_none_match = request.headers.get("if-none-match", "")
+        if etag in [tag.strip().removeprefix("W/") for tag in if_none_match.split(",")]:
+            return Response(status_code=304, headers=headers)
+        return _variant_response(request, variants, "text/html; charset=utf-8", headers)
+
+# --- 4. JSON Compression Middleware ---
+class JSONCompressionMiddleware:
+    """
+    Gzips single-body `application/json` responses of at least JSON_GZIP_MIN_BYTES.
+    Streaming responses (SSE, NDJSON, exports) pass through untouched so they are never buffered.
+    """
+    def __init__(self, app, minimum_size: int = JSON_GZIP_MIN_BYTES):
+        self.app = app
+        self.minimum_size = minimum_size
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        accept_encoding = dict(scope["headers"]).get(b"accept-encoding", b"").decode("latin-1")
+        accepted = accepted_encodings(accept_encoding)
+        if accepted.get("gzip", accepted.get("*", 0.0)) <= 0:
+            await self.app(scope, receive, send)
+            return
+
+        start_message = None
+
+        async def send_wrapper(message):
+            nonlocal start_message
+            if message["type"] == "http.response.start":
+                headers = dict(message.get("headers", []))
+                content_type = headers.get(b"content-type", b"")
+                if content_type.startswith(b"application/json") and b"content-encoding" not in headers:
+                    # Hold the start message until we know whether the body is worth compressing.
+                    start_message = message
+                    return
+                await send(message)
+            elif start_message is not None:
+                start, start_message = start_message, None
+                body = message.get("body", b"")
+                if message.get("more_body") or len(body) < self.minimum_size:
+                    await send(start)
+                    await send(message)
+                    return
+                compressed = gzip.compress(body, compresslevel=6)
+                headers = [(k, v) for k, v in start.get("headers", []) if k not in (b"content-length", b"vary")]
+                headers += [
+                    (b"content-encoding", b"gzip"),
+                    (b"content-length", str(len(compressed)).encode()),
+                    (b"vary", b"Accept-Encoding"),
+                ]
+                await send({**start, "headers": headers})
+                await send({**message, "body": compressed})
+            else:
+                await send(message)
+
+        await self.app(scope, receive, send_wrapper)
@@ -0,0 +1,158 @@
+import os
+import re
+
+import numpy as np
+import pandas as pd
+
+# --- 1. Configuration ---
+# Upper bound on the digest's length in characters (~4 characters per token).
+SUMMARY_MAX_CHARS = int(os.getenv("SUMMARY_MAX_CHARS", "4000"))
+# Results with at most this many rows are shown in full, ahead of the statistics.
+SUMMARY_FULL_ROWS = int(os.getenv("SUMMARY_FULL_ROWS", "20"))
+SUMMARY_TOP_K = 5
+SUMMARY_MAX_OUTLIERS = 5
+
+# Column names that usually hold the measure the question is about.
+METRIC_NAME_PATTERN = re.compile(r"cost|amount|budget|total|sum|value|price|avg|average", re.IGNORECASE)
+
+def _fmt(value) -> str:
+    if value is None or (isinstance(value, float) and np.isnan(value)):
+        return "n/a"
+    if isinstance(value, (int, np.integer)):
+        return f"{value:,}"
+    if isinstance(value, (float, np.floating)):
+        return f"{value:,.2f}"
+    return str(value)
+
+def _numeric_columns(df: pd.DataFrame) -> list:
+    return [c for c in df.select_dtypes(include="number").columns if not pd.api.types.is_bool_dtype(df[c])]
+
+def _year_column(df: pd.DataFrame, numeric: list):
+    for col in numeric:
+        if "year" in str(col).lower():
+            values = df[col].dropna()
+            if not values.empty and values.between(1900, 2100).all():
+                return col
+    return None
+
+def _primary_metric(numeric: list, year_col):
+    measures = [c for c in numeric if c != year_col and not str(c).lower().endswith("_id")]
+    if not measures:
+        return None
+    return next((c for c in measures if METRIC_NAME_PATTERN.search(str(c))), measures[0])
+
+# --- 2. Digest Sections ---
+
+def _overview(df: pd.DataFrame) -> str:
+    columns = ", ".join(f"{c} ({df[c].dtype})" for c in df.columns)
+    return f"Rows: {len(df):,}\nColumns: {columns}"
+
+def _numeric_stats(df: pd.DataFrame, measures: list) -> str:
+    if not measures:
+        return ""
+    frame = df[measures]
+    quantiles = frame.quantile([0.25, 0.5, 0.75])
+    stats = pd.DataFrame({
+        "total": frame.sum(), "mean": frame.mean(), "min": frame.min(),
+        "p25": quantiles.loc[0.25], "median": quantiles.loc[0.5], "p75": quantiles.loc[0.75],
+        "max": frame.max(), "missing": frame.isna().sum(),
+    })
+    lines = [
+        f"- {col}: " + ", ".join(
+            f"{name}={_fmt(int(value) if name == 'missing' else value)}" for name, value in row.items()
+        )
+        for col, row in stats.iterrows()
+    ]
+    return "Numeric columns:\n" + "\n".join(lines)
+
+def _category_stats(df: pd.DataFrame, metric) -> str:
+    lines = []
+    for col in df.columns:
+        series = df[col]
+        if not (isinstance(series.dtype, pd.CategoricalDtype) or series.dtype == object):
+            continue
+        distinct = series.nunique(dropna=True)
+        # Identifier-like columns (every value distinct) carry no distribution to report.
+        if distinct == 0 or (distinct == len(series) and len(series) > SUMMARY_TOP_K):
+            continue
+        counts = series.value_counts(normalize=True, dropna=True).head(SUMMARY_TOP_K)
+        top = ", ".join(f"{value} ({share:.1%} of rows)" for value, share in counts.items())
+        lines.append(f"- {col}: {distinct:,} distinct; most frequent: {top}")
+        if metric is not None:
+            totals = df.groupby(series, observed=True, sort=False)[metric].sum()
+            grand_total = totals.sum()
+            if grand_total:
+                shares = (totals.nlargest(SUMMARY_TOP_K) / grand_total).items()
+                lines.append(f"  largest by {metric}: " + ", ".join(f"{value} ({share:.1%})" for value, share in shares))
+    return "Text columns:\n" + "\n".join(lines) if lines else ""
+
+def _year_trend(df: pd.DataFrame, year_col, metric) -> str:
+    if year_col is None or metric is None:
+        return ""
+    by_year = df.groupby(year_col, sort=True)[metric].sum()
+    if len(by_year) < 2:
+        return ""
+    deltas = by_year.pct_change()
+    lines = [
+        f"- {int(year)}: {_fmt(total)}" + ("" if np.isnan(delta) else f" ({delta:+.1%} vs previous year)")
+        for (year, total), delta in zip(by_year.items(), deltas)
+    ]
+    return f"{metric} by {year_col}:\n" + "\n".join(lines)
+
+def _outliers(df: pd.DataFrame, metric) -> str:
+    if metric is None or len(df) < 10:
+        return ""
+    values = df[metric].astype(float).reset_index(drop=True)
+    median = values.median()
+    mad = (values - median).abs().median()
+    if not mad or np.isnan(mad):
+        return ""
+    # Robust z-score: 0.6745 scales the MAD to a standard deviation for normal data.
+    scores = 0.6745 * (values - median) / mad
+    flagged = scores[scores.abs() > 3.5].abs().nlargest(SUMMARY_MAX_OUTLIERS).index
+    if len(flagged) == 0:
+        return ""
+    return (
+        f"Outlier rows by {metric} ({int((scores.abs() > 3.5).sum()):,} in total, median {_fmt(median)}):\n"
+        + df.iloc[flagged].to_string(index=False)
+    )
+
+# --- 3. Digest ---
+
+def summarize_result(df: pd.DataFrame, max_chars: int = SUMMARY_MAX_CHARS) -> str:
+    """
+    Builds a compact digest of a query result for LLM prompts: size, numeric statistics,
+    category distributions, year-over-year changes and outliers. Small results are shown
+    in full. Sections are added in priority order until `max_chars` is reached, so the
+    prompt stays the same size however many rows the result has.
+    """
+    if df.empty:
+        return f"The result is empty. Columns: {', '.join(map(str, df.columns))}"
+
+    numeric = _numeric_columns(df)
+    year_col = _year_column(df, numeric)
+    metric = _primary_metric(numeric, year_col)
+    measures = [c for c in numeric if c != year_col]
+
+    sections = [_overview(df)]
+    if len(df) <= SUMMARY_FULL_ROWS:
+        sections.append("All rows:\n" + df.to_string(index=False))
+    sections += [
+        _numeric_stats(df, measures) if len(df) > 1 else "",
+        _year_trend(df, year_col, metric),
+        _category_stats(df, metric),
+        _outliers(df, metric),
+    ]
+    if len(df) > SUMMARY_FULL_ROWS:
+        sections.append("First rows:\n" + df.head(SUMMARY_TOP_K).to_string(index=False))
+
+    digest = ""
+    for section in filter(None, sections):
+        candidate = f"{digest}\n\n{section}" if digest else section
+        if len(candidate) > max_chars:
+            remaining = max_chars - len(digest) - 20
+            if remaining > 200:
+                digest = f"{candidate[:len(digest) + remaining]}\n[...truncated]"
+            break
+        digest = candidate
+    return digest
@@ -0,0 +1,84 @@
+import os
+import sqlite3
+import sys
+import unittest
+
+import pandas as pd
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from followup import apply_local_operations, might_refine, operations_to_sql
+from sql_fetch import read_sql_bounded
+
+PREVIOUS_SQL = "SELECT region, contractor, contract_cost, infra_year FROM flood_control_projects"
+
+def _records(df: pd.DataFrame) -> list:
+    return [
+        tuple(None if pd.isna(value) else value for value in row)
+        for row in df.astype(object).itertuples(index=False, name=None)
+    ]
+
+class LocalOperationsMatchSQLTest(unittest.TestCase):
+    def setUp(self):
+        self.conn = sqlite3.connect(":memory:")
+        self.conn.execute(
+            "CREATE TABLE flood_control_projects (region TEXT, contractor TEXT, contract_cost REAL, infra_year INTEGER)"
+        )
+        self.conn.executemany(
+            "INSERT INTO flood_control_projects VALUES (?, ?, ?, ?)",
+            [
+                ("Region IV-A", "Alpha Builders", 5_000_000.0, 2023),
+                ("Region IV-A", "beta construction", None, 2024),
+                ("NCR", None, 12_500_000.0, 2022),
+                ("Region V", "Gamma Corp", 800_000.0, None),
+                ("NCR", "Alpha Builders", 2_000_000.0, 2024),
+                (None, "Delta Works", 7_250_000.0, 2023),
+            ],
+        )
+        # The cached result is fetched the way execute_sql fetches it, categoricals included.
+        self.previous_df, _ = read_sql_bounded(PREVIOUS_SQL, self.conn)
+
+    def tearDown(self):
+        self.conn.close()
+
+    def _assert_same_rows(self, operations: list):
+        local = apply_local_operations(self.previous_df, operations)
+        sql = operations_to_sql(PREVIOUS_SQL, self.previous_df, operations)
+        remote = pd.read_sql(sql, self.conn)
+        self.assertEqual(_records(local), _records(remote), operations)
+
+    def test_sorts_put_nulls_where_sqlite_does(self):
+        for column in ("contract_cost", "infra_year", "region", "contractor"):
+            for ascending in (True, False):
+                self._assert_same_rows([{"op": "sort", "column": column, "ascending": ascending}])
+
+    def test_filters_drop_nulls(self):
+        self._assert_same_rows([{"op": "filter", "column": "contract_cost", "operator": ">", "value": 1_000_000}])
+        self._assert_same_rows([{"op": "filter", "column": "region", "operator": "!=", "value": "ncr"}])
+        self._assert_same_rows([{"op": "filter", "column": "contractor", "operator": "==", "value": "ALPHA BUILDERS"}])
+        self._assert_same_rows([{"op": "filter", "column": "contractor", "operator": "contains", "value": "con"}])
+
+    def test_chained_operations(self):
+        self._assert_same_rows([
+            {"op": "filter", "column": "infra_year", "operator": ">=", "value": 2023},
+            {"op": "sort", "column": "contract_cost", "ascending": False},
+            {"op": "limit", "n": 2},
+        ])
+
+class MightRefineTest(unittest.TestCase):
+    def setUp(self):
+        self.previous_df = pd.DataFrame({"region": ["NCR"], "total_contract_cost": [1.0]})
+
+    def test_refinements_reach_the_classifier(self):
+        for question in ("Only those in 2023", "Sort by total contract cost", "what about Region V?", "2024?"):
+            self.assertTrue(might_refine(question, self.previous_df), question)
+
+    def test_new_questions_skip_the_classifier(self):
+        for question in (
+            "How many flood control projects were completed in Bulacan in 2022?",
+            "List the contractors with CPES ratings below satisfactory in Bulacan",
+        ):
+            self.assertFalse(might_refine(question, self.previous_df), question)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,29 @@
+import os
+import sys
+import unittest
+
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from sql_fetch import downcast_chunk
+
+class DowncastChunkTest(unittest.TestCase):
+    def test_floats_stay_float64_so_totals_are_exact(self):
+        rng = np.random.default_rng(0)
+        costs = rng.integers(1_000_000, 16_000_000, size=5000).astype(np.float64)
+        df = downcast_chunk(pd.DataFrame({"contract_cost": costs}), set())
+        self.assertEqual(df["contract_cost"].dtype, np.float64)
+        self.assertEqual(df["contract_cost"].sum(), costs.sum())
+        self.assertEqual(df["contract_cost"].mean(), costs.mean())
+
+    def test_integers_narrow_and_text_becomes_categorical(self):
+        df = pd.DataFrame({"infra_year": [2022, 2023, 2024] * 100, "region": ["R1", "R2", "R3"] * 100})
+        downcast = downcast_chunk(df, {1})
+        self.assertEqual(downcast["infra_year"].dtype, np.int16)
+        self.assertEqual(downcast["infra_year"].sum(), df["infra_year"].sum())
+        self.assertIsInstance(downcast["region"].dtype, pd.CategoricalDtype)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -2,7 +2,9 @@ import logging
 import pandas as pd
 import json
 import re
-from sqlalchemy import create_engine
+import os
+from pydantic import BaseModel, Field
+from sqlalchemy import create_engine, event
 
 # LangChain and Google AI libraries
 from langchain_community.utilities import SQLDatabase
@@ -10,27 +12,48 @@ from langchain_core.prompts import ChatPromptTemplate
 from langchain_core.output_parsers import StrOutputParser
 
 
-import bleach
-
 # The safe LLM factory function (assuming this is defined elsewhere)
 from llm_config import get_llm
+from llm_governor import governor, estimate_tokens, OUTPUT_TOKEN_ALLOWANCE
+from fewshot import examples_for
+import metrics
+from contractor_fts import get_available_fts_tables, rewrite_contractor_predicates
+from offload import run_frame_stage
+from summarizer import summarize_result
+from sql_fetch import read_sql_bounded
+from partitions import USE_YEAR_PARTITIONS, execute_partitioned
+
+DB_URI = os.getenv("FLOODGPT_DB_URI", "sqlite:///db/analytics.db")
+INSIGHT_MODEL = os.getenv("INSIGHT_MODEL", "gemini-2.5-flash")
+# Results with at most this many cells (rows x columns) are explained by the cheaper model.
+INSIGHT_SMALL_MODEL = os.getenv("INSIGHT_SMALL_MODEL", "gemini-2.5-flash-lite")
+INSIGHT_SMALL_MAX_CELLS = int(os.getenv("INSIGHT_SMALL_MAX_CELLS", "6"))
+# Answer relevance, SQL generation and self-validation with one structured-output call;
+# the separate validation call is made only when local checks fail or confidence is low.
+USE_COMBINED_SQL_CALL = os.getenv("USE_COMBINED_SQL_CALL", "0") == "1"
+COMBINED_SQL_MIN_CONFIDENCE = float(os.getenv("COMBINED_SQL_MIN_CONFIDENCE", "0.7"))
+_ENGINE = None
+
+def get_engine():
+    """Returns the process-wide SQLAlchemy engine so connections are pooled across queries."""
+    global _ENGINE
+    if _ENGINE is None:
+        _ENGINE = create_engine(DB_URI)
+        if _ENGINE.dialect.name == "sqlite":
+            @event.listens_for(_ENGINE, "connect")
+            def _read_only(dbapi_connection, connection_record):
+                # The agent only ever reads; LLM-written SQL cannot write even if a check misses it.
+                dbapi_connection.execute("PRAGMA query_only = ON")
+    return _ENGINE
 
 def sanitize_and_validate_data(df: pd.DataFrame) -> pd.DataFrame:
     """
     Sanitizes and validates the data in a Pandas DataFrame.
     This function dynamically checks the data types of the columns and sanitizes the data accordingly.
+    Large results are processed in the CPU offload pool so the event loop stays responsive.
     """
     logging.info("Sanitizing and validating data...")
-    
-    for col in df.columns:
-        # Sanitize string columns
-        if df[col].dtype == 'object':
-            df[col] = df[col].apply(lambda x: bleach.clean(x) if isinstance(x, str) else x)
-        # Coerce numeric columns to numeric, coercing errors to NaN
-        elif pd.api.types.is_numeric_dtype(df[col]):
-            pd.to_numeric(df[col], errors='coerce')
-            
-    return df
+    return run_frame_stage("sanitize", df)
 
 def is_prompt_injection(question: str) -> bool:
     """Classifies a user's question as a prompt injection attempt or not."""
@@ -49,15 +72,13 @@ def is_prompt_injection(question: str) -> bool:
     )
 
     llm = get_llm(model_name="gemini-2.5-flash", temperature=0)
-    chain = prompt | llm | StrOutputParser()
+    chain = governor.wrap("prompt_injection", prompt | llm | StrOutputParser(), hedge=True)
 
     response = chain.invoke({"question": question})
     return response.strip().lower() == "prompt_injection"
 
-def is_question_related(question: str, db_schema: str) -> bool:
-    """Classifies a user's question as related or unrelated to the database schema."""
-    logging.info("Classifying question...")
-
+def question_relevance_chain():
+    """Builds the governed chain that labels a question 'related' or 'unrelated' (also used for batching)."""
     prompt = ChatPromptTemplate.from_template(
         """You are an AI assistant that classifies user questions as either 'related' or 'unrelated' to the provided database schema.
 
@@ -76,16 +97,17 @@ def is_question_related(question: str, db_schema: str) -> bool:
     )
 
     llm = get_llm(model_name="gemini-2.5-flash", temperature=0)
-    chain = prompt | llm | StrOutputParser()
+    return governor.wrap("question_relevance", prompt | llm | StrOutputParser(), hedge=True)
 
-    response = chain.invoke({"schema": db_schema, "question": question})
+def is_question_related(question: str, db_schema: str) -> bool:
+    """Classifies a user's question as related or unrelated to the database schema."""
+    logging.info("Classifying question...")
+    response = question_relevance_chain().invoke({"schema": db_schema, "question": question})
     return response.strip().lower() == "related"
 
 # --- 1. SQL GENERATION FUNCTION ---
-def generate_sql_query(question: str, db_schema: str) -> str:
-    """Takes a user question and schema, and generates a SQL query."""
-    logging.info("Generating SQL query...")
-    
+def sql_generation_chain():
+    """Builds the governed chain that turns a question and schema into SQL (also used for batching)."""
     prompt = ChatPromptTemplate.from_template(
         """You are an expert SQL analyst. Your task is to convert a user's question into a syntactically correct SQLite query.
         
@@ -98,22 +120,40 @@ def generate_sql_query(question: str, db_schema: str) -> str:
         - When a query requires joining `flood_control_projects` and `cpes_projects`, you MUST use the `contractor_name_mapping` table.
         - When filtering by a contractor's name, you MUST use the `LIKE` operator to handle partial matches and variations in the name.
         
+        {examples}
         Based on the schema and rules, generate a SQL query to answer the user's question: "{question}"
         """
     )
     
     llm = get_llm(model_name="gemini-2.5-flash", temperature=0)
-    chain = prompt | llm | StrOutputParser()
-    
-    sql_query = chain.invoke({"schema": db_schema, "question": question})
+    return governor.wrap("generate_sql", prompt | llm | StrOutputParser(), hedge=True)
+
+def clean_generated_sql(sql_query: str) -> str:
     # The LLM sometimes wraps the query in markdown, so we clean it.
     return sql_query.strip().replace("```sql", "").replace("```", "")
 
-# --- 2. SQL VALIDATION & CORRECTION FUNCTION ---
-def validate_and_correct_sql(sql_query: str, db_schema: str) -> dict:
-    """Validates a SQL query against the schema and corrects it if needed."""
-    logging.info("Validating and correcting SQL query...")
+def sql_generation_inputs(question: str, db_schema: str, exclude_exact: bool = False) -> tuple[dict, str]:
+    """
+    Builds the SQL generation prompt inputs, with retrieved few-shot examples unless the
+    question falls in the zero-shot holdout. Returns (inputs, variant) and counts the
+    prompt size per variant so both can be compared in /metrics.
+    """
+    variant, examples = examples_for(question, exclude_exact=exclude_exact)
+    inputs = {"schema": db_schema, "question": question, "examples": examples}
+    metrics.increment(f"sql.{variant}.queries")
+    metrics.increment(f"sql.{variant}.prompt_tokens", estimate_tokens(inputs) - OUTPUT_TOKEN_ALLOWANCE)
+    return inputs, variant
 
+def generate_sql_query(question: str, db_schema: str, exclude_exact: bool = False) -> str:
+    """Takes a user question and schema, and generates a SQL query."""
+    logging.info("Generating SQL query...")
+    inputs, _ = sql_generation_inputs(question, db_schema, exclude_exact=exclude_exact)
+    sql_query = sql_generation_chain().invoke(inputs)
+    return clean_generated_sql(sql_query)
+
+# --- 2. SQL VALIDATION & CORRECTION FUNCTION ---
+def sql_validation_chain():
+    """Builds the governed chain that checks and corrects a SQL query (also used for batching)."""
     prompt = ChatPromptTemplate.from_template(
         """You are an AI assistant that validates and fixes SQL queries. Your task is to:
         1. Check if the SQL query is syntactically correct for SQLite.
@@ -136,9 +176,16 @@ def validate_and_correct_sql(sql_query: str, db_schema: str) -> dict:
     )
     
     llm = get_llm(model_name="gemini-2.5-flash", temperature=0)
-    chain = prompt | llm | StrOutputParser()
+    return governor.wrap("validate_sql", prompt | llm | StrOutputParser(), hedge=True)
 
-    response_str = chain.invoke({"schema": db_schema, "sql_query": sql_query})
+def validate_and_correct_sql(sql_query: str, db_schema: str) -> dict:
+    """Validates a SQL query against the schema and corrects it if needed."""
+    logging.info("Validating and correcting SQL query...")
+    response_str = sql_validation_chain().invoke({"schema": db_schema, "sql_query": sql_query})
+    return parse_validation_response(sql_query, response_str)
+
+def parse_validation_response(sql_query: str, response_str: str) -> dict:
+    """Parses the validation LLM's JSON answer, guarding against hallucinated corrections."""
     clean_response_str = response_str.strip().replace('`json', '').replace('`', '')
     
     try:
@@ -175,35 +222,123 @@ def validate_and_correct_sql(sql_query: str, db_schema: str) -> dict:
     except json.JSONDecodeError:
         return {"valid": False, "issues": "Failed to get a valid JSON response from the validation LLM.", "corrected_query": sql_query}
 
+# Combined mode (USE_COMBINED_SQL_CALL): relevance, generation and self-validation in one call.
+class SQLPlan(BaseModel):
+    """The combined call's answer; the model is constrained to this JSON schema."""
+    related: bool = Field(description="Whether the question can be answered from the database schema.")
+    sql: str = Field(description="One SQLite SELECT statement answering the question, without markdown; empty if unrelated.")
+    confidence: float = Field(ge=0, le=1, description="Confidence from 0 to 1 that the query is valid SQLite and answers the question.")
+    notes: str = Field(description="Short notes on assumptions or doubts about the query.")
+
+def combined_sql_chain():
+    """Builds the governed chain that checks relevance, writes the SQL and rates it in one structured-output call."""
+    prompt = ChatPromptTemplate.from_template(
+        """You are an expert SQL analyst for a database of flood control projects.
+
+        Given the following database schema:
+        ---
+        {schema}
+        ---
+
+        And the following critical rules for joining tables and filtering:
+        - When a query requires joining `flood_control_projects` and `cpes_projects`, you MUST use the `contractor_name_mapping` table.
+        - When filtering by a contractor's name, you MUST use the `LIKE` operator to handle partial matches and variations in the name.
+
+        {examples}
+        For the user's question: "{question}"
+        1. Decide whether the question is related to the database schema. If it is not, set "related" to false and "sql" to "".
+        2. If it is, write one syntactically correct SQLite SELECT query that answers it.
+        3. Check your query against the schema: table and column names, joins and SQLite syntax. Set "confidence" accordingly and explain any doubts in "notes".
+        """
+    )
+
+    llm = get_llm(model_name="gemini-2.5-flash", temperature=0)
+    # The locked langchain-google-genai (2.0.x) enforces the schema through function calling
+    # and rejects a `method` argument.
+    return governor.wrap("plan_sql", prompt | llm.with_structured_output(SQLPlan), hedge=True)
+
+def check_sql_locally(sql_query: str) -> str | None:
+    """
+    Checks a query without an LLM: it must be a read-only SELECT that SQLite can plan
+    (which catches syntax errors, unknown tables and columns). Returns the issue, or None.
+    """
+    issue = read_only_violation(sql_query)
+    if issue:
+        return issue
+    raw_conn = get_engine().raw_connection()
+    try:
+        # EXPLAIN QUERY PLAN compiles the statement without running it.
+        raw_conn.cursor().execute(f"EXPLAIN QUERY PLAN {sql_query.strip().rstrip(';')}")
+    except Exception as e:
+        return str(e)
+    finally:
+        raw_conn.close()
+    return None
+
 # --- 3. SQL EXECUTION FUNCTION ---
+FORBIDDEN_SQL_KEYWORDS = [
+    r'\bINSERT\b', r'\bUPDATE\b', r'\bDELETE\b', r'\bDROP\b', r'\bALTER\b', r'\bCREATE\b',
+    r'\bTRUNCATE\b', r'\bSHUTDOWN\b', r'\bRESTART\b', r'\bKILL\b', r'\bGRANT\b', r'\bREVOKE\b'
+]
+
+def read_only_violation(sql_query: str) -> str | None:
+    """Returns why a query is not an allowed read-only SELECT, or None if it is."""
+    normalized_query = sql_query.strip().upper()
+    if not normalized_query.startswith("SELECT"):
+        return "Only SELECT queries are allowed. INSERT, UPDATE, and DELETE operations are forbidden."
+    for keyword in FORBIDDEN_SQL_KEYWORDS:
+        if re.search(keyword, normalized_query):
+            return f"Forbidden SQL keyword detected: {keyword[2:-2]}. Only SELECT queries are allowed."
+    return None
+
 def execute_sql_query(sql_query: str) -> dict:
-    """Executes a validated SQL query and returns the results as a Pandas DataFrame."""
+    """
+    Executes a validated SQL query and returns the results as a Pandas DataFrame.
+    `truncated` is True when the result was cut off at the memory budget.
+    """
     logging.info(f"Executing validated SQL query:\n{sql_query}")
-    db_uri = "sqlite:///db/analytics.db"
 
     # Security check: Only allow SELECT queries
     normalized_query = sql_query.strip().upper()
-    if not normalized_query.startswith("SELECT"):
-        error_msg = "Only SELECT queries are allowed. INSERT, UPDATE, and DELETE operations are forbidden."
+    error_msg = read_only_violation(sql_query)
+    if error_msg:
         logging.error(error_msg)
         return {"sql_dataframe": pd.DataFrame(), "error": error_msg}
-    
-    # Further check for forbidden keywords within the query
-    forbidden_keywords = [
-        r'\bINSERT\b', r'\bUPDATE\b', r'\bDELETE\b', r'\bDROP\b', r'\bALTER\b', r'\bCREATE\b',
-        r'\bTRUNCATE\b', r'\bSHUTDOWN\b', r'\bRESTART\b', r'\bKILL\b', r'\bGRANT\b', r'\bREVOKE\b'
-    ]
-    for keyword in forbidden_keywords:
-        if re.search(keyword, normalized_query):
-            error_msg = f"Forbidden SQL keyword detected: {keyword[2:-2]}. Only SELECT queries are allowed."
-            logging.error(error_msg)
-            return {"sql_dataframe": pd.DataFrame(), "error": error_msg}
             
+    engine = get_engine()
+
+    # With the year-partitioned layout, aggregates and year-filtered queries read the
+    # partitions instead (the FTS rewrite is skipped: its rowids refer to the main table).
+    if USE_YEAR_PARTITIONS:
+        try:
+            partitioned = execute_partitioned(sql_query, engine.url.database)
+            if partitioned is not None:
+                df, truncated = partitioned
+                return {"sql_dataframe": df, "truncated": truncated}
+        except Exception as e:
+            logging.warning(f"Partitioned execution failed, querying the main table. Error: {e}")
+
+    # Contractor LIKE filters force full scans, so route them through the FTS5 trigram indexes.
+    rewritten_query = sql_query
+    if "LIKE" in normalized_query:
+        raw_conn = engine.raw_connection()
+        try:
+            rewritten_query = rewrite_contractor_predicates(sql_query, get_available_fts_tables(raw_conn))
+        finally:
+            raw_conn.close()
+
+    # Results are fetched in chunks and downcast as they arrive, up to SQL_RESULT_BUDGET_MB.
     try:
-        engine = create_engine(db_uri)
-        df = pd.read_sql(sql_query, engine)
-        return {"sql_dataframe": df}
+        df, truncated = read_sql_bounded(rewritten_query, engine)
+        return {"sql_dataframe": df, "truncated": truncated}
     except Exception as e:
+        if rewritten_query != sql_query:
+            logging.warning(f"FTS-rewritten query failed, retrying the original query. Error: {e}")
+            try:
+                df, truncated = read_sql_bounded(sql_query, engine)
+                return {"sql_dataframe": df, "truncated": truncated}
+            except Exception as retry_error:
+                e = retry_error
         logging.error(f"SQL execution failed: {e}")
         return {"sql_dataframe": pd.DataFrame(), "error": str(e)}
 
@@ -217,7 +352,7 @@ You are an AI assistant that recommends appropriate data visualizations. Based o
 **Analyze the following information:**
 
 1.  **User's Question:** "{question}"
-2.  **Query Result Summary (Column Names and First 3 Rows):**
+2.  **Query Result Summary (size, statistics and sample rows):**
     ---
     {data_summary}
     ---
@@ -229,6 +364,8 @@ Recommended Visualization: [Chart type or "None"]
 Reason: [Brief explanation for your recommendation]
 """
 
+VISUALIZATION_SUMMARY_MAX_CHARS = 1500
+
 def recommend_visualization(user_question: str, sql_result_df: pd.DataFrame) -> str:
     """Recommends a data visualization based on the user's question and a DataFrame."""
     logging.info("Generating visualization recommendation...")
@@ -236,11 +373,12 @@ def recommend_visualization(user_question: str, sql_result_df: pd.DataFrame) ->
         if sql_result_df.empty:
             return "Recommended Visualization: none\nReason: The query returned no data to visualize."
             
-        data_summary = f"Columns: {', '.join(sql_result_df.columns)}\n\n{sql_result_df.head(3).to_string()}"
+        # Chart choice needs the shape of the data more than its details, so a shorter digest suffices.
+        data_summary = summarize_result(sql_result_df, max_chars=VISUALIZATION_SUMMARY_MAX_CHARS)
 
         prompt = ChatPromptTemplate.from_template(VISUALIZATION_PROMPT)
         viz_llm = get_llm(model_name="gemini-2.5-flash", temperature=0)
-        chain = prompt | viz_llm | StrOutputParser()
+        chain = governor.wrap("recommend_visualization", prompt | viz_llm | StrOutputParser(), hedge=True)
         
         response = chain.invoke({"question": user_question, "data_summary": data_summary})
         return response
@@ -250,13 +388,11 @@ def recommend_visualization(user_question: str, sql_result_df: pd.DataFrame) ->
         return "Recommended Visualization: none\nReason: An error occurred while processing the data for visualization."
 
 # --- 5. INSIGHT GENERATION FUNCTION ---
-def generate_insight_from_data(question: str, df: pd.DataFrame) -> str:
-    """Generates a human-friendly insight from the data."""
-    logging.info("Generating insight from data...")
-
-    if df.empty:
-        return "The query returned no data, so there is nothing to explain."
-
+def insight_chain(small: bool = False):
+    """
+    Builds the governed chain that explains a query result (also used for batching).
+    `small` selects the cheaper model for results that need no narrative analysis.
+    """
     # prompt = ChatPromptTemplate.from_template(
     #     """You are an expert data analyst. Your task is to clearly and human-friendly explain the meaning of the data returned from a user's query.
 
@@ -315,10 +451,22 @@ def generate_insight_from_data(question: str, df: pd.DataFrame) -> str:
 
 
 
-    llm = get_llm(model_name="gemini-2.5-flash", temperature=0.7)
-    chain = prompt | llm | StrOutputParser()
+    llm = get_llm(model_name=INSIGHT_SMALL_MODEL if small else INSIGHT_MODEL, temperature=0.7)
+    return governor.wrap("insight", prompt | llm | StrOutputParser())
 
-    data_summary = f"Columns: {', '.join(df.columns)}\n\n{df.head().to_string()}"
-    
-    insight = chain.invoke({"question": question, "data_summary": data_summary})
+def insight_data_summary(df: pd.DataFrame) -> str:
+    """Renders the token-bounded digest of a result shown to the insight LLM."""
+    return summarize_result(df)
+
+def generate_insight_from_data(question: str, df: pd.DataFrame) -> str:
+    """Generates a human-friendly insight from the data."""
+    logging.info("Generating insight from data...")
+
+    if df.empty:
+        return "The query returned no data, so there is nothing to explain."
+
+    small = df.size <= INSIGHT_SMALL_MAX_CELLS
+    if small:
+        metrics.increment("insight.small_model")
+    insight = insight_chain(small=small).invoke({"question": question, "data_summary": insight_data_summary(df)})
     return insight